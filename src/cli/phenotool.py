@@ -44,9 +44,11 @@ from pkpep import pkpep
 
 @click.group()
 @click.pass_context
+@click.option('--engine', type=click.Choice(['pandas', 'arrow'], case_sensitive=False), default='pandas', show_default=True, help=OPTIONS.engine)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True, help=OPTIONS.jobs)
 @click.option('--log', default="warning", help=OPTIONS.log, show_default=True)
 @click.version_option(version=__version__)
-def main(ctx, log):
+def main(ctx, engine, jobs, log):
     """Organize column-based information for analyses.
 
 Read column-based sample information and perform simple sorting, filtering and transformations on phenotype values.
@@ -58,6 +60,8 @@ Outputs sample information in formats appropriate for popular GWAS tools includi
     logging.basicConfig(level=log_num)
     ctx.ensure_object(dict)
     ctx.obj['files'] = ctx.obj.get('files', [])
+    ctx.obj['engine'] = engine
+    ctx.obj['jobs'] = jobs
 
 
 # PEP Command
@@ -22,6 +22,7 @@ __version__ = """0.10"""
 # --%%  RUN: Perform Basic Setup  %%--
 
 import click
+import itertools
 import logging
 import sys
 
@@ -31,8 +32,11 @@ logger = logging.getLogger(__name__)
 import eastwood.cli as Eastwood
 from phenotool import EPILOG, OPTIONS, plink_chain, rvtest_chain, snptest_chain, textfile_chain
 import ukbiobank.options as OPTIONS_UKB
+from phenotool.rowindex import RowIndex
 import pklib.pkcsv as csv
 from pklib.pkclick import CSV, isalFile, SampleList
+from ukbiobank.cache import UKBCache
+from ukbiobank.postings import Postings
 from ukbiobank.ukbiobank import UKBioBank
 
 # --%%  END: Perform Basic Setup  %%--
@@ -47,17 +51,23 @@ from ukbiobank.ukbiobank import UKBioBank
 # --%%  RUN: Commands  %%--
 
 @click.group(chain=True, invoke_without_command=True, no_args_is_help=True, epilog=EPILOG.chained)
+@click.option('--cache', type=click.Path(file_okay=False), default=None, envvar='UKBIOBANK_CACHE', help=OPTIONS_UKB.cache)
+@click.option('--chunksize', type=click.IntRange(min=1), default=None, help=OPTIONS.chunksize)
+@click.option('--data-dictionary', type=click.Path(exists=True, dir_okay=False), default=None, envvar='UKBIOBANK_DATA_DICTIONARY', help=OPTIONS_UKB.data_dictionary)
 @click.option('-d', '--datafields', type=CSV(), required=True, help=OPTIONS_UKB.datafields)
+@click.option('--engine', type=click.Choice(['pandas', 'arrow'], case_sensitive=False), default='pandas', show_default=True, help=OPTIONS.engine)
 @click.option('-i', '--instances', type=CSV(), help=OPTIONS_UKB.instances)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True, help=OPTIONS.jobs)
 @click.option('--log', default="warning", show_default=True, help=OPTIONS.log)
 @click.option('--nrows', type=int, default=None, help=OPTIONS.nrows)
 @click.option('--phenotype-file', type=isalFile(mode='rb'), default=None, envvar='UKBIOBANK_PHENOTYPE_FILE', help=OPTIONS_UKB.phenotype_file)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
 @click.option('--sex', type=click.Choice(['genetic','registry','none'], case_sensitive=False), default='registry', show_default=True, help=OPTIONS_UKB.sex)
+@click.option('--shm', type=click.Path(file_okay=False), default=None, envvar='UKBIOBANK_SHM', help=OPTIONS_UKB.shm)
 @click.option('-v', '--values', default=".", help=OPTIONS.values, hidden=True)
 @click.version_option(version=__version__)
 @click.pass_context
-def ukbiobank(ctx, datafields, instances, log, nrows, phenotype_file, samples, sex, values):
+def ukbiobank(ctx, cache, chunksize, data_dictionary, datafields, engine, instances, jobs, log, nrows, phenotype_file, samples, sex, shm, values):
     """Extraction and processing of UKBiobank Phenotypes.
 
 The UK Biobank lists thousands of phenotypic variables in a strict three tier hierarchy, which requires some
@@ -79,13 +89,19 @@ https://biobank.ndph.ox.ac.uk/showcase/search.cgi
     try: ctx.obj['args']['nrows'] = nrows
     except KeyError:
         ctx.obj['args'] = {'nrows': nrows}
+    ctx.obj['args']['cache'] = cache
+    ctx.obj['args']['chunksize'] = chunksize
+    ctx.obj['args']['dictionary'] = data_dictionary
+    ctx.obj['args']['engine'] = engine
     ctx.obj['args']['instances'] = instances
     ctx.obj['args']['phenovars'] = datafields
     ctx.obj['args']['samples'] = samples
     ctx.obj['args']['sexcol'] = sex
+    ctx.obj['args']['shm'] = shm
     ctx.obj['args']['values'] = values
     ctx.obj['constructor'] = UKBioBank
     ctx.obj['files'] = ctx.obj.get('files', [])
+    ctx.obj['jobs'] = jobs
     if phenotype_file:
         ctx.obj['files'].append(phenotype_file)
 
@@ -93,24 +109,79 @@ https://biobank.ndph.ox.ac.uk/showcase/search.cgi
     if ctx.invoked_subcommand is None:
         if phenotype_file is not None:
             result = ctx.invoke(textfile_chain, files=[phenotype_file])
-            process_pipeline([result], datafields, instances, log, nrows, phenotype_file, samples, sex, values)
+            process_pipeline([result], cache, chunksize, data_dictionary, datafields, engine, instances, jobs, log, nrows, phenotype_file, samples, sex, shm, values)
         else:
             logger.error("UKBioBank: You must specify either a command or give a phenotype file. Exiting...")
             exit(1)
 
 @ukbiobank.result_callback()
 @click.pass_obj
-def process_pipeline(obj, processors, datafields, instances, log, nrows, phenotype_file, samples, sex, values):
+def process_pipeline(obj, processors, cache, chunksize, data_dictionary, datafields, engine, instances, jobs, log, nrows, phenotype_file, samples, sex, shm, values):
     logger.debug(f"Pipeline: Cols to be deleted: {obj.get('to_be_deleted')}")
     logger.debug(f'Processors: {processors}')
     try: pheno = obj['pheno']
     except KeyError:
-        sys.exit("\nERROR: It looks like no input was provided??\n")
+        if not obj.get('cached'):
+            sys.exit("\nERROR: It looks like no input was provided??\n")
+        pheno = None
     for processor in processors:
         pheno = processor(pheno)
 
 
 
+#
+# -%    Cache Command (Chained Version)  %-
+
+@ukbiobank.command(name="cache", no_args_is_help=True)
+@click.pass_obj
+@click.argument('action', type=click.Choice(['build', 'index', 'postings'], case_sensitive=False))
+def cache_chain(obj, action):
+    """Store UKB datafields in a columnar cache for fast extraction.
+
+\b
+ACTIONS:
+  build  Parse the phenotype file once and store the requested datafields in a column-partitioned cache.
+  index  Index the byte offset of each participant's row in the phenotype file ('<file>.eidx').
+  postings  Build an inverted index of the coded datafields given with '--datafields' ('<file>.postings').
+
+The cache holds one Parquet file per datafield and is placed next to the phenotype file (as '<file>.cache') unless
+a directory is given with '--cache'. Only the datafields given with '--datafields' (and '--instances') are stored,
+together with the participant IDs and both sex fields. Building again into the same cache adds further datafields.
+
+Later extractions from the same phenotype file read the requested datafields directly from the cache, provided every
+column they select in the phenotype file is stored there (eg. not for all instances from a cache built with one). A cache is ignored once the phenotype file has been modified. With '--data-dictionary' the
+columns are stored in the type of their datafield. Requires 'pyarrow'.
+
+The row index lets extractions with '--samples' seek directly to the rows of the listed participants instead of
+parsing the whole file. Only uncompressed phenotype files can be indexed.
+
+The inverted index maps each code of a datafield (eg. 20002, 20003 or 41270) to the participants carrying it, so
+lookups of codes in those datafields, eg. by the 'prevalence' and 'incidence' commands, only read the matching entries.
+"""
+    def processor(pheno):
+        return pheno
+
+    phenovars = UKBioBank.plan(obj['args']['phenovars'], obj['args'].get('selectors', []), obj['args'].get('instances'))
+    magic = list(itertools.chain(UKBioBank.MAGIC_COLS[UKBioBank.mkey_id], *UKBioBank.sex_dict.values()))
+    for fobj in obj['files']:
+        dialect = csv.sniff(fobj)
+        if action == 'index':
+            RowIndex.build(fobj, delimiter=getattr(dialect, 'delimiter', None))
+            continue
+        if action == 'postings':
+            Postings.build(fobj, obj['args']['phenovars'], dialect=dialect)
+            fobj.seek(0)
+            continue
+        usecols = UKBioBank.colselector(phenovars, magic)
+        schema = UKBioBank.schema(obj['args']['dictionary'], UKBioBank.peek_columns(fobj, usecols=usecols, dialect=dialect)) if obj['args'].get('dictionary') else {}
+        store = UKBCache.build(fobj if dialect else csv.DictReader(fobj), obj['args'].get('cache'), dialect=dialect, usecols=usecols, **schema)
+        logger.info(f"Cache: Stored datafields {store.fields} in '{store.path}'.")
+        fobj.seek(0) # Later commands in the chain may read the file again
+    obj['cached'] = True
+    return processor
+
+
+
 #
 # -%    Add Command on External Commands (Chained Versions)  %-
 
@@ -7,7 +7,10 @@
 __version__ = "0.4"
 
 import click
+import hashlib
+import json
 import logging
+import pandas as pd
 import sys
 
 assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
@@ -21,6 +24,41 @@ from ukbiobank.ukbiobank import UKBioBank
 
 
 
+###########################################################
+#
+# -%  Chain memo of Eastwood algorithm objects  %-
+
+def memo_prevalence(obj, pheno, baseline, cache=None, jobs=None, snapshot=None):
+	"""Return: The Prevalence of pheno at baseline.
+
+	The object is memoized in the chain context obj and shared by all Eastwood commands in the chain, so the features
+	are only extracted once per phenotype even when the commands use different baselines: a Prevalence built from the
+	same inputs at another baseline is moved to baseline.
+	jobs: Number of processes calculating shards of the samples. Default: The '--jobs' of the ukbiobank group, or 1.
+	snapshot: Directory with the snapshot of an earlier run (see Prevalence._fromsnapshot).
+	"""
+	memo = obj.setdefault('eastwood', dict())
+	inputs = memo_inputs(pheno, cache, snapshot)
+	if (inputs, baseline) not in memo:
+		if (old := next((key for key in memo if key[0] == inputs), None)) is not None:
+			memo[inputs, baseline] = memo.pop(old).atbaseline(baseline)
+		else:
+			memo[inputs, baseline] = Prevalence(pheno, baseline=baseline, cache=cache, jobs=jobs or obj.get('jobs', 1), snapshot=snapshot)
+	return memo[inputs, baseline]
+
+def memo_inputs(pheno, cache=None, snapshot=None):
+	"""Return: The inputs a Prevalence of pheno is built from besides the baseline; ie. the source file, the columns
+	read, the samples, the cache and the snapshot. Not the number of jobs, which does not change the result.
+
+	A phenotype not read from a file is identified by the object itself; the memo holds on to it, so it is not reused.
+	"""
+	source = json.dumps(pheno.source, sort_keys=True, default=str) if pheno.source else id(pheno)
+	columns = tuple(pheno.field2cols(UKBioBank.plan(Prevalence.UKBioFields)))
+	samples = hashlib.sha1(pd.util.hash_pandas_object(pheno.index, index=False).to_numpy().tobytes()).hexdigest()
+	return (source, columns, samples, cache, snapshot)
+
+
+
 ###########################################################
 #
 # -%  Click commands for Eastwood algorithms  %-
@@ -32,10 +70,14 @@ from ukbiobank.ukbiobank import UKBioBank
 @click.command(name="incidence", no_args_is_help=True, epilog=EPILOG.chained)
 @click.pass_context
 @click.option('-b', '--baseline', default=str(Incidence.UKBbaseline.date()), show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.baseline)
-@click.option('-e', '--enddate', default=str(Incidence.UKBenddate.date()), show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.stopdate)
+@click.option('--dm-cache', type=click.Path(file_okay=False, writable=True), help=OPTIONS.dmcache)
+@click.option('-e', '--enddate', default=[str(Incidence.UKBenddate.date())], multiple=True, show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.stopdates)
 @click.option('-i', '--interval', type=Timedelta(), help=OPTIONS.inciinterval)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help=OPTIONS.shards)
 @click.option('-p', '--prefix', default="Incidence", show_default=True, help=OPTIONS.columnprefix)
-def incidence_ukb(ctx, baseline, prefix, enddate, interval):
+@click.option('--snapshot', type=click.Path(file_okay=False, writable=True), help=OPTIONS.snapshot)
+@click.option('--survival/--no-survival', default=False, show_default=True, help=OPTIONS.survival)
+def incidence_ukb(ctx, baseline, dm_cache, prefix, enddate, interval, jobs, snapshot, survival):
 	"""Incidence (diabetes) algorithm from Eastwood2016.
 
 Incidence is calculated by first consulting a prevalence algorithm (same as for the 'prevalence' command) to mask out
@@ -50,16 +92,19 @@ PloS one 2016 Sep 15; 11(9): e0162388
 https://doi.org/10.1371/journal.pone.0162388
 """
 	def processor(pheno):
-		incidence = Incidence(pheno, baseline=baseline, enddate=enddate, interval=interval)
-		pheno[prefix + '_t1dm'] = incidence.t1dm
-		pheno[prefix + '_t2dm'] = incidence.t2dm
-		pheno[prefix + '_anydm'] = incidence.anydm
+		incidence = Incidence(prev=memo_prevalence(ctx.obj, pheno, baseline, dm_cache, jobs, snapshot), enddate=enddate[0], interval=interval)
+		if survival:
+			for col, values in incidence.survival(enddate).items():
+				pheno[f"{prefix}_{col}"] = values
+		else:
+			pheno[prefix + '_t1dm'] = incidence.t1dm
+			pheno[prefix + '_t2dm'] = incidence.t2dm
+			pheno[prefix + '_anydm'] = incidence.anydm
 		return pheno
 
-	for field in Incidence.UKBioFields:
-		if field not in ctx.obj['phenovars']:
-			ctx.obj['to_be_deleted'] = ctx.obj.get('to_be_deleted', list()) + [field]
-			ctx.obj['phenovars'].append(field)
+	assert survival or len(enddate) == 1, "Several '--enddate' are only supported with '--survival'."
+	ctx.obj.setdefault('args', dict())
+	ctx.obj['args']['selectors'] = list(dict.fromkeys(ctx.obj['args'].get('selectors', []) + Incidence.UKBioFields))
 	return processor
 	
 
@@ -69,12 +114,15 @@ https://doi.org/10.1371/journal.pone.0162388
 
 @click.command(name="prevalence", no_args_is_help=True, epilog=EPILOG.chained)
 @click.pass_context
-@click.option('-b', '--baseline', default=str(Prevalence.UKBbaseline.date()), show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.baseline)
+@click.option('-b', '--baseline', default=[str(Prevalence.UKBbaseline.date())], multiple=True, show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.baselines)
+@click.option('--dm-cache', type=click.Path(file_okay=False, writable=True), help=OPTIONS.dmcache)
 @click.option('--date/--no-date', default=False, show_default=True, help="NOT IMPLEMENTED")
 @click.option('--datename', default="Prevalence_date", show_default=True, help="NOT IMPLEMENTED")
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help=OPTIONS.shards)
 @click.option('-n', '--name', default="Prevalence", show_default=True, help=OPTIONS.columnname)
-@click.option('-s', '--style', default="eastwood", show_default=True, type=click.Choice(Prevalence.styles, case_sensitive=False), help=OPTIONS.prevstyles)
-def prevalence_ukb(ctx, baseline, date, datename, name, style):
+@click.option('--snapshot', type=click.Path(file_okay=False, writable=True), help=OPTIONS.snapshot)
+@click.option('-s', '--style', default=["eastwood"], multiple=True, show_default=True, type=click.Choice(Prevalence.styles, case_sensitive=False), help=OPTIONS.prevstyles)
+def prevalence_ukb(ctx, baseline, date, datename, dm_cache, jobs, name, snapshot, style):
 	"""Prevalence (diabetes) algorithm from Eastwood2016.
 
 The algorithm uses UK Biobank self-reported medical history and medication as well as hospital in-patient data to
@@ -88,17 +136,17 @@ PloS one 2016 Sep 15; 11(9): e0162388
 https://doi.org/10.1371/journal.pone.0162388
 """
 	def processor(pheno):
-		prevalence = Prevalence(pheno, baseline=baseline, style=style)
-		pheno[name] = prevalence.prevalence
+		prevalence = memo_prevalence(ctx.obj, pheno, baseline[0], dm_cache, jobs, snapshot)
+		prevalence.style = style[0]
+		for (when, how), col in prevalence.sweep(baseline, style).items():
+			pheno[name + (f"_{how}" if len(style) > 1 else "") + (f"_{when.date()}" if len(baseline) > 1 else "")] = col
 		if date:
 			logger.debug(f"date = {datename}")
 			pheno[datename] = prevalence.datediag()
 		return pheno
 
-	for field in Prevalence.UKBioFields:
-		if field not in ctx.obj['phenovars']:
-			ctx.obj['to_be_deleted'] = ctx.obj.get('to_be_deleted', list()) + [field]
-			ctx.obj['phenovars'].append(field)
+	ctx.obj.setdefault('args', dict())
+	ctx.obj['args']['selectors'] = list(dict.fromkeys(ctx.obj['args'].get('selectors', []) + Prevalence.UKBioFields))
 	return processor
 
 
@@ -110,11 +158,15 @@ https://doi.org/10.1371/journal.pone.0162388
 @click.group(chain=True, no_args_is_help=True)
 @click.pass_context
 @click.option('-b', '--baseline', default=str(Incidence.UKBbaseline.date()), show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.baseline)
-@click.option('-e', '--enddate', default=str(Incidence.UKBenddate.date()), show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.stopdate)
+@click.option('--dm-cache', type=click.Path(file_okay=False, writable=True), help=OPTIONS.dmcache)
+@click.option('-e', '--enddate', default=[str(Incidence.UKBenddate.date())], multiple=True, show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.stopdates)
 @click.option('-i', '--interval', type=Timedelta(), help=OPTIONS.inciinterval)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help=OPTIONS.shards)
 @click.option('-p', '--prefix', default="Incidence", show_default=True, help=OPTIONS.columnprefix)
+@click.option('--snapshot', type=click.Path(file_okay=False, writable=True), help=OPTIONS.snapshot)
+@click.option('--survival/--no-survival', default=False, show_default=True, help=OPTIONS.survival)
 @click.version_option(version=__version__)
-def incidence(ctx, baseline, enddate, interval, prefix):
+def incidence(ctx, baseline, dm_cache, enddate, interval, jobs, prefix, snapshot, survival):
 	"""Incidence (diabetes) algorithm from Eastwood2016.
 
 Incidence is calculated by first consulting a prevalence algorithm (same as for the 'prevalence' command) to mask out
@@ -131,19 +183,24 @@ https://doi.org/10.1371/journal.pone.0162388
 	# Ensure that ctx.obj exists and is a dict 
 	ctx.ensure_object(dict)
 	ctx.obj['constructor'] = UKBioBank
-	ctx.obj['phenovars'] = Incidence.UKBioFields
-	ctx.obj['to_be_deleted'] = Incidence.UKBioFields
+	ctx.obj['args'] = {'phenovars': list(), 'selectors': Incidence.UKBioFields}
+	ctx.obj['files'] = list()
 
 @incidence.result_callback()
 @click.pass_context
-def incidence_pipeline(ctx, processors, baseline, enddate, interval, prefix):
-	logger.debug(f"Pipeline: Cols to be deleted: {ctx.obj.get('to_be_deleted')}")
+def incidence_pipeline(ctx, processors, baseline, dm_cache, enddate, interval, jobs, prefix, snapshot, survival):
+	logger.debug(f"Pipeline: Helper selectors: {ctx.obj['args'].get('selectors')}")
 
 	pheno = ctx.obj['pheno']
-	incidence = Incidence(pheno, baseline=baseline, enddate=enddate, interval=interval)
-	pheno[prefix + '_t1dm'] = incidence.t1dm
-	pheno[prefix + '_t2dm'] = incidence.t2dm
-	pheno[prefix + '_anydm'] = incidence.anydm
+	assert survival or len(enddate) == 1, "Several '--enddate' are only supported with '--survival'."
+	incidence = Incidence(prev=memo_prevalence(ctx.obj, pheno, baseline, dm_cache, jobs, snapshot), enddate=enddate[0], interval=interval)
+	if survival:
+		for col, values in incidence.survival(enddate).items():
+			pheno[f"{prefix}_{col}"] = values
+	else:
+		pheno[prefix + '_t1dm'] = incidence.t1dm
+		pheno[prefix + '_t2dm'] = incidence.t2dm
+		pheno[prefix + '_anydm'] = incidence.anydm
 
 	for processor in processors:
 		pheno = processor(pheno)
@@ -170,11 +227,14 @@ incidence.add_command(snptest_chain)
 
 @click.group(chain=True, invoke_without_command=True, no_args_is_help=True)
 @click.pass_context
-@click.option('-b', '--baseline', default=str(Prevalence.UKBbaseline.date()), show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.baseline)
+@click.option('-b', '--baseline', default=[str(Prevalence.UKBbaseline.date())], multiple=True, show_default=True, type=click.DateTime(formats=["%Y-%m-%d"]), help=OPTIONS.baselines)
+@click.option('--dm-cache', type=click.Path(file_okay=False, writable=True), help=OPTIONS.dmcache)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), help=OPTIONS.shards)
 @click.option('-n', '--name', default="Prevalence", show_default=True, help=OPTIONS.columnname)
-@click.option('-s', '--style', default="eastwood", show_default=True, type=click.Choice(Prevalence.styles, case_sensitive=False), help=OPTIONS.prevstyles)
+@click.option('--snapshot', type=click.Path(file_okay=False, writable=True), help=OPTIONS.snapshot)
+@click.option('-s', '--style', default=["eastwood"], multiple=True, show_default=True, type=click.Choice(Prevalence.styles, case_sensitive=False), help=OPTIONS.prevstyles)
 @click.version_option(version=__version__)
-def prevalence(ctx, baseline, name, style):
+def prevalence(ctx, baseline, dm_cache, jobs, name, snapshot, style):
 	"""Prevalence (diabetes) algorithm from Eastwood2016
 
 The algorithm uses UK Biobank self-reported medical history and medication as well as hospital in-patient data to
@@ -190,17 +250,19 @@ https://doi.org/10.1371/journal.pone.0162388
 	# Ensure that ctx.obj exists and is a dict 
 	ctx.ensure_object(dict)
 	ctx.obj['constructor'] = UKBioBank
-	ctx.obj['phenovars'] = Prevalence.UKBioFields
-	ctx.obj['to_be_deleted'] = Prevalence.UKBioFields
+	ctx.obj['args'] = {'phenovars': list(), 'selectors': Prevalence.UKBioFields}
+	ctx.obj['files'] = list()
 
 @prevalence.result_callback()
 @click.pass_context
-def prevalence_pipeline(ctx, processors, baseline, name, style):
-	logger.debug(f"Pipeline: Cols to be deleted: {ctx.obj.get('to_be_deleted')}")
+def prevalence_pipeline(ctx, processors, baseline, dm_cache, jobs, name, snapshot, style):
+	logger.debug(f"Pipeline: Helper selectors: {ctx.obj['args'].get('selectors')}")
 
 	pheno = ctx.obj['pheno']
-	prevalence = Prevalence(pheno, baseline=baseline, style=style)
-	pheno[name] = prevalence.prevalence
+	prevalence = memo_prevalence(ctx.obj, pheno, baseline[0], dm_cache, jobs, snapshot)
+	prevalence.style = style[0]
+	for (when, how), col in prevalence.sweep(baseline, style).items():
+		pheno[name + (f"_{how}" if len(style) > 1 else "") + (f"_{when.date()}" if len(baseline) > 1 else "")] = col
 
 	for processor in processors:
 		pheno = processor(pheno)
@@ -4,50 +4,132 @@
 #
 # --%%  Setup and Initialize  %%--
 
+import concurrent.futures
 import copy
 from datetime import datetime
+import hashlib
+import json
 import logging
+import numpy as np
 import pandas as pd
+import pathlib
 import sys
 
 assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
 logger = logging.getLogger(__name__)
 
+from eastwood import kleene
+from eastwood.rules import Ruleset
+from ukbiobank.postings import Postings
+from ukbiobank.sharedstore import SharedStore
+from ukbiobank.ukbiobank import UKBioBank
+
 
 # Convienience function.
 
-# Need to double check this guy for Kleene logic (It doesn't follow it completely)
 def pkall(df, axis=0):
-	"""This function is necessary to address bugs with skipna=False when that behavior is needed."""
-	out = pd.Series(df.all(axis=axis), dtype='boolean')
-	out[df.isna().any(axis=axis)] = pd.NA
-	return out
+	"""Kleene AND of df across 'axis' (see eastwood.kleene). Return: pd.Series with dtype 'boolean'."""
+	work = df if df._get_axis_number(axis) == 1 else df.T
+	return kleene.series(kleene.all(work), index=work.index)
 
-def pkany():
-	"""This function is necessary to address bugs with skipna=False when that behavior is needed."""
-	sys.exit("Not implemented yet")
+def pkany(df, axis=0):
+	"""Kleene OR of df across 'axis' (see eastwood.kleene). Return: pd.Series with dtype 'boolean'."""
+	work = df if df._get_axis_number(axis) == 1 else df.T
+	return kleene.series(kleene.any(work), index=work.index)
 
-def datefirst(df, *args, **kwargs):
+def datefirst(df, axis=0):
 	"""Find the earliest occurrance of dates in a pd.DataFrame applied over 'axis'.
 
-	df: A Pandas Series or DataFrame.
+	df: A Pandas DataFrame.
 	axis: The axis to search across.
-	Return: A pd.Series with the earliest dates."""
-	mydf = df[isDateFirst(df, *args, **kwargs)]
-	out = mydf.apply(lambda s: pd.NaT if s.dropna().empty else s.dropna()[[0]].item(), *args, **kwargs)
-	out = out.apply(lambda x: pd.to_datetime(x) if isinstance(x, str) else x)
-	return out
-
-def isDateFirst(df, *args, **kwargs):
+	Return: A pd.Series with the earliest dates. Dates are returned as found in df, ie. a pd.Period stays a pd.Period.
+	  The dtype is that of the dates in df (see _datesdtype), also when no dates are found."""
+	work = df if df._get_axis_number(axis) == 1 else df.T
+	dtype = _datesdtype(work)
+	first = _datefirst(work)
+	if not first.any():
+		return pd.Series(pd.NaT, index=work.index, dtype=dtype)
+	hit, pos = first.any(axis=1), first.argmax(axis=1)
+	pieces = [work.iloc[rows, j].set_axis(rows) for j in range(work.columns.size) if (rows := np.flatnonzero(hit & (pos == j))).size]
+	out = pd.concat(pieces)
+	if out.dtype == 'object' or isinstance(out.dtype, pd.StringDtype):
+		out = out.astype('object').apply(lambda x: pd.to_datetime(x) if isinstance(x, str) else x)
+	if out.dtype != dtype:
+		out = pd.to_datetime(out) if dtype.kind == 'M' else out.astype(dtype)
+	return out.reindex(range(work.index.size), fill_value=pd.NaT).set_axis(work.index)
+
+def isDateFirst(df, axis=0):
 	"""Find the earlisest occurrance of dates in a pd.DataFrame applied over 'axis'.
 
-	df: A Pandas Series or DataFrame.
+	df: A Pandas DataFrame.
 	axis: The axis to search across.
 	Return: pd.DataFrame with bools."""
-	df = df.applymap(lambda x: x.end_time.date() if isinstance(x, type(pd.Period('2008'))) else x)
-	out = df.apply(lambda x: pd.to_datetime(x) == pd.to_datetime(x).min(), *args, **kwargs)
+	work = df if df._get_axis_number(axis) == 1 else df.T
+	out = pd.DataFrame(_datefirst(work), index=work.index, columns=work.columns)
+	return out if work is df else out.T
+
+def _datefirst(df):
+	"""Return: np.ndarray with bools marking the earliest date(s) in each row of df; False for missing dates."""
+	block = np.empty((df.index.size, df.columns.size), dtype='datetime64[ns]')
+	for j, (_, col) in enumerate(df.items()):
+		block[:, j] = asDatetime(col)
+	missing = np.isnat(block)
+	block = np.where(missing, np.iinfo('int64').max, block.view('int64'))
+	return (block == block.min(axis=1, initial=np.iinfo('int64').max)[:, None]) & ~missing
+
+def _datesdtype(df):
+	"""Return: The dtype of the dates in the columns of df; 'object' if they differ. Strings are taken as datetime64[ns].
+	Columns without any values are skipped, so the dtype is the same for every subset of the rows holding dates."""
+	dtypes = set()
+	for _, col in df.items():
+		if isinstance(col.dtype, pd.PeriodDtype) or pd.api.types.is_datetime64_any_dtype(col.dtype):
+			dtypes.add(col.dtype)
+		elif (kind := pd.api.types.infer_dtype(col, skipna=True)) == 'period':
+			dtypes.add(pd.PeriodDtype(col.dropna().iloc[0].freq))
+		elif kind != 'empty':
+			dtypes.add(np.dtype('datetime64[ns]'))
+	if len(dtypes) > 1:
+		return np.dtype('object')
+	return dtypes.pop() if dtypes else np.dtype('datetime64[ns]')
+
+def asDatetime(s):
+	"""Convert a pd.Series of dates to a datetime64 array. A pd.Period is taken as the last day of the period.
+
+	s: A Pandas Series holding dates, pd.Periods or strings.
+	Return: np.ndarray with datetime64[ns]; NaT for missing dates."""
+	if s.dtype == 'object' and pd.api.types.infer_dtype(s, skipna=True) == 'period':
+		try: s = s.astype(pd.PeriodDtype(s.dropna().iloc[0].freq))
+		except (TypeError, ValueError):
+			pass
+	if isinstance(s.dtype, pd.PeriodDtype):
+		s = s.dt.end_time.dt.normalize()
+	elif s.dtype == 'object':
+		s = s.map(lambda x: x.end_time.normalize() if isinstance(x, pd.Period) else x)
+	return pd.to_datetime(s).to_numpy(dtype='datetime64[ns]')
+
+
+
+def _subset(pheno, rows):
+	"""Return: Copy of pheno with only the rows at positions rows (a slice or array); other attributes are shared."""
+	out = copy.copy(pheno)
+	out.df = pheno.df.iloc[rows].copy() # A view would be written to by the conversions in _extract()
 	return out
 
+def _concat(frames):
+	"""pd.concat of frames with the same columns. A column without values in some frames takes the dtype the column has
+	in the others, so that the dtypes are those of a frame calculated in one piece rather than their common 'object'."""
+	frames = list(frames)
+	for col in frames[0].columns:
+		if len(dtypes := {frame[col].dtype for frame in frames if frame[col].notna().any()}) == 1:
+			dtype = dtypes.pop()
+			frames = [frame if frame[col].dtype == dtype else frame.astype({col: dtype}) for frame in frames]
+	return pd.concat(frames)
+
+def _prevalence_shard(pheno, baseline):
+	"""Worker for Prevalence._sharded(). Return: Prevalence of pheno at baseline; without pheno, which stays with the caller."""
+	out = Prevalence(pheno, baseline=baseline)
+	out._pheno = None
+	return out
 
 
 
@@ -72,8 +154,17 @@ class Eastwood():
 	UKBbaseline = pd.to_datetime("2010-08-01")
 	UKBioFields = ['41270', '41280']
 
-	def __init__(self, pheno, baseline=None, **kwargs):
-		"""Prevalence and Incidence based on the Eastwood2016 paper."""
+	CACHE_VERSION = 1 # Bump when dm changes, so that cached feature matrices are recalculated
+	HASHPRIME = np.uint64(0x100000001B3) # Mixes the column into the hash of a cell (see _rowhashes)
+
+	def __init__(self, pheno, baseline=None, cache=None, jobs=1, snapshot=None, **kwargs):
+		"""Prevalence and Incidence based on the Eastwood2016 paper.
+
+		cache: Directory for caching the feature matrix dm per input file and baseline (see atbaseline). Default: No caching.
+		jobs: Number of processes, each calculating a shard of the samples (see Prevalence._sharded). Default: 1.
+		snapshot: Directory holding dm per subject from an earlier run, eg. on the previous data release; only subjects
+		  with new or changed input are calculated (see Prevalence._fromsnapshot). Default: Calculate all subjects.
+		"""
 
 		# Start with some assessments. Do we have the data?
 		#	Remember that we may want to use this definition on other datasets; not just UKB.
@@ -83,6 +174,13 @@ class Eastwood():
 		for (k,v) in Eastwood.CategoriesDM.items():
 			setattr(self, k, v)
 		self.baseline = baseline
+		self.cache = cache
+		self.jobs = jobs
+		self.snapshot = snapshot
+		self._pheno = pheno
+		self._features = False
+		self._hashes = None
+		self._types = None
 		self.dm = pd.DataFrame(index=pheno.index, dtype='boolean')
 		self._incidence = pd.Series(
 		    [pd.NA] * pheno.index.size,
@@ -97,6 +195,28 @@ class Eastwood():
 		    name="Prevalence",
 		) # This guy is a frozen init; actual prevalence is returned through a property getter
 
+		if self.snapshot:
+			self._rowhashes(), self._inputtypes() # Before extracting the features, which converts some columns of pheno in place (dc13toDate)
+		self.atbaseline()
+
+		# Validation
+		Eastwood._validate(self)
+
+	def atbaseline(self, baseline=None):
+		"""Fill dm at baseline. Return: self"""
+		if baseline is not None:
+			self.baseline = baseline
+		self.features()
+		return self
+
+	def features(self):
+		"""Find the features which do not depend on the baseline. They are found once and shared by all baselines."""
+		if not self._features:
+			self._extract(self._pheno)
+			self._features = True
+
+	def _extract(self, pheno):
+		"""Fill dm with the features from pheno which do not depend on the baseline. Extended by descendants."""
 		# Needed for both Incidence and Prevalence
 		self.dm['date_t1dm_ip']    = datefirst(pheno.findinterpolated('41280', '41270', ['E10' + str(i) for i in range(10)]), axis='columns')
 		self.dm['date_t2dm_ip']    = datefirst(pheno.findinterpolated('41280', '41270', ['E11' + str(i) for i in range(10)]), axis='columns')
@@ -104,12 +224,86 @@ class Eastwood():
 		self.dm['date_unkdm_ip']   = datefirst(pheno.findinterpolated('41280', '41270', ['E14' + str(i) for i in range(10)]), axis='columns')
 		self.dm['date_anydm_ip']   = datefirst(self.dm[['date_t1dm_ip','date_t2dm_ip', 'date_otherdm_ip', 'date_unkdm_ip']], axis='columns')
 
-		# Validation
-		Eastwood._validate(self)
+	def _cachespec(self):
+		"""Return: The settings identifying dm in the cache besides the input file; None if dm cannot be cached."""
+		pheno = self._pheno
+		if not self.cache or pheno.source is None:
+			return None
+		rows = pd.util.hash_pandas_object(pd.Series(pheno.sex, index=pheno.index), index=True).to_numpy()
+		return {
+		    'eastwood': self.CACHE_VERSION,
+		    'columns':  pheno.field2cols(UKBioBank.plan(self.UKBioFields)),
+		    'rows':     hashlib.sha1(rows.tobytes()).hexdigest(),
+		    'baseline': str(self.baseline),
+		}
+
+	def _fromcache(self):
+		"""Load dm and the prevalence at self.baseline from the cache. Return: True if found in the cache."""
+		if (spec := self._cachespec()) is None or (store := SharedStore.find(self._pheno.source['name'], self.cache, **spec)) is None:
+			return False
+		frame = store.read()
+		self._prevalence = frame.pop("Prevalence").copy().set_axis(self.dm.index).rename("Prevalence")
+		self.dm = frame.copy().set_axis(self.dm.index)
+		logger.info(f"Loaded the feature matrix at baseline {self.baseline.date()} from the cache in '{store.path}'.")
+		return True
+
+	def _tocache(self):
+		"""Write dm and the prevalence at self.baseline to the cache and the snapshot."""
+		if (spec := self._cachespec()) is not None:
+			SharedStore.publish(self.dm.assign(Prevalence=self._prevalence), self._pheno.source['name'], self.cache, **spec)
+		self._tosnapshot()
+
+	def _tosnapshot(self):
+		"""Replace the snapshot at self.baseline with dm and the prevalence, unless it holds the same subjects and input."""
+		if (path := self._snapshotpath()) is None:
+			return
+		try: old = SharedStore(path).read()
+		except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+			old = None
+		if old is None or not old.index.equals(self.dm.index) or not np.array_equal(old['_input'].to_numpy(), self._rowhashes()):
+			SharedStore.write(self.dm.assign(Prevalence=self._prevalence, _input=self._rowhashes()), path, replace=True)
+
+	def _snapshotpath(self):
+		"""Return: Directory of the snapshot at self.baseline; None without a snapshot. Independent of the input file, but
+		not of how it was parsed (see _inputtypes)."""
+		if not self.snapshot:
+			return None
+		spec = {'eastwood': self.CACHE_VERSION, 'fields': self.UKBioFields, 'dtypes': self._inputtypes(), 'baseline': str(self.baseline)}
+		return pathlib.Path(self.snapshot) / SharedStore.key(None, **spec)
+
+	def _inputtypes(self):
+		"""Return: dict with the dtypes of the cells read by the algorithm per datafield, as parsed (eg. with or without
+		a data dictionary). Cells parsed differently hash differently (see _rowhashes), so these belong to the snapshot."""
+		if self._types is None:
+			pheno = self._pheno
+			types = dict()
+			for col in pheno.field2cols(UKBioBank.plan(self.UKBioFields)):
+				cell = Postings.cell(col)
+				types.setdefault(cell[0] if cell else col, set()).add(str(pheno.df[col].dtype))
+			self._types = {field: sorted(dtypes) for field, dtypes in types.items()}
+		return self._types
+
+	def _rowhashes(self):
+		"""Return: np.ndarray with a hash of the input of each subject; ie. sex and the cells read by the algorithm.
+
+		Missing cells do not count, nor do the order and naming style (eg. 'f.53.0.0' or '53-0.0') of the columns, so
+		the hash of a subject only changes with its data. Cells are hashed as parsed; a change of dtype counts as changed.
+		"""
+		if self._hashes is None:
+			pheno = self._pheno
+			out = pd.util.hash_pandas_object(pd.Series(pheno.sex, index=pheno.index), index=False).to_numpy()
+			for col in pheno.field2cols(UKBioBank.plan(self.UKBioFields)):
+				cell = Postings.cell(col)
+				seed = pd.util.hash_array(np.array(["{}-{}.{}".format(*cell) if cell else col], dtype=object))[0]
+				values = pd.util.hash_pandas_object(pheno.df[col], index=False).to_numpy()
+				out = out + np.where(pheno.df[col].notna().to_numpy(), (values ^ seed) * self.HASHPRIME, np.uint64(0)) # Wraps around
+			self._hashes = out
+		return self._hashes
 
 	def __getitem__(self, key):
-		"""Propagates index operations across the relevant attributes."""
-		out = copy.deepcopy(self)
+		"""Propagates index operations across the relevant attributes.
+		Only dm and _prevalence are subset; all other attributes are shared with self."""
+		out = copy.copy(self)
 		out.dm = self.dm.loc[key,]
 		out._prevalence = self._prevalence[key]
 		return out
@@ -150,25 +344,59 @@ class Prevalence(Eastwood):
 	binaryNegative = 0
 	binaryPositive = 1
 	binaryOther = pd.NA
+	# Values of the categories (by key in CategoriesDM) in the binary styles; all other categories are binaryOther
+	StyleValues = {
+	    't1d': {'T1Moderate': binaryPositive, 'T1High': binaryPositive, 'Negative': binaryNegative},
+	    't2d': {'T2Moderate': binaryPositive, 'T2High': binaryPositive, 'Negative': binaryNegative},
+	}
 
 	UKBstartdate = pd.to_datetime("2006-01-01")
-	UKBioFields = Eastwood.UKBioFields + ['53', '2443', '2976', '2986', '4041', '6153', '6177', '20002', '20003', '20008', '20009', '21000']
+	# Selectors for the UKB columns read by the algorithm; field, 'field-instance' or 'field-instance.array' (see UKBioBank.plan)
+	UKBioFields = Eastwood.UKBioFields + ['53', '2976-0', '2986', '4041', '6153', '6177', '20002', '20003', '20008', '20009', '21000']
 
 	DEBUGsubject = '1000863'
 
+	# Fig 2 (Flowcharts) as decision tables (see eastwood.rules). The steps are documented in prevalenceA/B/C().
+	#	Conditions on 'date_*_ip' diverge from Eastwood who does not consider in-patient data prior to the UKB baseline.
+	Flowcharts = {
+	    'A': {'entry': None, 'default': 'T2Moderate', 'steps': [
+	        ('1.1', ('no', ('any', 'gdmonly_sr', 'alldm_ni', 'gdm_ni', 't1dm_ni', 't2dm_ni', 'drug_ins_ni', 'drug_ins_sr', 'drug_metf_ni',
+	                        'drug_nonmetf_oad_ni', ('<=', 'date_anydm_ip', '{baseline}'))), 'Negative'),
+	        ('1.2', ('any', ('all', 'gdmonly_sr', ('no', ('any', 'anydmrx_ni_sr', 't1dm_ni', 't2dm_ni'))),
+	                        ('all', 'gdm_ni', ('<', 'agediag_gdm_ni', 50), ('no', ('any', 'anydmrx_ni_sr', 't1dm_ni', 't2dm_ni')))), 'GDModerate'),
+	        ('1.3', 'drug_nonmetf_oad_ni', 'T2Moderate'),
+	        ('1.4', ('any', ('>', 'agedm_ts_or_ni', 36), ('all', ('>=', 'agedm_ts_or_ni', 31), 'ethnic_sa_afc')), 'T2Moderate'),
+	        ('1.5', ('any', 'drug_ins_sr', 'drug_ins_ni', 'insat1yr', 't1dm_ni', ('<=', 'date_t1dm_ip', '{baseline}')), 'T1Moderate'),
+	    ]},
+	    'B': {'entry': 'T1Moderate', 'default': 'T1Moderate', 'steps': [
+	        ('2.1', ('any', 't1dm_ni', ('<=', 'date_t1dm_ip', '{baseline}')), 'T1High'),
+	        ('2.2', ('all', 'insat1yr', ('any', 'drug_ins_sr', 'drug_ins_ni')), 'T1High'),
+	    ]},
+	    'C': {'entry': 'T2Moderate', 'default': 'T2Moderate', 'steps': [
+	        ('3.1+3.2', ('all', 'drug_metf_ni', ('no', ('any', 'drug_ins_sr', 'drug_ins_ni', 'drug_nonmetf_oad_ni')),
+	                            ('no', 'anynsgt1t2_ni'), ('no', ('<=', 'date_anydm_ip', '{baseline}'))), 'Negative'),
+	        ('3.3', ('any', 'drug_nonmetf_oad_ni', ('<=', 'date_t2dm_ip', '{baseline}')), 'T2High'),
+	        ('3.4', ('no', ('any', 'drug_ins_sr', 'drug_ins_ni')), 'T2High'),
+	        ('3.5', 't1dm_ni', 'T1High'),
+	    ]},
+	}
+	Rules = Ruleset(Eastwood.CategoriesDM, Flowcharts, name="Prevalence")
+	Baseline = ('_baseline', 'dm', '_prevalence') # The state set by atbaseline(); restored after a sweep()
+
 	def __init__(self, pheno, *args, agediag=None, ethnicity=None, high=None, moderate=None, style='Eastwood', treatments=None, **kwargs):
 		"""Based on the Eastwood2016 paper.
 
 		The following refers to the prevalence algorithm only.
 		"""
-		super().__init__(pheno, *args, **kwargs)
 		self.style = style
+		super().__init__(pheno, *args, **kwargs)
 
-		instances = pd.Series(None, index=pheno.index, dtype='object')
-		df = pheno.findfield('53').astype('object')
-		for (i, s) in (df.astype("datetime64[ns]") <= self.baseline).iterrows():
-			instances[i] = df.columns[s].to_series().str.replace(r'f\d+_(\d+)_\d+', r'\1', regex=True).to_list()
-		logger.debug(f"Init: Identified instances = {instances.to_list()}")
+	def _extract(self, pheno):
+		"""Extends super() with the features of the prevalence algorithm which do not depend on the baseline."""
+		super()._extract(pheno)
+
+		# Assessment dates (field 53); the instances counted at a baseline are those assessed no later than baseline
+		self._assessments = pheno.findfield('53').astype('object').astype("datetime64[ns]")
 
 		# Fill dm with values - Main ethnic groups (NB: this makes some assumptions i.e. British is white, and does not include mixed, Chinese or other Asian)
 		self.dm.loc[pheno.findinfield('21000', ['1', '1001', '1002', '1003']), 'ethnic'] = 1 # White European
@@ -178,55 +406,187 @@ class Prevalence(Eastwood):
 		self.dm['ethnic_sa_afc'] = pd.Series([ethnic in [2, 3] for ethnic in self.dm['ethnic']], dtype='boolean') # SA and AFC vs all other variable
 		logger.info(f"Init: Ethnic breakdown = {dict(zip(['White European', 'South Asian', 'African Caribbean', 'Mixed or Other'], self.dm['ethnic'].value_counts().sort_index()))}.")
 
+		# Touchscreen, Nurse Interview and Medication. Searched once; the instances are selected per baseline in atbaseline()
+		Glitazones    = ['1141171646','1141171652','1141153254','1141177600','1141177606']
+		Meglitinides  = ['1141173882','1141173786','1141168660']
+		Sulfonylureas = ['1140874718','1140874744','1140874746','1141152590','1141156984','1140874646','1141157284','1140874652','1140874674','1140874728']
+		OtherOAD      = ['1140868902','1140868908','1140857508']
+		self._female = pheno.sex == 'female'
+		self._found = {
+		    'gdmonly_sr':          pheno.findininstances('4041','1'),
+		    'alldm_ni':            pheno.findininstances('20002','1220'),
+		    'gdm_ni':              pheno.findininstances('20002','1221'),
+		    't1dm_ni':             pheno.findininstances('20002','1222'),
+		    't2dm_ni':             pheno.findininstances('20002','1223'),
+		    'drug_ins_sr':         pheno.findininstances(['6153','6177'],'3'),
+		    'insat1yr':            pheno.findininstances('2986','1'),
+		    'drug_ins_ni':         pheno.findininstances('20003','1140883066'),
+		    'drug_metf_ni':        pheno.findininstances('20003',['1140884600','1140874686','1141189090']),
+		    'drug_nonmetf_oad_ni': pheno.findininstances('20003', Glitazones + Meglitinides + Sulfonylureas + OtherOAD),
+		}
+
+		# Age at Diagnosis from TS and NI; combined per baseline in atbaseline()
+		self._agediag = {
+		    'ts':       pheno.findfield('2976_0').mean(axis='columns'),                          # Touchscreen - gestational DM
+		    'alldm_ni': pheno.findinterpolated('20009','20002','1220').mean(axis='columns'), # Nurse interview - all DM
+		    't1dm_ni':  pheno.findinterpolated('20009','20002','1222').mean(axis='columns'), # Nurse interview - type 1 DM
+		    't2dm_ni':  pheno.findinterpolated('20009','20002','1223').mean(axis='columns'), # Nurse interview - type 2 DM
+		}
+		self.dm['agediag_gdm_ni'] = self._agediag['alldm_ni']                                       # Nurse interview - gestational DM
+
+		# Register the date of the first diagnosis
+		self.dm['date_anydm_ni'] = datefirst(pheno.dc13toDate('20008').findinterpolated('20008', '20002', '1220'), axis='columns')
+
+	def atbaseline(self, baseline=None):
+		"""Fill the baseline dependent columns of dm and (re)calculate the prevalence at baseline.
+
+		baseline: The new baseline. Default: Keep self.baseline.
+		Return: self
+
+		Features not depending on the baseline are found once (see features()) and shared by all baselines. With a
+		cache, dm and the prevalence are loaded from there if they were calculated for the same input and baseline
+		before; the features are then not extracted at all, and only the snapshot (if any) is brought up to date.
+		"""
+		if baseline is not None:
+			self.baseline = baseline
+		if self._fromcache():
+			self._tosnapshot()
+			return self
+		if not self._features and self._fromsnapshot():
+			return self
+		if self.jobs > 1 and not self._features:
+			return self._sharded()
+		self.features()
+
+		# Instances (participants x instances) with an assessment (field 53) no later than baseline
+		instances = self._assessments <= self.baseline
+		instances = instances.T.groupby(instances.columns.str.replace(r'^\D*\d+\D(\d+)\D.*$', r'\1', regex=True)).any().T
+		logger.debug(f"Init: Identified instances = {instances.sum().to_dict()}")
+		found = lambda name: UKBioBank.ininstances(*self._found[name], instances)
+
 		# Fill dm with values - Touchscreen
-		self.dm['gdmonly_sr'] = pkall(pd.concat([pheno.findinfield('4041','1',instances), pheno.sex == 'female'], axis='columns'), axis='columns')
+		self.dm['gdmonly_sr'] = kleene.series(kleene.and_(found('gdmonly_sr'), self._female), index=self.dm.index)
 		logger.info(f"Init: {self.dm['gdmonly_sr'].sum()} subjects with Gestational Diabetes from Touchscreen.")
 
 		# Fill dm with values - Nurse Interview
-		self.dm['alldm_ni'] = pheno.findinfield('20002','1220',instances)
+		self.dm['alldm_ni'] = found('alldm_ni')
 		logger.info(f"Init: {self.dm['alldm_ni'].sum()} Subjects with any type DM from Nurse Interview.")
-		self.dm['gdm_ni'] = pkall(pd.concat([pheno.findinfield('20002','1221',instances), pheno.sex == 'female'], axis='columns'), axis='columns')
+		self.dm['gdm_ni'] = kleene.series(kleene.and_(found('gdm_ni'), self._female), index=self.dm.index)
 		logger.info(f"Init: {self.dm['gdm_ni'].sum()} Subjects with Gestational DM from Nurse Interview.")
-		self.dm['t1dm_ni'] = pheno.findinfield('20002','1222',instances)
+		self.dm['t1dm_ni'] = found('t1dm_ni')
 		logger.info(f"Init: {self.dm['t1dm_ni'].sum()} Subjects with Type 1 DM from Nurse Interview.")
-		self.dm['t2dm_ni'] = pheno.findinfield('20002','1223',instances)
+		self.dm['t2dm_ni'] = found('t2dm_ni')
 		logger.info(f"Init: {self.dm['t2dm_ni'].sum()} Subjects with Type 2 DM from Nurse Interview.")
 		self.dm['anynsgt1t2_ni'] = pd.Series(self.dm[['alldm_ni', 'gdm_ni', 't1dm_ni', 't2dm_ni']].any(axis='columns'), dtype='boolean')
 		logger.info(f"Init: {self.dm['t2dm_ni'].sum()} Subjects with any DM from Nurse Interview.")
 
 		# Fill dm with values - Medication
-		self.dm['drug_ins_sr'] = pheno.findinfield(['6153','6177'],'3',instances)
+		self.dm['drug_ins_sr'] = found('drug_ins_sr')
 		logger.info(f"Init: {self.dm['drug_ins_sr'].sum()} Subjects with Insulin, Medication from Touchscreen.")
-		self.dm['insat1yr'] = pheno.findinfield('2986','1',instances)
+		self.dm['insat1yr'] = found('insat1yr')
 		logger.info(f"Init: {self.dm['insat1yr'].sum()} subjects with Insulin started within 1 yr of diagnosis from Touchscreen.")
-		self.dm['drug_ins_ni'] = pheno.findinfield('20003','1140883066',instances)
+		self.dm['drug_ins_ni'] = found('drug_ins_ni')
 		logger.info(f"Init: {self.dm['drug_ins_ni'].sum()} Subjects with Insulin Product, Medication from Nurse Interview.")
-		self.dm['drug_metf_ni'] = pheno.findinfield('20003',['1140884600','1140874686','1141189090'],instances)
+		self.dm['drug_metf_ni'] = found('drug_metf_ni')
 		logger.info(f"Init: {self.dm['drug_metf_ni'].sum()} Subjects with Metformin, Medication from Nurse Interview.")
-
-		Glitazones    = ['1141171646','1141171652','1141153254','1141177600','1141177606']
-		Meglitinides  = ['1141173882','1141173786','1141168660']
-		Sulfonylureas = ['1140874718','1140874744','1140874746','1141152590','1141156984','1140874646','1141157284','1140874652','1140874674','1140874728']
-		OtherOAD      = ['1140868902','1140868908','1140857508']
-		self.dm['drug_nonmetf_oad_ni'] = pheno.findinfield('20003', Glitazones + Meglitinides + Sulfonylureas + OtherOAD, instances)
+		self.dm['drug_nonmetf_oad_ni'] = found('drug_nonmetf_oad_ni')
 		logger.info(f"Init: {self.dm['drug_nonmetf_oad_ni'].sum()} Subjects with Non-metformin oral anti-diabetic drug, Medication from Nurse Interview.")
 
 		# Age at Diagnosis combined from TS and NI (Remember: .loc[] enforces index/column names so this works as intended)
-		self.dm['agedm_ts_or_ni'] = pheno.findfield('2976_0').mean(axis='columns')                                               # Touchscreen - gestational DM
-		self.dm['agediag_gdm_ni'] = pheno.findinterpolated('20009','20002','1220').mean(axis='columns')                          # Nurse interview - gestational DM
-		self.dm.loc[self.dm['alldm_ni'], 'agedm_ts_or_ni'] = pheno.findinterpolated('20009','20002','1220').mean(axis='columns') # Nurse interview - all DM
-		self.dm.loc[self.dm['gdm_ni'],   'agedm_ts_or_ni'] = self.dm.loc[self.dm['gdm_ni'], 'agediag_gdm_ni']                    # Nurse interview - gestational DM
-		self.dm.loc[self.dm['t1dm_ni'],  'agedm_ts_or_ni'] = pheno.findinterpolated('20009','20002','1222').mean(axis='columns') # Nurse interview - type 1 DM
-		self.dm.loc[self.dm['t2dm_ni'],  'agedm_ts_or_ni'] = pheno.findinterpolated('20009','20002','1223').mean(axis='columns') # Nurse interview - type 2 DM
+		self.dm['agedm_ts_or_ni'] = self._agediag['ts'].copy()                                            # Touchscreen - gestational DM
+		self.dm.loc[self.dm['alldm_ni'], 'agedm_ts_or_ni'] = self._agediag['alldm_ni']                     # Nurse interview - all DM
+		self.dm.loc[self.dm['gdm_ni'],   'agedm_ts_or_ni'] = self.dm.loc[self.dm['gdm_ni'], 'agediag_gdm_ni'] # Nurse interview - gestational DM
+		self.dm.loc[self.dm['t1dm_ni'],  'agedm_ts_or_ni'] = self._agediag['t1dm_ni']                      # Nurse interview - type 1 DM
+		self.dm.loc[self.dm['t2dm_ni'],  'agedm_ts_or_ni'] = self._agediag['t2dm_ni']                      # Nurse interview - type 2 DM
 		logger.info(f"Init: {sum(self.dm['agedm_ts_or_ni'] > 0)} subjects with age at diagnosis.")
 
-		# Register the date of the first diagnosis
-		self.dm['date_anydm_ni'] = datefirst(pheno.dc13toDate('20008').findinterpolated('20008', '20002', '1220'), axis='columns')
+		# Calculate the prevalence; flowcharts A, B and C in one pass
+		self.dm['anydmrx_ni_sr'] = self.dm[['drug_ins_ni', 'drug_metf_ni', 'drug_nonmetf_oad_ni', 'drug_ins_sr']].any(axis='columns')
+		self.prevalence = self.Rules(self.dm, start=self._prevalence, name="Prevalence", baseline=self.baseline)
+		self._tocache()
+		return self
 
-		# Precalculate the prevalence
-		self.prevalence = self.prevalenceA()
-		self.prevalence = self[self._prevalence == self.T1Moderate].prevalenceB()
-		self.prevalence = self[self._prevalence == self.T2Moderate].prevalenceC()
+	def _sharded(self):
+		"""Calculate dm and the prevalence at self.baseline on self.jobs shards of the samples in a pool of processes.
+
+		The shards are consecutive blocks of rows, and every step of the algorithm only looks at the row of a subject, so
+		joining the shards in order gives the same dm and prevalence as the serial calculation. The features of the
+		shards are joined as well, so later baselines are calculated in this process without extracting them again.
+		Return: self
+		"""
+		bounds = np.linspace(0, self._pheno.index.size, self.jobs + 1, dtype=int)
+		shards = [_subset(self._pheno, slice(start, stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+		logger.info(f"Init: Calculating the prevalence at baseline {self.baseline.date()} in {len(shards)} shards of {np.diff(bounds).max()} subjects or less.")
+		with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as executor:
+			parts = list(executor.map(_prevalence_shard, shards, [self.baseline] * len(shards)))
+
+		self.dm = _concat(part.dm for part in parts)
+		self._prevalence = pd.concat([part._prevalence for part in parts])
+		self._assessments = pd.concat([part._assessments for part in parts])
+		self._female = pd.concat([part._female for part in parts])
+		self._agediag = {name: pd.concat([part._agediag[name] for part in parts]) for name in parts[0]._agediag}
+		self._found = {name: (np.concatenate([part._found[name][0] for part in parts]),
+		                      pd.concat([part._found[name][1] for part in parts]).fillna(False).astype(bool))
+		               for name in parts[0]._found}
+		self._features = True
+		self._tocache()
+		return self
+
+	def _fromsnapshot(self):
+		"""Update dm and the prevalence at self.baseline from the snapshot of an earlier run, eg. on the previous release.
+
+		Subjects whose input (see _rowhashes) is unchanged are copied from the snapshot; only new and changed subjects
+		are calculated. Every step of the algorithm only looks at the row of a subject, so the result is the same as
+		when calculating all subjects. Subjects no longer in the input are dropped. The snapshot is then replaced.
+		Return: True if the snapshot was used.
+		"""
+		if (path := self._snapshotpath()) is None:
+			return False
+		try: frame = SharedStore(path).read()
+		except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+			return False
+		pos = frame.index.get_indexer(self.dm.index)
+		reuse = (pos >= 0) & (frame['_input'].to_numpy()[pos] == self._rowhashes()) if frame.index.size else np.zeros(pos.size, dtype=bool)
+		if not reuse.any():
+			return False
+		changed = np.flatnonzero(~reuse)
+		parts = [frame.drop(columns='_input').iloc[pos[reuse]]]
+		if changed.size:
+			part = Prevalence(_subset(self._pheno, changed), baseline=self.baseline, jobs=self.jobs)
+			parts.append(part.dm.assign(Prevalence=part._prevalence))
+		order = np.argsort(np.concatenate([np.flatnonzero(reuse), changed]))
+		frame = _concat(parts).iloc[order].set_axis(self.dm.index)
+		self._prevalence = frame.pop("Prevalence").rename("Prevalence")
+		self.dm = frame
+		logger.info(f"Loaded {reuse.sum()} unchanged subjects at baseline {self.baseline.date()} from the snapshot in '{path}'; calculated {changed.size} new or changed subjects.")
+		self._tocache()
+		return True
+
+	def sweep(self, baselines, styles=None):
+		"""Calculate the prevalence at each of several baselines in one pass over the data.
+
+		baselines: The baseline dates.
+		styles: The output styles (see styled). Default: The current style.
+		Return: pd.DataFrame with the prevalence at each baseline; one column per baseline, or with styles, one column
+		  per (baseline, style).
+
+		Only the assessment instances and the flowcharts are evaluated per baseline. Afterwards self is restored to the
+		baseline, dm and prevalence it had before the sweep (see Baseline); only the features found on the way are kept.
+		"""
+		state = {name: copy.copy(self.__dict__[name]) for name in self.Baseline}
+		out = dict()
+		try:
+			for baseline in baselines:
+				if baseline != self.baseline:
+					self.atbaseline(baseline)
+				if styles is None:
+					out[baseline] = self.prevalence.copy()
+				else:
+					out.update({(baseline, style): col for style, col in self.styled(styles).items()})
+		finally:
+			self.__dict__.update(state)
+			self._styled = None
+		return pd.DataFrame(out, index=self.dm.index)
 
 	@Eastwood.baseline.setter
 	def baseline(self, value):
@@ -238,40 +598,57 @@ class Prevalence(Eastwood):
 
 	@property
 	def prevalence(self):
-		"""Implements prevalence algorithm from Eastwood2016 paper (See Fig 2 in paper)."""
-		out = self._prevalence
-		if self.styletr is not None:
-			logger.info(f"Converting output to style: {self.style}")
-			out = pd.Series(out.apply(self.styletr), dtype='category')
-		return out
+		"""Implements prevalence algorithm from Eastwood2016 paper (See Fig 2 in paper). Return: pd.Series in self.style."""
+		return self._styledprevalence(self.style)
 
 	@prevalence.setter
 	def prevalence(self, value):
 		"""Setter used to calculate the prevalence."""
 		if hasattr(value, 'index'):
 			self._prevalence[value.index] = value
+			self._styled = None
 		else:
 			logger.error(f"Oops! You set prevalence to something fishy...")
 
+	def styled(self, styles=None):
+		"""The prevalence in each of styles. Return: pd.DataFrame with one column per style (in lower case).
+
+		styles: Any of self.styles. Default: self.style.
+		"""
+		styles = [self.style] if styles is None else list(dict.fromkeys(style.lower() for style in styles))
+		return pd.DataFrame({style: self._styledprevalence(style) for style in styles}, index=self._prevalence.index)
+
+	def _styledprevalence(self, style):
+		"""Return: The prevalence in style as pd.Series with dtype 'category'.
+
+		Styles are translated by a lookup on the category codes and kept until the prevalence changes (like
+		UKBioBank.valueindex); repeated calls are free.
+		"""
+		if style == 'eastwood':
+			return self._prevalence
+		if getattr(self, '_styled', None) is None or self._styled[0] is not self._prevalence:
+			self._styled = (self._prevalence, dict())
+		if style not in self._styled[1]:
+			logger.info(f"Converting output to style: {style}")
+			values = self.StyleValues[style]
+			keys = {label: key for key, label in Eastwood.CategoriesDM.items()}
+			outcats = [self.binaryNegative, self.binaryPositive]
+			lookup = [outcats.index(values[keys[label]]) if keys.get(label) in values else -1 for label in self._prevalence.cat.categories]
+			codes = np.array(lookup + [-1], dtype='int8')[self._prevalence.cat.codes.to_numpy()] # Code -1 (missing) picks the last
+			self._styled[1][style] = pd.Series(pd.Categorical.from_codes(codes, categories=outcats), index=self._prevalence.index, name=self._prevalence.name)
+		return self._styled[1][style]
+
 	@property
 	def style(self):
 		"""Return: self._style. Needed for setter."""
 		return self._style
 
-# Don't much like setting the translator here, but it's meaningless to change the style without changing the translator
-#	The clean way would be to make a style class. A thought for future update?
 	@style.setter
 	def style(self, value):
-		"""Assert value and set it to self._style if valid."""
+		"""Assert value and set it to self._style if valid. The translation itself is done by _styledprevalence()."""
 		value = value.lower()
 		assert value in [s.lower() for s in self.styles], f"Given style {value} is unknown. Supported styles include {self.styles}"
 		self._style = value
-		if self.style == 'eastwood':
-			self.styletr = None
-		elif self.style == 't1d':
-			self.styletr = lambda x: self.binaryPositive if x in [self.T1Moderate, self.T1High] else (self.binaryNegative if x in [self.Negative] else self.binaryOther)
-		elif self.style == 't2d':
-			self.styletr = lambda x: self.binaryPositive if x in [self.T2Moderate, self.T2High] else (self.binaryNegative if x in [self.Negative] else self.binaryOther)
 
 	def datediag(self):
 		"""Report the date when the 'prevalent disease' was diagnosed. Returns pd.Series."""
@@ -341,69 +718,7 @@ class Prevalence(Eastwood):
 		specifying this diagnosis at NI overall 0.09% (428/502,665), we sought other evidence of type 1
 		diabetes in addition. NB: there was no option to specify diabetes type on TS self-report.
 		"""
-
-		prevalence = self._prevalence[self.dm.index]
-		subjects_left = pd.Series(True, index=self.dm.index, dtype='boolean')
-		logger.info(f"Prevalence Algorithm A Starting: Analysing {subjects_left.sum()} subjects.")
-
-		# Fig 2 (Flowchart): 1.1
-		x = self.dm[['gdmonly_sr', 'alldm_ni', 'gdm_ni', 't1dm_ni', 't2dm_ni', 'drug_ins_ni', 'drug_ins_sr', 'drug_metf_ni', 'drug_nonmetf_oad_ni']].any(axis='columns')
-		# Next line diverges from Eastwood who does not consider in-patient data prior to the UKB baseline
-		x = pd.concat([x, self.dm['date_anydm_ip'] <= self.baseline], axis='columns').any(axis='columns')
-		prevalence[x != True] = self.Negative
-		subjects_left[x != True] = False
-		logger.info(f"   Prevalence 1.1: {sum(x != True)} subjects assigned '{self.Negative}'; {subjects_left.sum()} subjects remaining.")
-#		logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-
-		# Fig 2 (Flowchart): 1.2
-		self.dm['anydmrx_ni_sr'] = self.dm[['drug_ins_ni', 'drug_metf_ni', 'drug_nonmetf_oad_ni', 'drug_ins_sr']].any(axis='columns')
-
-		x = pd.DataFrame({1: pkall(pd.DataFrame({1: self.dm['gdmonly_sr'],
-                                                         2: self.dm[['anydmrx_ni_sr', 't1dm_ni', 't2dm_ni']].any(axis='columns') != True}),
-		                           axis='columns'),
-		                  2: pkall(pd.DataFrame({1: self.dm['gdm_ni'],
-                                                         2: self.dm['agediag_gdm_ni'] < 50,
-		                                         3: self.dm[['anydmrx_ni_sr', 't1dm_ni', 't2dm_ni']].any(axis='columns') != True}),
-		                           axis='columns')
-		    }).any(axis='columns')
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		prevalence[x] = self.GDModerate
-		subjects_left[x] = False
-		logger.info(f"   Prevalence 1.2: {x.sum()} subjects asigned '{self.GDModerate}'; {subjects_left.sum()} subjects remaining.")
-#		logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-
-		# Fig 2 (Flowchart): 1.3
-		x = self.dm['drug_nonmetf_oad_ni']
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		prevalence[x] = self.T2Moderate
-		subjects_left[x] = False
-		logger.info(f"   Prevalence 1.3: {x.sum()} subjects asigned '{self.T2Moderate}'; {subjects_left.sum()} subjects remaining.")
-#		logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-
-		# Fig 2 (Flowchart): 1.4
-		x = pd.concat([
-		        self.dm['agedm_ts_or_ni'] > 36,
-		        pkall(pd.concat([self.dm['agedm_ts_or_ni'] >= 31 , self.dm['ethnic_sa_afc']], axis='columns'), axis='columns'),
-		    ], axis='columns').any(axis='columns')
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		prevalence[x] = self.T2Moderate
-		subjects_left[x] = False
-		logger.info(f"   Prevalence 1.4: {x.sum()} subjects asigned '{self.T2Moderate }'; {subjects_left.sum()} subjects remaining.")
-#		logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-
-		# Fig 2 (Flowchart): 1.5
-		x = self.dm[['drug_ins_sr', 'drug_ins_ni', 'insat1yr', 't1dm_ni']].any(axis='columns')
-		# Next line diverges from Eastwood who does not consider in-patient data prior to the UKB baseline
-		x = pd.concat([x, self.dm['date_t1dm_ip'] <= self.baseline], axis='columns').any(axis='columns')
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		subjects_left[x] = False
-		prevalence.loc[subjects_left != False] = self.T2Moderate
-		logger.info(f"   Prevalence 1.5: {sum(subjects_left != False)} subjects asigned '{self.T2Moderate}'; {x.sum()} subjects remaining.")
-#		logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		prevalence[x] = self.T1Moderate
-		logger.info(f"Prevalence Algorithm A finished: Remaining {x.sum()} subjects asigned '{self.T1Moderate}'.")
-
-		return prevalence[self.dm.index]
+		return self.Rules(self.dm, start=self._prevalence[self.dm.index], charts=['A'], name="Prevalence", baseline=self.baseline)
 
 	def prevalenceB(self):
 		"""Prevalence algorithm B. Classify type 1 diabetes into probable or possible.
@@ -423,35 +738,7 @@ class Prevalence(Eastwood):
 		reported current insulin use to the nurse.  Metformin use was reported in some of those with "possible"
 		versus those with "probable" type 1 diabetes.
 		"""
-		prevalence = self._prevalence[self.dm.index]
-		subjects_left = pd.Series(True, index=self.dm.index, dtype='boolean')
-		logger.info(f"Prevalence Algorithm B Starting: Analysing {subjects_left.sum()} subjects.")
-
-		# Fig 2 (Flowchart): 2.1
-		x = self.dm['t1dm_ni']
-		# Next line diverges from Eastwood who does not consider in-patient data prior to the UKB baseline
-		x = pd.concat([x, self.dm['date_t1dm_ip'] <= self.baseline], axis='columns').any(axis='columns')
-		prevalence[x] = self.T1High
-		subjects_left[x] = False
-		logger.info(f"   Prevalence 2.1: {x.sum()} subjects asigned '{self.T1High}'; {sum(subjects_left != False)} subjects remaining.")
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm B.")
-
-		# Fig 2 (Flowchart): 2.2
-		x = pkall(pd.concat([self.dm['insat1yr'], self.dm[['drug_ins_sr', 'drug_ins_ni']].any(axis='columns')], axis='columns'), axis='columns')
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		prevalence[x] = self.T1High
-		subjects_left[x] = False
-
-		logger.info(f"   Prevalence 2.2: {x.sum()} subjects asigned '{self.T1High}'; {subjects_left.sum()} subjects remaining.")
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm B.")
-
-		prevalence[subjects_left] = self.T1Moderate
-		logger.info(f"Prevalence Algorithm B finished: Remaining {subjects_left.sum()} subjects asigned '{self.T1Moderate}'.")
-		return prevalence[self.dm.index]
+		return self.Rules(self.dm, start=self._prevalence[self.dm.index], charts=['B'], name="Prevalence", baseline=self.baseline)
 
 	def prevalenceC(self):
 		"""Prevalence algorithm C. Classify type 2 diabetes into probable or possible.
@@ -500,66 +787,7 @@ class Prevalence(Eastwood):
 		this stage as insulin use and relatively high rates of commencement of insulin within a year of
 		diagnosis (39%, n=1197/3040) cast doubt over a type 2 diagnosis.
 		"""
-		prevalence = self._prevalence[self.dm.index]
-		subjects_left = pd.Series(True, index=self.dm.index, dtype='boolean')
-		logger.info(f"Prevalence Algorithm C Starting: Analysing {subjects_left.sum()} subjects.")
-
-		# Fig 2 (Flowchart): 3.1
-		x = pkall(pd.concat([self.dm['drug_metf_ni'],
-		                     self.dm[['drug_ins_sr', 'drug_ins_ni', 'drug_nonmetf_oad_ni']].any(axis='columns') != True], axis='columns'),
-		          axis='columns')
-		logger.info(f"   Prevalence 3.1: {x.sum()} subjects directed to 3.2; {x.size - x.sum()} subjects directed to 3.3.")
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm C.")
-
-		# Fig 2 (Flowchart): 3.2
-		y = pkall(pd.concat([x, self.dm['anynsgt1t2_ni'] != True], axis='columns'), axis='columns')
-		# Next line diverges from Eastwood who does not consider in-patient data prior to the UKB baseline
-		y[self.dm['date_anydm_ip'] <= self.baseline] = False
-		prevalence[y] = self.Negative
-		logger.info(f"   Prevalence 3.2: {y.sum()} subjects asigned '{self.Negative}'; remaining {x.sum() - y.sum()} subjects directed to 3.3.")
-		subjects_left[y] = False
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm C.")
-
-		# Fig 2 (Flowchart): 3.3
-		x = self.dm['drug_nonmetf_oad_ni']
-		# Next line diverges from Eastwood who does not consider in-patient data prior to the UKB baseline
-		x = pd.concat([x, self.dm['date_t2dm_ip'] <= self.baseline], axis='columns').any(axis='columns')
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		prevalence[x] = self.T2High
-		subjects_left[x] = False
-		logger.info(f"   Prevalence 3.3: {x.sum()} subjects asigned '{self.T2High}'; {subjects_left.sum()} subjects remaining.")
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm C.")
-
-		# Fig 2 (Flowchart): 3.4
-		x = self.dm[['drug_ins_sr', 'drug_ins_ni']].any(axis='columns') != True
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		prevalence[x] = self.T2High
-		subjects_left[x] = False
-		logger.info(f"   Prevalence 3.4: {x.sum()} subjects asigned '{self.T2High}'; {subjects_left.sum()} subjects remaining.")
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm C.")
-
-		# Fig 2 (Flowchart): 3.5
-		x = self.dm['t1dm_ni']
-		x = pkall(pd.concat([x, subjects_left], axis='columns'), axis='columns')
-		subjects_left[x] = False
-		prevalence[subjects_left] = self.T2Moderate
-
-		logger.info(f"   Prevalence 3.5: {subjects_left.sum()} subjects asigned '{self.T2Moderate}'; {x.sum()} subjects remaining.")
-		try: logger.debug(f"     Testsubject: {self.DEBUGsubject} = '{prevalence[self.DEBUGsubject]}'")
-		except KeyError:
-			logger.debug(f"     Testsubject: '{self.DEBUGsubject}' not in Algorithm C.")
-
-		prevalence[x] = self.T1High
-		logger.info(f"Prevalence Algorithm C Finished: Remaining {x.sum()} subjects asigned '{self.T1High}'.")
-		return prevalence[self.dm.index]
+		return self.Rules(self.dm, start=self._prevalence[self.dm.index], charts=['C'], name="Prevalence", baseline=self.baseline)
 
 	def to_incidence(self, *args, **kwargs):
 		"""Convert to Incidence class (with equal args, like baseline)."""
@@ -579,12 +807,26 @@ class Incidence(Prevalence):
 	# UKB End date
 	UKBenddate = pd.Timestamp.max
 
+	# Outcomes and their in-patient diagnosis dates in dm
+	Outcomes = {'anydm': 'date_anydm_ip', 't1dm': 'date_t1dm_ip', 't2dm': 'date_t2dm_ip'}
+
+	# Attributes copied from the Prevalence in Incidence(prev=...). The features (eg. _assessments and the Series in
+	# _found and _agediag) are shared; they are never modified after extraction, only replaced.
+	Copied = ('dm', '_prevalence', '_incidence', '_found', '_agediag')
+
 	def __init__(self, *args, enddate=None, interval=None, prev=None, **kwargs):
-		"""Init the Incidence object."""
+		"""Init the Incidence object.
+
+		prev: A Prevalence object to start from instead of a phenotype. Its features are shared (see Copied) and its dm
+		  and prevalence are copied, so prev is left as is.
+		"""
 		if prev is None:
 			super().__init__(*args, **kwargs)
 		else:
-			self = copy.deepcopy(prev)
+			self.__dict__.update(prev.__dict__)
+			self.__dict__.update({name: copy.copy(prev.__dict__[name]) for name in self.Copied if name in prev.__dict__})
+			self._styled = None
+			self.baseline = prev.baseline
 		self.enddate = enddate
 		self.interval = interval
 		self.dm['prevalent'] = self._prevalence.isin([self.T1High, self.T2High])
@@ -625,7 +867,7 @@ class Incidence(Prevalence):
 	def anydm(self):
 		"""Incidence of Type-1 + Type-2 + Unspecified Diabetes Mellitus."""
 		incidence = self._incidence[self.dm.index]
-		x = pkall(pd.concat([~self.dm['prevalent'], self.dm['date_anydm_ip'] > self.baseline, self.dm['date_anydm_ip'] < self.enddate], axis='columns'), axis='columns')
+		x = kleene.mask(kleene.all([~self.dm['prevalent'], self.dm['date_anydm_ip'] > self.baseline, self.dm['date_anydm_ip'] < self.enddate]))
 		incidence[x] = self.dm.loc[x, 'date_anydm_ip']
 		logger.info(f"Incidence Any DM: {x.sum()} subjects with Any Diabets diagnosis data.")
 		if self.interval:
@@ -636,7 +878,7 @@ class Incidence(Prevalence):
 	def t1dm(self):
 		"""Incidence of Type-1 Diabetes Mellitus."""
 		incidence = self._incidence[self.dm.index]
-		x = pkall(pd.concat([~self.dm['prevalent'], self.dm['date_t1dm_ip'] > self.baseline, self.dm['date_t1dm_ip'] < self.enddate], axis='columns'), axis='columns')
+		x = kleene.mask(kleene.all([~self.dm['prevalent'], self.dm['date_t1dm_ip'] > self.baseline, self.dm['date_t1dm_ip'] < self.enddate]))
 		incidence[x] = self.dm.loc[x, 'date_t1dm_ip']
 		logger.info(f"Incidence Type-1 DM: {x.sum()} subjects with Type-1 DM diagnosis data.")
 		if self.interval:
@@ -647,13 +889,39 @@ class Incidence(Prevalence):
 	def t2dm(self):
 		"""Incidence of Type-2 Diabetes Mellitus."""
 		incidence = self._incidence[self.dm.index]
-		x = pkall(pd.concat([~self.dm['prevalent'], self.dm['date_t2dm_ip'] > self.baseline, self.dm['date_t2dm_ip'] < self.enddate], axis='columns'), axis='columns')
+		x = kleene.mask(kleene.all([~self.dm['prevalent'], self.dm['date_t2dm_ip'] > self.baseline, self.dm['date_t2dm_ip'] < self.enddate]))
 		incidence[x] = self.dm.loc[x, 'date_t2dm_ip']
 		logger.info(f"Incidence Type-2 DM: {x.sum()} subjects with Type-2 DM diagnosis data.")
 		if self.interval:
 			incidence = (incidence - self.baseline).floordiv(self.interval) + 1
 		return incidence[self.dm.index]
 
+	def survival(self, enddates=None):
+		"""Incidence as time-to-event and event indicator of each outcome (see Outcomes), censored at each of enddates.
+
+		enddates: The dates of censoring. Default: [self.enddate]
+		Return: pd.DataFrame with columns '<outcome>_time' and '<outcome>_event' per outcome, named
+		  '<outcome>_<enddate>_time' and '<outcome>_<enddate>_event' with several enddates. Time is from baseline to
+		  the diagnosis or to the censoring at enddate, counted in units of self.interval (default: days). Subjects
+		  with prevalent DM or diagnosed no later than baseline are not at risk and NA.
+		"""
+		enddates = [self.enddate] if enddates is None else list(enddates)
+		dates = self.dm[list(self.Outcomes.values())].apply(asDatetime).to_numpy(dtype='datetime64[ns]')[:, :, None]
+		stops = np.array([pd.Timestamp(enddate).to_datetime64() for enddate in enddates], dtype='datetime64[ns]')[None, None, :]
+		baseline = np.datetime64(pd.Timestamp(self.baseline), 'ns')
+		atrisk = ~(dates <= baseline) & ~self.dm['prevalent'].to_numpy(dtype=bool, na_value=False)[:, None, None]
+		event = atrisk & (dates > baseline) & (dates < stops)
+		time = (np.where(event, dates, stops) - baseline) / (self.interval or pd.Timedelta(days=1)).to_timedelta64()
+		time[~np.broadcast_to(atrisk, time.shape)] = np.nan
+		out = dict()
+		for i, outcome in enumerate(self.Outcomes):
+			for j, enddate in enumerate(enddates):
+				name = outcome if len(enddates) == 1 else f"{outcome}_{pd.Timestamp(enddate).date()}"
+				out[name + '_time'] = time[:, i, j]
+				out[name + '_event'] = pd.array(np.where(atrisk[:, i, 0], event[:, i, j], pd.NA), dtype='Int8')
+			logger.info(f"Survival {outcome}: {event[:, i, :].sum(axis=0).tolist()} events among {atrisk[:, i, 0].sum()} subjects at risk.")
+		return pd.DataFrame(out, index=self.dm.index)
+
 	def to_incidence(self, *args, **kwargs):
 		"""Dummy converter."""
 		return self
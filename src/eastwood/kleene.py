@@ -0,0 +1,84 @@
+
+
+###########################################################
+#
+# --%%  Setup and Initialize  %%--
+
+import numpy as np
+import pandas as pd
+import sys
+
+assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
+
+# Three-valued (Kleene) logic on pairs of numpy arrays with bools: (value, known).
+#	A truth value is True, False or unknown (NA). 'known' is False where the truth value is unknown; 'value' is then
+#	False as well. Operands may be given as pairs, pd.Series (NA is unknown) or np.ndarrays/lists of bools.
+#
+#	and:  False if any operand is False; otherwise unknown if any operand is unknown; otherwise True.
+#	or:   True if any operand is True; otherwise unknown if any operand is unknown; otherwise False.
+#	not:  Unknown stays unknown.
+
+def kleene(obj):
+	"""Return: obj as a (value, known) pair of np.ndarrays with bools."""
+	if isinstance(obj, tuple):
+		return obj
+	if isinstance(obj, pd.Series):
+		known = obj.notna().to_numpy()
+		return obj.to_numpy(dtype=bool, na_value=False) & known, known
+	value = np.asarray(obj, dtype=bool)
+	return value, np.ones(value.shape, dtype=bool)
+
+def operands(objs):
+	"""Return: Generator of pairs from objs; a pd.DataFrame (one operand per column) or an iterable of operands."""
+	objs = (col for _, col in objs.items()) if isinstance(objs, pd.DataFrame) else objs
+	return (kleene(obj) for obj in objs)
+
+def all(objs):
+	"""Kleene AND across objs (see operands()). Return: (value, known) pair."""
+	false, unknown = None, None
+	for value, known in operands(objs):
+		if false is None:
+			false, unknown = known & ~value, ~known
+		else:
+			false |= known & ~value
+			unknown |= ~known
+	if false is None:
+		raise ValueError("Kleene all() requires at least one operand.")
+	known = false | ~unknown
+	return ~false & known, known
+
+def any(objs):
+	"""Kleene OR across objs (see operands()). Return: (value, known) pair."""
+	true, unknown = None, None
+	for value, known in operands(objs):
+		if true is None:
+			true, unknown = value & known, ~known
+		else:
+			true |= value & known
+			unknown |= ~known
+	if true is None:
+		raise ValueError("Kleene any() requires at least one operand.")
+	return true, true | ~unknown
+
+def and_(a, b):
+	"""Return: Kleene a AND b as a (value, known) pair."""
+	return all([a, b])
+
+def or_(a, b):
+	"""Return: Kleene a OR b as a (value, known) pair."""
+	return any([a, b])
+
+def not_(a):
+	"""Return: Kleene NOT a as a (value, known) pair."""
+	value, known = kleene(a)
+	return ~value & known, known
+
+def mask(a):
+	"""Return: np.ndarray with bools; True where a is True (ie. unknown counts as not True). Use for selections."""
+	value, known = kleene(a)
+	return value & known
+
+def series(a, index=None, name=None):
+	"""Return: a as a pd.Series with dtype 'boolean' and NA where unknown."""
+	value, known = kleene(a)
+	return pd.Series(pd.arrays.BooleanArray(value, ~known), index=index, name=name)
@@ -0,0 +1,149 @@
+
+
+###########################################################
+#
+# --%%  Setup and Initialize  %%--
+
+import logging
+import numpy as np
+import operator
+import pandas as pd
+import sys
+
+assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
+logger = logging.getLogger(__name__)
+
+from eastwood import kleene
+
+# Decision tables for flowchart algorithms (eg. Eastwood2016, Fig 2).
+#	A ruleset is a sequence of flowcharts. A flowchart is a dict with its ordered 'steps', the 'default' category of the
+#	subjects passing all steps and the 'entry' category of the subjects it handles (None: all subjects). Each step is a
+#	tuple (label, condition, category); a subject is assigned the category of the first step whose condition is True.
+#	Categories are given by their keys in the dict of categories of the ruleset.
+#
+#	Conditions are three-valued (see eastwood.kleene) and built from nested tuples over the columns of a frame:
+#	  'col'                A column of the frame as a truth value; NA is unknown.
+#	  (op, 'col', value)   Comparison of a column with value; op is one of '<', '<=', '==', '!=', '>=', '>'. Unknown
+#	                       where col is missing. A value like '{name}' is the parameter 'name' given at evaluation.
+#	  ('any', cond, ...)   Kleene OR.
+#	  ('all', cond, ...)   Kleene AND.
+#	  ('not', cond)        Kleene NOT.
+#	  ('no', cond)         True where cond is not known to be True (ie. False or unknown); never unknown.
+
+COMPARISONS = {'<': operator.lt, '<=': operator.le, '==': operator.eq, '!=': operator.ne, '>=': operator.ge, '>': operator.gt}
+LOGICAL = {
+    'any': lambda *args: kleene.any(args),
+    'all': lambda *args: kleene.all(args),
+    'not': kleene.not_,
+    'no':  lambda arg: kleene.not_(kleene.mask(arg)),
+}
+
+
+
+###########################################################
+#
+# --%%  DEFINE: Ruleset; flowcharts compiled for evaluation in one pass  %%--
+
+class Ruleset():
+	"""Flowcharts of decision steps, compiled into a program over numpy arrays.
+
+	Each distinct (sub)condition of all steps becomes one instruction of the program, so a condition shared by several
+	steps or flowcharts is only evaluated once, and each column is only read from the frame once.
+	"""
+
+	def __init__(self, categories, flowcharts, name="Ruleset"):
+		"""categories: dict mapping the keys used in the steps to the category labels; the order is that of the output.
+		flowcharts: dict of flowcharts by name, evaluated in order.
+		name: Used in the log.
+		"""
+		self.categories = dict(categories)
+		self.name = name
+		self.program = list()
+		self._compiled = dict()
+		self.flowcharts = dict()
+		codes = {key: code for code, key in enumerate(self.categories)}
+		for chart, spec in flowcharts.items():
+			self.flowcharts[chart] = {
+			    'entry':   None if spec.get('entry') is None else codes[spec['entry']],
+			    'default': codes[spec['default']],
+			    'steps':   [(label, self._compile(cond), codes[category]) for label, cond, category in spec['steps']],
+			}
+
+	def _compile(self, cond):
+		"""Add cond and its subconditions to the program. Return: Position of cond in the program."""
+		if cond in self._compiled:
+			return self._compiled[cond]
+		if isinstance(cond, str):
+			instruction = ('column', cond)
+		elif cond[0] in COMPARISONS:
+			assert len(cond) == 3 and isinstance(cond[1], str), f"{self.name}: Comparisons take a column and a value; got {cond}."
+			instruction = cond
+		elif cond[0] in LOGICAL:
+			instruction = (cond[0], *[self._compile(arg) for arg in cond[1:]])
+		else:
+			raise ValueError(f"{self.name}: Unknown operator '{cond[0]}' in condition {cond}.")
+		self.program.append(instruction)
+		self._compiled[cond] = len(self.program) - 1
+		return self._compiled[cond]
+
+	@property
+	def columns(self):
+		"""Return: The columns read by the program."""
+		return list(dict.fromkeys(instr[1] for instr in self.program if instr[0] == 'column' or instr[0] in COMPARISONS))
+
+	@staticmethod
+	def _compare(series, op, value):
+		"""Return: series op value as a (value, known) pair; unknown where series is missing."""
+		known = series.notna().to_numpy()
+		if pd.api.types.is_datetime64_any_dtype(series.dtype):
+			values, value = series.to_numpy(dtype='datetime64[ns]'), np.datetime64(pd.Timestamp(value), 'ns')
+		elif pd.api.types.is_numeric_dtype(series.dtype):
+			values = series.to_numpy(dtype='float64', na_value=np.nan)
+		else:
+			values = series.to_numpy(dtype=object)
+		with np.errstate(invalid='ignore'):
+			result = np.asarray(COMPARISONS[op](values[known], value), dtype=bool)
+		out = np.zeros(known.size, dtype=bool)
+		out[known] = result
+		return out, known
+
+	def evaluate(self, df, **params):
+		"""Run the program on the columns of df. Return: list with the (value, known) pair of each instruction."""
+		param = lambda value: params[value[1:-1]] if isinstance(value, str) and value.startswith('{') and value.endswith('}') else value
+		out = list()
+		for op, *args in self.program:
+			if op == 'column':
+				out.append(kleene.kleene(df[args[0]]))
+			elif op in COMPARISONS:
+				out.append(self._compare(df[args[0]], op, param(args[1])))
+			else:
+				out.append(LOGICAL[op](*[out[i] for i in args]))
+		return out
+
+	def __call__(self, df, start=None, charts=None, name=None, **params):
+		"""Assign the categories of the flowcharts to the rows of df.
+
+		start: Categories of the rows before the flowcharts, eg. for entering a later flowchart. Default: Missing.
+		charts: The names of the flowcharts to apply. Default: All.
+		name: Name of the returned Series.
+		params: Values of the parameters in the conditions.
+		Return: pd.Series with dtype 'category'.
+		"""
+		if start is None:
+			codes = np.full(df.index.size, -1, dtype='int8')
+		else:
+			codes = pd.Categorical(start, categories=list(self.categories.values())).codes.copy()
+		labels = list(self.categories.values())
+		truth = self.evaluate(df, **params)
+		for chart in (self.flowcharts if charts is None else charts):
+			spec = self.flowcharts[chart]
+			left = np.ones(codes.size, dtype=bool) if spec['entry'] is None else codes == spec['entry']
+			logger.info(f"{self.name} Algorithm {chart} Starting: Analysing {left.sum()} subjects.")
+			for label, instruction, category in spec['steps']:
+				x = kleene.mask(truth[instruction]) & left
+				codes[x] = category
+				left &= ~x
+				logger.info(f"   {self.name} {label}: {x.sum()} subjects assigned '{labels[category]}'; {left.sum()} subjects remaining.")
+			codes[left] = spec['default']
+			logger.info(f"{self.name} Algorithm {chart} finished: Remaining {left.sum()} subjects assigned '{labels[spec['default']]}'.")
+		return pd.Series(pd.Categorical.from_codes(codes, categories=labels), index=df.index, name=name)
@@ -1,7 +1,7 @@
 
 import phenotool.epilog as EPILOG
 import phenotool.options as OPTIONS
-from phenotool.phenotype import Phenotype
+from phenotool.phenotype import Phenotype, open_output, read_files
 from phenotool.plink import Psam, plink, plink_chain
 from phenotool.rvtest import rvtest, rvtest_chain
 from phenotool.snptest import snptest, snptest_chain
@@ -2,6 +2,11 @@
 #
 # --%%  Define shared help strings  %%--
 
+chunksize = """
+Parse the input file(s) in chunks of this many rows, keeping only the requested samples and columns from each chunk.
+Limits memory use on large input files. Default is to parse each file in one go.
+"""
+
 columns = """
 Comma separated list of columns to output in addition to mandatory columns. Default is to output all columns.
 """
@@ -10,11 +15,21 @@ covariates = """
 Comma separated list of columns with covariates. Print only these columns (plus any mandatory columns)
 """
 
+engine = """
+Parser for the input file(s). 'arrow' uses the multithreaded CSV reader of pyarrow, which is much faster on large
+files but requires the optional dependency 'pyarrow'. Default is the pandas parser.
+"""
+
 files = """
 Input File(s). %(prog)s accepts one or more input files including '-' symbolizing stdin. The precise format of each
 input file will be autodetected, but it should be some form of delimited text data file like 'csv' or tab-delimited.
 """
 
+jobs = """
+Number of processes used to parse input files in parallel. Files given on stdin are always parsed by the main process.
+Also the number of threads compressing the output.
+"""
+
 log = """
 Control logging. Valid levels: 'debug', 'info', 'warning', 'error', 'critical'.
 """
@@ -23,6 +38,11 @@ nrows = """
 Read only 'nrows' lines from the input file(s) (header excluded). Intended for speedy testing on large datafiles. Default is to read all lines from input.
 """
 
+output = """
+Write the output to this file instead of stdout. Files ending in '.gz' are gzip compressed, files ending in '.zst'
+zstd compressed (requires the optional dependency 'zstandard'). Compression runs in parallel with writing.
+"""
+
 phenotypes = """
 Comma separated list of columns with phenotypes.
 """
@@ -99,6 +119,27 @@ baseline = """
 Baseline date. All prior information will be considered baseline data.
 """
 
+baselines = """
+Baseline date. All prior information will be considered baseline data. Give several times to calculate the prevalence
+at each baseline in one pass; the columns are then named <NAME>_<DATE>.
+"""
+
+dmcache = """
+Directory for caching the features found by the algorithm, keyed by the input file, its datafields and samples and the
+baseline. Later runs on the same input and baseline (eg. with another style, end date or interval) load the features
+from the cache instead of extracting them.
+"""
+
+snapshot = """
+Directory holding a snapshot of the features and results per participant and baseline. A later run (eg. on a new data
+release) only calculates participants whose data differ from the snapshot, copies the others and replaces the snapshot.
+"""
+
+shards = """
+Number of processes calculating the algorithm, each on a shard of the samples. The result is the same as with a single
+process. Default: The '--jobs' of the ukbiobank command, or 1.
+"""
+
 datediag = """
 Diagnoses and dates when they were first given.
 """
@@ -116,7 +157,8 @@ Give incidence as intervals of time. <TIME_STR> should be a timeunit or a number
 """
 
 prevstyles = """
-Sets the style of the prevalence output categories.
+Sets the style of the prevalence output categories. Give several times for one column per style; the columns are
+then named <NAME>_<STYLE> (followed by any _<DATE>).
 """
 
 reported = """
@@ -127,6 +169,16 @@ stopdate = """
 Last date to consider. All information after this date will be ignored.
 """
 
+stopdates = """
+Last date to consider. All information after this date will be ignored. With '--survival', subjects are censored at
+this date; give it several times for one set of survival columns per date.
+"""
+
+survival = """
+Output incidence as time-to-event ('_time') and event indicator ('_event') columns for Cox models. Time is counted from
+baseline in units of '--interval' (default: days). Subjects not at risk at baseline are NA.
+"""
+
 treatments = """
 Evidence of relevant treatments; eg. Insulin for Diabetes.
 """
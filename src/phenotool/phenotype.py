@@ -8,10 +8,16 @@
 #
 # --%%  RUN: Perform Basic Setup  %%--
 
+import concurrent.futures
+import contextlib
 import copy
+from isal import igzip
+import io
+import itertools
 import logging
 from numbers import Number
 import numpy as np
+import os
 import pandas as pd
 import sys
 import warnings
@@ -20,6 +26,7 @@ assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newe
 logger = logging.getLogger(__name__)
 
 import pklib
+import pklib.pkcsv as csv
 
 # --%%  END: Perform Basic Setup  %%--
 #
@@ -46,14 +53,38 @@ class Phenotype:
     mkey_id    = "IID" # Also the index, so must be unique.
     mkey_sex   = "SEX"
 
-    def __init__(self, iterable, *args, phenovars=[], samples=[], **kwargs):
+    WRITE_ROWS = 10000 # Rows formatted and written at a time by write()
+    helpers    = []    # Columns read only for later processing; left out by the to_*() conversions
+    source     = None  # Identity of the parsed file (see file_identity); None if unknown or combined from several
+
+    def __init__(self, iterable, *args, chunksize=None, engine=None, phenovars=[], samples=[], **kwargs):
         """
         iterable:  Someting iterable. Possibly a 'Phenotype' class object.
+        chunksize: If given, parse 'iterable' in chunks of this many rows and only keep the requested samples and columns.
+        engine:    Parser for text input; 'arrow' for the multithreaded pyarrow CSV reader. Default: pandas.
         phenovars: A list of variables to output. If empty it must default to all columns in 'iterable'.
+        samples:   A list of samples to output. If 'iterable' has a row index (see RowIndex), only those rows are parsed.
         """
+        from .rowindex import RowIndex
+        if (identity := file_identity(iterable)) is not None:
+            self.source = identity
+        if samples and not kwargs.get('nrows') and (rowindex := RowIndex.find(iterable)) is not None:
+            iterable = rowindex.subset(samples)
         try:
-            self.df = pd.read_csv(iterable, *args, **kwargs)
-        except:
+            if engine == 'arrow':
+                if chunksize:
+                    logger.warning(f"{self.__name__}: Ignoring chunksize={chunksize} with the arrow engine.")
+                self.df = self._read_arrow(iterable, *args, **kwargs)
+            elif chunksize:
+                self.df = self._read_chunked(iterable, *args, chunksize=chunksize, phenovars=phenovars, samples=samples, **kwargs)
+            else:
+                self.df = pd.read_csv(iterable, *args, **kwargs)
+        except ImportError as ex:
+            logger.critical(f"{self.__name__}: The arrow engine requires the optional dependency 'pyarrow'.")
+            sys.exit(ex)
+        except Exception:
+            if hasattr(iterable, 'read') or isinstance(iterable, (str, os.PathLike)):
+                raise # A file which failed to parse; not data for pd.DataFrame()
             try: self.df = pd.DataFrame(iterable)
             except Exception as ex:
                 logger.critical(f'Phenotype: Unable to parse input for Phenotype constructor. Iterable expected, received {iterable}')
@@ -61,10 +92,10 @@ class Phenotype:
         logger.info(f"{self.__name__}: Parsing file with columns[:10] = {self.colnames[:10]}")
         logger.debug(f"{self.__name__}: Parsing file with columns: {self.colnames}")
         logger.info(f"{self.__name__}: Searching for vars = {phenovars}")
-        if samples:
-            self.samples = samples
         self = self._set_magic_kcol()
         self.df = self.df.set_index(self.mkey_id)
+        if samples:
+            self.samples = samples
         self = self._conform_columns(columns=self.field2cols(phenovars))
         Phenotype._validate(self)
         logger.debug(f"{self.__name__}: Columns after __init__ = {self.columns.to_list()}")
@@ -74,24 +105,35 @@ class Phenotype:
             self._sampletypes = self.index[0]
             self.df = self.drop(self.index[0])
 
-    def _conform_columns(self, columns=[]):
+    def _conform_columns(self, columns=[], typed=[]):
         """Return: All magic columns in input + specified columns in that order. Also converts data types and NAs.
         columns: a list of column names to extract. Default: All.
+        typed: Columns which were given their dtype at parse time; these are not converted.
         """
         columns = self.colnames_translate(columns) if columns else self.colnames
         index = pd.Index(self.colnames_magic).append(pd.Index(columns)).drop_duplicates().to_list()
         cols = [col for col in index if col in self.df]
         self.df = self.df.loc[:,cols]
-        self.df.replace('NA', np.NaN, inplace=True)
-        for col in self.df.select_dtypes('object').columns:
-            self._obj[col] = pd.to_numeric(self._obj[col], errors='ignore')
-        self.df = self.df.convert_dtypes()
+        if not typed:
+            self.df.replace('NA', np.NaN, inplace=True)
+            for col in self.df.select_dtypes('object').columns:
+                self._obj[col] = pd.to_numeric(self._obj[col], errors='ignore')
+            self.df = self.df.convert_dtypes()
+            return self
+        untyped = [col for col in cols if col not in typed]
+        obj = self.df[untyped].replace('NA', np.NaN)
+        for col in obj.select_dtypes('object').columns:
+            obj[col] = pd.to_numeric(obj[col], errors='ignore')
+        obj = obj.convert_dtypes()
+        for col in untyped:
+            self.df[col] = obj[col]
         return self
 
     def __getitem__(self, key):
-        """Redirects index operations to the _obj attribute."""
-        out = copy.deepcopy(self)
-        out._obj = out._obj[key]
+        """Redirects index operations to the _obj attribute.
+        Only the selection is copied; all other attributes are shared with self."""
+        out = copy.copy(self)
+        out._obj = self._obj[key]
         return out
 
     def __repr__(self):
@@ -103,6 +145,75 @@ class Phenotype:
         """Redirects index-based assignment operations to the _obj attribute."""
         self._obj[key] = value
 
+    def _read_arrow(self, iterable, *args, dialect=None, dtype=None, nrows=None, parse_dates=[], usecols=None, **kwargs):
+        """Parse iterable with the multithreaded CSV reader of pyarrow. Understands the subset of pd.read_csv arguments
+        used by Phenotype and its subclasses; others are ignored.
+
+        iterable: A binary file object positioned at the header.
+        usecols: Column names or a callable selecting column names as for pd.read_csv.
+        nrows: Read only the first 'nrows' rows. Rows are then parsed in blocks, stopping once enough are read.
+        dtype, parse_dates: Column types as for pd.read_csv (eg. from UKBioBank.schema()).
+        Return: pd.DataFrame with column types as close as possible to those of pd.read_csv.
+        """
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+        arrow_types = {"category": pa.string(), "string": pa.string(), "Int32": pa.int32(), "Float32": pa.float32(), "Float64": pa.float64()}
+        dtype = dtype if dtype else dict()
+        parse = pacsv.ParseOptions(delimiter=getattr(dialect, 'delimiter', ','), quote_char=getattr(dialect, 'quotechar', '"') or False)
+        names = pacsv.read_csv(io.BytesIO(iterable.readline()), parse_options=parse).column_names
+        if callable(usecols):
+            names_use = [name for name in names if usecols(name)]
+        else:
+            names_use = [name for name in names if usecols is None or name in usecols]
+        types = {col: arrow_types[str(t)] for col, t in dtype.items() if str(t) in arrow_types}
+        types.update({col: pa.timestamp('ns') for col in parse_dates})
+        read = pacsv.ReadOptions(column_names=names, use_threads=True)
+        convert = pacsv.ConvertOptions(include_columns=names_use, column_types=types, strings_can_be_null=True)
+        if nrows is None:
+            table = pacsv.read_csv(iterable, read_options=read, parse_options=parse, convert_options=convert)
+        else:
+            reader, batches, n = pacsv.open_csv(iterable, read_options=read, parse_options=parse, convert_options=convert), [], 0
+            while n < nrows:
+                try: batches.append(reader.read_next_batch())
+                except StopIteration:
+                    break
+                n += batches[-1].num_rows
+            table = pa.Table.from_batches(batches, schema=reader.schema).slice(0, nrows)
+        for i, field in enumerate(table.schema):
+            if pa.types.is_null(field.type): # Empty columns; pd.read_csv gives float
+                table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+            elif pa.types.is_temporal(field.type) and field.name not in parse_dates: # pd.read_csv leaves these as text
+                table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+        logger.debug(f"{self.__name__}: Parsed {table.num_rows} rows with the arrow engine; schema = {table.schema}")
+        return table.to_pandas().astype({col: t for col, t in dtype.items() if col in table.column_names})
+
+    def _read_chunked(self, iterable, *args, chunksize, phenovars=[], samples=[], **kwargs):
+        """Parse iterable with pd.read_csv in chunks of 'chunksize' rows. Each chunk is reduced to the magic columns, the
+        columns matching phenovars and the rows in samples before the next chunk is parsed, so peak memory is bounded by
+        the chunk size plus the output.
+
+        Return: pd.DataFrame with the surviving rows and columns; column names are not yet translated.
+        """
+        keep, idcol, out = None, None, []
+        samples = pd.Index([str(s) for s in samples]) if samples else None
+        for chunk in pd.read_csv(iterable, *args, chunksize=chunksize, **kwargs):
+            if keep is None:
+                self.df = chunk.iloc[:0]
+                idcol = next((col for col in chunk.columns if col in self.MAGIC_COLS[self.mkey_id]), chunk.columns[0])
+                magic = set(itertools.chain.from_iterable(self.MAGIC_COLS.values())) | set(self.field2cols(phenovars)) | {idcol}
+                keep = [col for col in chunk.columns if col in magic] if phenovars else chunk.columns.to_list()
+                logger.debug(f"{self.__name__}: Reading chunks of {chunksize} rows with columns {keep}")
+            chunk = chunk[keep]
+            if samples is not None:
+                chunk = chunk[chunk[idcol].astype(str).isin(samples)]
+            out.append(chunk)
+        if not out:
+            return pd.DataFrame(columns=keep)
+        df = pd.concat(out)
+        for col in out[0].select_dtypes('category').columns:
+            df[col] = df[col].astype('category') # Chunks with different categories concatenate to object
+        return df
+
     def _set_magic_kcol(self):
         for k, v in self.MAGIC_COLS.items():
             self.df = self.df.rename(dict(zip(v, [k] * len(v))), axis=1)
@@ -186,6 +297,10 @@ class Phenotype:
     @samples.setter
     def samples(self, value):
         """Return: All specified samples in specified order."""
+        value = pd.Index(value)
+        try: value = value.astype(self.index.dtype) # Sample files are text, but IDs are often parsed as numbers
+        except (TypeError, ValueError):
+            pass
         try: self.df = self.df.reindex(value)
         except Exception as ex:
             sys.exit(f"{ex} in samples.setter...")
@@ -213,6 +328,34 @@ class Phenotype:
             outcols.extend(mcol if mcol else [col])
         return outcols
 
+    def combine(self, others):
+        """Return: Self combined with all of 'others' in a single outer join on the index.
+
+        Columns present in more than one object take their values in priority order: self first, then 'others' in the
+        given order, so each missing value is filled from the first object that has one (like repeated combine_first).
+        """
+        frames = [self.df] + [other.df if isinstance(other, Phenotype) else other for other in others]
+        if len(frames) == 1:
+            return self
+        self.source = None
+        self.helpers = list(dict.fromkeys(self.helpers + [col for other in others for col in getattr(other, 'helpers', [])]))
+        index = frames[0].index
+        for frame in frames[1:]:
+            index = index.union(frame.index)
+        columns = dict()
+        for frame in frames:
+            for col in frame.columns:
+                columns.setdefault(col, []).append(frame[col])
+        for col, series in columns.items():
+            out = series[0]
+            for other in series[1:]:
+                out = out.combine_first(other)
+            columns[col] = out.reindex(index)
+        self.df = pd.concat(columns, axis='columns').fillna(np.NaN)
+        self.df.index.name = frames[0].index.name
+        logger.debug(f"{self.__name__}: Combined {len(frames)} inputs into {self.df.shape[0]} rows and {self.df.shape[1]} columns.")
+        return self
+
     def combine_first(self, other):
         """Return: Combined DataFrame from self and other."""
         if isinstance(other, Phenotype):
@@ -300,22 +443,35 @@ class Phenotype:
         list_ = [0,"0","B","C","D","P"]
         return all(self._obj.iloc[0].isin(list_))
 
-    def pkisin(self, columns, values):
-        """Convienience function to check for 'values' using both numeric and string in df.isin()."""
-        if isinstance(values, str):
-            values = [values]
-        out = values
-        for value in values:
-            if isinstance(value, str) and value.isnumeric():
-                out.append(float(value))
-            elif isinstance(value, Number):
-                out.append(str(value))
-        return self.df[columns].isin(out)
-
-    def to_psam(self):
-        """Convert Phenotype Class to Class Psam for Plink output."""
+    def pkisin(self, columns, values=None):
+        """Convienience function to check for 'values' using both numeric and string in df.isin().
+        Called with one argument, it is taken as the values and all columns are checked."""
+        if values is None:
+            columns, values = self.colnames, columns
+        return self.df[columns].isin(self.pkvalues(values))
+
+    @staticmethod
+    def pkvalues(values):
+        """Return: List of values extended with the numeric version of numeric strings and vice versa (see pkisin).
+        Numbers compare by value; eg. '1065', '1065.0', 1065 and 1065.0 all give the same list of forms."""
+        out = [values] if isinstance(values, str) else list(values)
+        for value in out: # NB: Grows while iterating, so '1' gives both 1.0 and '1.0'
+            if isinstance(value, str):
+                try: number = float(value)
+                except ValueError:
+                    continue
+                forms = [number] if np.isfinite(number) else []
+            elif isinstance(value, Number) and not isinstance(value, bool):
+                forms = [str(value)] + ([str(int(value))] if float(value).is_integer() else [])
+            else:
+                continue
+            out.extend(form for form in forms if not any(type(other) is type(form) and other == form for other in out))
+        return out
+
+    def to_psam(self, exclude=[]):
+        """Convert Phenotype Class to Class Psam for Plink output. Columns in self.helpers and exclude are left out."""
         from .plink import Psam
-        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None), getattr(self, 'mkey_mat', None), getattr(self, 'mkey_pat', None)], errors='ignore')
+        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None), getattr(self, 'mkey_mat', None), getattr(self, 'mkey_pat', None)] + self.helpers + exclude, errors='ignore')
         obj[Psam.mkey_id] = self.index
         obj[Psam.mkey_sex] = self.sex
         try: obj[Psam.mkey_altid] = self._obj[self.mkey_altid]
@@ -330,10 +486,10 @@ class Phenotype:
         psam = Psam(obj)
         return psam
 
-    def to_rvtest(self):
-        """Convert Phenotype Class to Class RVtest for RVtest output."""
+    def to_rvtest(self, exclude=[]):
+        """Convert Phenotype Class to Class RVtest for RVtest output. Columns in self.helpers and exclude are left out."""
         from .rvtest import RVtest
-        obj = self._obj.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None), getattr(self, 'mkey_mat', None), getattr(self, 'mkey_pat', None)], errors='ignore')
+        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None), getattr(self, 'mkey_mat', None), getattr(self, 'mkey_pat', None)] + self.helpers + exclude, errors='ignore')
         obj[RVtest.mkey_id] = self.index
         obj[RVtest.mkey_sex] = self.sex
         try: obj[RVtest.mkey_altid] = self._obj[self.mkey_altid]
@@ -348,10 +504,10 @@ class Phenotype:
         rvtest = RVtest(obj)
         return rvtest
 
-    def to_snptest(self, covariates=[]):
-        """Convert Phenotype Class to Class Snptest for sample file output."""
+    def to_snptest(self, covariates=[], exclude=[]):
+        """Convert Phenotype Class to Class Snptest for sample file output. Columns in self.helpers and exclude are left out."""
         from .snptest import Snptest
-        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None)], errors='ignore')
+        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None)] + self.helpers + exclude, errors='ignore')
         obj[Snptest.mkey_id] = self.index
         obj[Snptest.mkey_sex] = self.sex
         try: obj[Snptest.mkey_altid] = self._obj[self.mkey_altid]
@@ -363,10 +519,10 @@ class Phenotype:
             raise
         return snptest
 
-    def to_textfile(self):
-        """Convert Phenotype Class to Class TextFile for custom file output."""
+    def to_textfile(self, exclude=[]):
+        """Convert Phenotype Class to Class TextFile for custom file output. Columns in self.helpers and exclude are left out."""
         from .textfile import TextFile
-        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None)], errors='ignore')
+        obj = self.drop(columns=[self.mkey_id, self.mkey_sex, getattr(self, 'mkey_altid', None)] + self.helpers + exclude, errors='ignore')
         obj[TextFile.mkey_id] = self.index
         obj[TextFile.mkey_sex] = self.sex
         try: obj[TextFile.mkey_altid] = self._obj[self.mkey_altid]
@@ -375,10 +531,17 @@ class Phenotype:
         textfile = TextFile(obj)
         return textfile
 
-    def write(self, dest=sys.stdout, *args, **kwargs):
-        """Output self._obj to dest."""
+    def write(self, dest=sys.stdout, *args, header=True, **kwargs):
+        """Output self._obj to dest in blocks of WRITE_ROWS rows, so the first rows are written before the rest of the
+        table is formatted. The table itself is validated and converted (eg. to_psam()) in full beforehand.
+        Uncompressed output, eg. a pipe, is flushed after each block so a reader can start early; compressed output
+        (see open_output) is not, as that would cost compression."""
         self._validate(self, warn=True)
-        self.df.to_csv(dest, *args, **kwargs)
+        flush = not getattr(dest, 'compressed', False)
+        for start in range(0, max(self.df.index.size, 1), self.WRITE_ROWS):
+            self.df.iloc[start:start + self.WRITE_ROWS].to_csv(dest, *args, header=header if start == 0 else False, **kwargs)
+            if flush:
+                dest.flush()
 
 # --%%  END: Define CLASS pheno  %%--
 #
@@ -418,6 +581,75 @@ class PEP(Phenotype):
 #
 # --%%  RUN: Other Functions & Constructors  %%--
 
+def read_files(constructor, files, *args, jobs=1, **kwargs):
+    """Parse several input files with 'constructor', using a pool of 'jobs' processes when jobs > 1.
+
+    constructor: The Phenotype class (or subclass) used for each file.
+    files: Open file objects. Files on disk are reopened by name in the worker processes; others (eg. stdin) are always
+      parsed in this process.
+    Return: List of 'constructor' objects in the same order as files.
+    """
+    out = [None] * len(files)
+    futures = dict()
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs) if jobs > 1 and len(files) > 1 else contextlib.nullcontext()
+    with pool as executor:
+        for i, fobj in enumerate(files):
+            if executor is not None and (identity := file_identity(fobj)) is not None:
+                futures[i] = executor.submit(_read_file, constructor, identity['name'], *args, **kwargs)
+            else:
+                out[i] = _read_fobj(constructor, fobj, *args, **kwargs)
+        for i, future in futures.items():
+            out[i] = future.result()
+    return out
+
+def _read_fobj(constructor, fobj, *args, **kwargs):
+    """Sniff the dialect of fobj and parse it with 'constructor'."""
+    if (dialect := csv.sniff(fobj)) is None:
+        fobj = csv.DictReader(fobj)
+    return constructor(fobj, *args, dialect=dialect, **kwargs)
+
+def _read_file(constructor, name, *args, **kwargs):
+    """Worker for read_files(): Open the file 'name' (possibly gzip compressed) and parse it with 'constructor'."""
+    with open(name, 'rb') as fh:
+        magic = fh.read(2)
+    with (igzip.open(name, 'rb') if magic == b'\x1f\x8b' else open(name, 'rb')) as fobj:
+        return _read_fobj(constructor, fobj, *args, **kwargs)
+
+def open_output(name=None, threads=1):
+    """Open the output file 'name' for writing text, compressing it if name ends with '.gz' or '.zst'.
+
+    name: File name. Default: Write to stdout.
+    threads: Number of threads compressing the output while it is written.
+    Return: A context manager with the open file object. Compressing file objects have the attribute 'compressed'.
+    """
+    if name is None or name == '-':
+        return contextlib.nullcontext(sys.stdout)
+    if name.endswith('.gz'):
+        from isal import igzip_threaded
+        out = igzip_threaded.open(name, 'wt', threads=threads)
+    elif name.endswith('.zst'):
+        try: import zstandard
+        except ImportError as ex:
+            logger.critical(f"Writing '{name}' requires the optional dependency 'zstandard'.")
+            sys.exit(ex)
+        out = zstandard.open(name, 'wt', cctx=zstandard.ZstdCompressor(threads=threads))
+    else:
+        return open(name, 'w')
+    out.compressed = True
+    return out
+
+def file_identity(source):
+    """Identify a file by name, size and modification time; used to detect stale sidecar files.
+
+    source: A file name or an open file object.
+    Return: A dict with the identity or None if source is not a regular file (eg. stdin).
+    """
+    name = getattr(source, 'name', source)
+    if not isinstance(name, (str, os.PathLike)) or not os.path.isfile(name):
+        return None
+    stat = os.stat(name)
+    return {'name': os.path.abspath(name), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
 def rank_INT(series, c=3.0/8, stochastic=True):
     """Perform rank-based inverse normal transformation on pandas series.
 
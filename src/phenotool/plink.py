@@ -9,9 +9,8 @@ import logging
 import pandas as pd
 import sys
 
-from phenotool import OPTIONS, Phenotype
+from phenotool import OPTIONS, Phenotype, open_output, read_files
 from pklib.pkclick import CSV, isalFile, SampleList
-import pklib.pkcsv as csv
 
 logger = logging.getLogger(__name__)
 
@@ -25,8 +24,9 @@ logger = logging.getLogger(__name__)
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--columns', type=CSV(), default="", help=OPTIONS.columns)
 @click.option('-f', '--fam', type=str, metavar='COLUMN', default=None, help=OPTIONS.fam)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
-def plink(obj, files, columns, fam, samples):
+def plink(obj, files, columns, fam, output, samples):
     """Output phenotypes in psam/fam format for use with Plink.
 
 A properly formatted psam file has in addition to the phenotype columns one or more of the following recognizable
@@ -57,13 +57,10 @@ https://www.cog-genomics.org/plink/1.9/formats#fam
         if columns:
             logger.warning(f"Note that the '--columns' option is ignored when setting '--fam'.")
         columns = [fam]
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = Psam(fobj, dialect=dialect, phenovars=columns, samples=samples)
-        try: obj['pheno'] = obj['pheno'].pheno.combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
-    obj['pheno'].write(header = False if fam else True)
+    phenos = read_files(Psam, files, engine=obj.get('engine'), jobs=obj.get('jobs', 1), phenovars=columns, samples=samples)
+    obj['pheno'] = phenos[0].combine(phenos[1:])
+    with open_output(output, threads=obj.get('jobs', 1)) as dest:
+        obj['pheno'].write(dest=dest, header = False if fam else True)
 
 
 
@@ -75,8 +72,9 @@ https://www.cog-genomics.org/plink/1.9/formats#fam
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--columns', type=CSV(), default="", help=OPTIONS.columns)
 @click.option('-f', '--fam', type=str, metavar='COLUMN', default=None, help=OPTIONS.fam)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
-def plink_chain(obj, files, columns, fam, samples):
+def plink_chain(obj, files, columns, fam, output, samples):
     """Output phenotypes in psam/fam format for use with Plink.
 
 A properly formatted psam file has in addition to the phenotype columns one or more of the following recognizable
@@ -103,10 +101,9 @@ For more on the fam format please refer to:
 https://www.cog-genomics.org/plink/1.9/formats#fam
 """
     def processor(pheno):
-        if obj.get('to_be_deleted'):
-            pheno.df = pheno.drop(obj['to_be_deleted'], axis='columns')
-        pheno = pheno.to_psam()
-        pheno.write(header = False if obj.get('fam') else True)
+        pheno = pheno.to_psam(exclude=obj.get('to_be_deleted', []))
+        with open_output(output, threads=obj.get('jobs', 1)) as dest:
+            pheno.write(dest=dest, header = False if obj.get('fam') else True)
         return pheno
 
     assert sum([1 for x in [columns,fam] if x]) <= 1, "'--columns' and '--fam' are mutually exclusive; please only specify one of them."
@@ -124,12 +121,9 @@ https://www.cog-genomics.org/plink/1.9/formats#fam
         obj['samples'] = list(dict.fromkeys(obj.get('samples', []) + samples)) if obj.get('samples') else samples
     obj['constructor'] = obj.get('constructor', Psam)
     obj['files'].extend(files)
-    for fobj in obj['files']:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = obj['constructor'](fobj, dialect=dialect, **obj['args'])
-        try: obj['pheno'] = obj['pheno'].combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
+    phenos = ([obj['pheno']] if 'pheno' in obj else []) + read_files(obj['constructor'], obj['files'], jobs=obj.get('jobs', 1), **obj['args'])
+    if phenos:
+        obj['pheno'] = phenos[0].combine(phenos[1:])
     return processor
 
 
@@ -173,14 +167,17 @@ class Psam(Phenotype):
         self.df = self.df.loc[:,cols]
         Psam._validate(self)
 
-    def to_psam(self):
-        """No conversion necessary; self is already Psam."""
+    def to_psam(self, exclude=[]):
+        """No conversion necessary; self is already Psam. Only leaves out the columns in self.helpers and exclude."""
+        if self.helpers or exclude:
+            self.df = self.drop(columns=self.helpers + exclude, errors='ignore')
+            self.helpers = []
         return self
 
     def write(self, *args, dest=sys.stdout, header=True, **kwargs):
         """Like super() but handles *.fam files through header=False if self._obj only has one phenotype."""
         if header:
-            print("#", end="")
+            dest.write("#")
         super().write(dest, *args, sep='\t', na_rep='NA', header=header, index=False, **kwargs)
 
 # --%%  END: Define CLASS Psam (Plink2)  %%--
@@ -0,0 +1,119 @@
+
+
+###########################################################
+#
+# ---%%%  RowIndex: Random access to rows of phenotype files  %%%---
+#
+
+import io
+import json
+import logging
+import numpy as np
+import pandas as pd
+import sys
+
+assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
+logger = logging.getLogger(__name__)
+
+from phenotool.phenotype import file_identity
+
+
+
+##################################################
+#
+# --%%  CLASS: RowIndex    %%--
+
+class RowIndex:
+    """Sidecar index mapping the primary identifier (first column) of each row to its byte offset and length.
+
+With the index, a subset of samples can be parsed from a large phenotype file by seeking directly to their rows. Only
+uncompressed files can be indexed, since compressed streams do not support random access.
+"""
+    __name__ = "RowIndex"
+    SUFFIX = ".eidx"
+    COMPRESSED = [b'\x1f\x8b', b'\x28\xb5\x2f\xfd'] # Magic bytes of gzip/bgzip and zstd
+
+    def __init__(self, ids, offsets, lengths, source=None):
+        """ids: Primary identifiers as strings; offsets/lengths: Position of each row in bytes."""
+        self.ids = pd.Index(ids)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.lengths = np.asarray(lengths, dtype='int64')
+        self.source = source
+
+    @classmethod
+    def sidecar(cls, source):
+        """Return: Location of the index belonging to source; None if source is not a regular file."""
+        identity = file_identity(source)
+        return None if identity is None else identity['name'] + cls.SUFFIX
+
+    @classmethod
+    def is_compressed(cls, name):
+        """Return: True if the file 'name' starts with the magic bytes of a supported compression format."""
+        with open(name, 'rb') as fh:
+            magic = fh.read(4)
+        return any([magic.startswith(m) for m in cls.COMPRESSED])
+
+    @classmethod
+    def build(cls, source, delimiter=None):
+        """Scan source once and write the index next to it.
+
+        source: A regular, uncompressed file (name or open file object).
+        delimiter: Column separator. Default: Tab if the header has any, otherwise comma.
+        Return: The new RowIndex object.
+        """
+        identity = file_identity(source)
+        if identity is None or cls.is_compressed(identity['name']):
+            logger.warning(f"{cls.__name__}: Unable to index '{getattr(source, 'name', source)}'; only uncompressed regular files can be indexed.")
+            return None
+        ids, offsets, lengths = [], [], []
+        with open(identity['name'], 'rb') as fh:
+            header = fh.readline()
+            delimiter = delimiter.encode() if delimiter else (b'\t' if b'\t' in header else b',')
+            offset = len(header)
+            for line in fh:
+                ids.append(line.split(delimiter, 1)[0].strip(b'"\' \r\n').decode())
+                offsets.append(offset)
+                lengths.append(len(line))
+                offset += len(line)
+        out = cls(ids, offsets, lengths, source=identity)
+        with open(cls.sidecar(source), 'wb') as fh:
+            np.savez(fh, ids=np.array(ids, dtype=str), offsets=out.offsets, lengths=out.lengths, source=json.dumps(identity))
+        logger.info(f"{cls.__name__}: Indexed {len(ids)} rows of '{identity['name']}'.")
+        return out
+
+    @classmethod
+    def find(cls, source):
+        """Return: The RowIndex of source if it exists and is up to date; otherwise None."""
+        if (name := cls.sidecar(source)) is None:
+            return None
+        try:
+            with np.load(name) as npz:
+                out = cls(npz['ids'], npz['offsets'], npz['lengths'], source=json.loads(str(npz['source'])))
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            return None
+        if out.source != file_identity(source):
+            logger.warning(f"{cls.__name__}: Ignoring index '{name}' as it was built from a different version of '{out.source['name']}'.")
+            return None
+        return out
+
+    def subset(self, samples):
+        """Read the header and the rows of 'samples' from the source file.
+
+        samples: Primary identifiers to read. Identifiers not in the index are skipped.
+        Return: io.BytesIO with a file containing only the header and the requested rows (in file order).
+        """
+        pos = self.ids.get_indexer_for(pd.Index([str(s) for s in samples]).unique())
+        pos = np.sort(pos[pos >= 0])
+        out = io.BytesIO()
+        with open(self.source['name'], 'rb') as fh:
+            out.write(fh.readline())
+            for i in pos:
+                fh.seek(self.offsets[i])
+                out.write(fh.read(self.lengths[i]))
+        out.seek(0)
+        logger.info(f"{self.__name__}: Read {pos.size} of {len(samples)} requested samples using the row index.")
+        return out
+
+# --%%  END: CLASS RowIndex    %%--
+#
+##################################################
@@ -8,9 +8,8 @@ import click
 import logging
 import sys
 
-from phenotool import OPTIONS, Psam
+from phenotool import OPTIONS, Psam, open_output, read_files
 from pklib.pkclick import CSV, isalFile, SampleList
-import pklib.pkcsv as csv
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +22,9 @@ logger = logging.getLogger(__name__)
 @click.pass_obj
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--columns', type=CSV(), default="", help=OPTIONS.columns)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
-def rvtest(obj, files, columns, samples):
+def rvtest(obj, files, columns, output, samples):
     """UNTESTED; Output phenotypes in psam-like format for RVtest.
 
 RVtest phenotype files are very similar to the psam format. They are essentially plink2 files with a few caveats. The
@@ -34,13 +34,10 @@ names 'fatid' and 'matid' are used for paternal and maternal ids and 'sex' is en
 For more on RVtest phenotype files, please refer to:
 http://zhanxw.github.io/rvtests/#phenotype-file
 """
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = RVtest(fobj, dialect=dialect, phenovars=columns, samples=samples)
-        try: obj['pheno'] = obj['pheno'].pheno.combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
-    obj['pheno'].write()
+    phenos = read_files(RVtest, files, engine=obj.get('engine'), jobs=obj.get('jobs', 1), phenovars=columns, samples=samples)
+    obj['pheno'] = phenos[0].combine(phenos[1:])
+    with open_output(output, threads=obj.get('jobs', 1)) as dest:
+        obj['pheno'].write(dest=dest)
 
 
 #
@@ -50,8 +47,9 @@ http://zhanxw.github.io/rvtests/#phenotype-file
 @click.pass_obj
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--columns', type=CSV(), default="", help=OPTIONS.columns)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
-def rvtest_chain(obj, files, columns, samples):
+def rvtest_chain(obj, files, columns, output, samples):
     """UNTESTED; Output phenotypes in psam-like format for RVtest.
 
 RVtest phenotype files are very similar to the psam format. They are essentially plink2 files with a few caveats. The
@@ -62,10 +60,9 @@ For more on RVtest phenotype files, please refer to:
 http://zhanxw.github.io/rvtests/#phenotype-file
 """
     def processor(pheno):
-        if obj.get('to_be_deleted'):
-            pheno.df = pheno.drop(obj['to_be_deleted'], axis='columns')
-        pheno = pheno.to_rvtest()
-        pheno.write()
+        pheno = pheno.to_rvtest(exclude=obj.get('to_be_deleted', []))
+        with open_output(output, threads=obj.get('jobs', 1)) as dest:
+            pheno.write(dest=dest)
         return pheno
 
     try: obj['args']
@@ -75,12 +72,9 @@ http://zhanxw.github.io/rvtests/#phenotype-file
     if samples:
         obj['samples'] = list(dict.fromkeys(obj.get('samples', []) + samples))
     obj['constructor'] = obj.get('constructor', RVtest)
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = obj['constructor'](fobj, dialect=dialect, **obj['args'])
-        try: obj['pheno'] = obj['pheno'].combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
+    phenos = ([obj['pheno']] if 'pheno' in obj else []) + read_files(obj['constructor'], files, jobs=obj.get('jobs', 1), **obj['args'])
+    if phenos:
+        obj['pheno'] = phenos[0].combine(phenos[1:])
     return processor
 
 
@@ -116,8 +110,11 @@ class RVtest(Psam):
         self._obj[self.mkey_sex] = self._obj[self.mkey_sex].cat.rename_categories({1 : 0, 2 : 1})
         RVtest._validate(self)
 
-    def to_rvtest(self):
-        """No conversion necessary; self is already RVtest."""
+    def to_rvtest(self, exclude=[]):
+        """No conversion necessary; self is already RVtest. Only leaves out the columns in self.helpers and exclude."""
+        if self.helpers or exclude:
+            self.df = self.drop(columns=self.helpers + exclude, errors='ignore')
+            self.helpers = []
         return self
 
     def write(self, *args, dest=sys.stdout, **kwargs):
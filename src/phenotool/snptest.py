@@ -9,9 +9,8 @@ import logging
 import pandas as pd
 import sys
 
-from phenotool import OPTIONS, Phenotype
+from phenotool import OPTIONS, Phenotype, open_output, read_files
 from pklib.pkclick import CSV, isalFile, SampleList
-import pklib.pkcsv as csv
 
 logger = logging.getLogger(__name__)
 
@@ -24,9 +23,10 @@ logger = logging.getLogger(__name__)
 @click.pass_obj
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--covariates', type=CSV(), default="", help=OPTIONS.covariates)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-p', '--phenotypes', type=CSV(), default="", help=OPTIONS.phenotypes)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
-def snptest(obj, files, covariates, phenotypes, samples):
+def snptest(obj, files, covariates, output, phenotypes, samples):
     """Output phenotypes in sample format for use with Snptest.
 
 A properly formatted snptest sample (*.sam) file must contain the columns 'ID_1', 'ID_2', 'missing' and 'sex' in that
@@ -48,13 +48,10 @@ https://www.well.ox.ac.uk/~gav/qctool_v2/documentation/sample_file_formats.html
 Unofficial, but good (Scroll down):
 https://jmarchini.org/file-formats/
 """
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = Snptest(fobj, dialect=dialect, covariates=covariates, phenovars=phenotypes, samples=samples)
-        try: obj['pheno'] = obj['pheno'].combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
-    obj['pheno'].write()
+    phenos = read_files(Snptest, files, engine=obj.get('engine'), jobs=obj.get('jobs', 1), covariates=covariates, phenovars=phenotypes, samples=samples)
+    obj['pheno'] = phenos[0].combine(phenos[1:])
+    with open_output(output, threads=obj.get('jobs', 1)) as dest:
+        obj['pheno'].write(dest=dest)
 
 
 
@@ -66,9 +63,10 @@ https://jmarchini.org/file-formats/
 @click.pass_obj
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--covariates', type=CSV(), default="", help=OPTIONS.covariates)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-p', '--phenotypes', type=CSV(), default="", help=OPTIONS.phenotypes)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
-def snptest_chain(obj, files, covariates, phenotypes, samples):
+def snptest_chain(obj, files, covariates, output, phenotypes, samples):
     """Output phenotypes in sample format for use with Snptest.
 
 A properly formatted snptest sample (*.sam) file must contain the columns 'ID_1', 'ID_2', 'missing' and 'sex' in that
@@ -91,10 +89,9 @@ Unofficial, but good (Scroll down):
 https://jmarchini.org/file-formats/
 """
     def processor(pheno):
-        if obj.get('to_be_deleted'):
-            pheno.df = pheno.drop(obj['to_be_deleted'], axis='columns')
-        pheno = pheno.to_snptest(covariates = covariates)
-        pheno.write()
+        pheno = pheno.to_snptest(covariates = covariates, exclude=obj.get('to_be_deleted', []))
+        with open_output(output, threads=obj.get('jobs', 1)) as dest:
+            pheno.write(dest=dest)
         return pheno
 
     try: obj['args']
@@ -105,12 +102,9 @@ https://jmarchini.org/file-formats/
     if samples:
         obj['samples'] = list(dict.fromkeys(obj.get('samples', []) + samples))
     obj['constructor'] = obj.get('constructor', Snptest)
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = obj['constructor'](fobj, dialect=dialect, **obj['args'])
-        try: obj['pheno'] = obj['pheno'].combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
+    phenos = ([obj['pheno']] if 'pheno' in obj else []) + read_files(obj['constructor'], files, jobs=obj.get('jobs', 1), **obj['args'])
+    if phenos:
+        obj['pheno'] = phenos[0].combine(phenos[1:])
     return processor
 
 
@@ -210,6 +204,16 @@ class Snptest(Phenotype):
         value = pd.Index(value)
         self._phenotypes = value.intersection(self._obj.select_dtypes(include='number').columns)
 
+    def combine(self, others, *args, **kwargs):
+        """Super(), then set covariates/phenotypes."""
+        covariates, phenotypes = self.covariates, self.phenotypes
+        for other in others:
+            covariates, phenotypes = covariates.union(other.covariates), phenotypes.union(other.phenotypes)
+        obj = super().combine(others, *args, **kwargs)
+        obj.covariates = covariates
+        obj.phenotypes = phenotypes
+        return obj
+
     def combine_first(self, other, *args, **kwargs):
         """Super(), then set covariates/phenotypes."""
         obj = super().combine_first(other, *args, **kwargs)
@@ -217,18 +221,18 @@ class Snptest(Phenotype):
         obj.phenotypes = self.phenotypes.union(other.phenotypes)
         return obj
 
-    def to_snptest(self, covariates=None):
+    def to_snptest(self, covariates=None, exclude=[]):
         """Checks if covariates is not None and uses self.covariates instead."""
         if covariates:
-            return super().to_snptest(covariates)
+            return super().to_snptest(covariates, exclude=exclude)
         else:
-            return super().to_snptest(self.covariates)
+            return super().to_snptest(self.covariates, exclude=exclude)
 
     def write(self, *args, dest=sys.stdout, **kwargs):
         # All phenotypes should appear after the covariates in this file.
         self.df = self.df[filter(lambda c: c in self.colnames, list(dict.fromkeys(self.colnames_magic + self.covariates.to_list() + self.colnames)))]
-        print(' '.join([self.mkey_id] + self.colnames))
-        print(' '.join(['0'] + self.coltype.to_list()))
+        print(' '.join([self.mkey_id] + self.colnames), file=dest)
+        print(' '.join(['0'] + self.coltype.to_list()), file=dest)
         super().write(dest, *args, sep=' ', na_rep='NA', header=False, **kwargs)
 
 # --%%  END: Define CLASS Snptest  %%--
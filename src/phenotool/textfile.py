@@ -13,9 +13,8 @@ import logging
 import pandas as pd
 import sys
 
-from phenotool import EPILOG, OPTIONS, Phenotype
+from phenotool import EPILOG, OPTIONS, Phenotype, open_output, read_files
 from pklib.pkclick import CSV, isalFile, SampleList
-import pklib.pkcsv as csv
 
 logger = logging.getLogger(__name__)
 
@@ -29,17 +28,15 @@ logger = logging.getLogger(__name__)
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--columns', type=CSV(), default="", help=OPTIONS.columns)
 @click.option('--csv', 'formatflag', flag_value='csv', help=OPTIONS.csv)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
 @click.option('--tsv', 'formatflag', flag_value='tsv', default=True, help=OPTIONS.tsv)
-def textfile(obj, files, columns, formatflag, samples):
+def textfile(obj, files, columns, formatflag, output, samples):
     """Output phenotypes in customizable text format."""
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = TextFile(fobj, dialect=dialect, phenovars=columns, samples=samples)
-        try: obj['pheno'] = obj['pheno'].combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
-    obj['pheno'].write(sep=formatflag)
+    phenos = read_files(TextFile, files, engine=obj.get('engine'), jobs=obj.get('jobs', 1), phenovars=columns, samples=samples)
+    obj['pheno'] = phenos[0].combine(phenos[1:])
+    with open_output(output, threads=obj.get('jobs', 1)) as dest:
+        obj['pheno'].write(sep=formatflag, dest=dest)
 
 
 
@@ -51,15 +48,15 @@ def textfile(obj, files, columns, formatflag, samples):
 @click.argument('files', nargs=-1, type=isalFile(mode='rb'))
 @click.option('-c', '--columns', type=CSV(), default="", help=OPTIONS.columns)
 @click.option('--csv', 'formatflag', flag_value='csv', help=OPTIONS.csv)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default=None, help=OPTIONS.output)
 @click.option('-s', '--samples', type=SampleList(mode='rb'), help=OPTIONS.samples)
 @click.option('--tsv', 'formatflag', flag_value='tsv', default=True, help=OPTIONS.tsv)
-def textfile_chain(obj, files, columns, formatflag, samples):
+def textfile_chain(obj, files, columns, formatflag, output, samples):
     """Output phenotypes in customizable text format."""
     def processor(pheno):
-        if obj.get('to_be_deleted'):
-            pheno.df = pheno.drop(obj['to_be_deleted'], axis='columns')
-        pheno = pheno.to_textfile()
-        pheno.write(sep=formatflag)
+        pheno = pheno.to_textfile(exclude=obj.get('to_be_deleted', []))
+        with open_output(output, threads=obj.get('jobs', 1)) as dest:
+            pheno.write(sep=formatflag, dest=dest)
         return pheno
 
     try: obj['args']
@@ -69,12 +66,9 @@ def textfile_chain(obj, files, columns, formatflag, samples):
     if samples:
         obj['args']['samples'] = list(dict.fromkeys(obj.get('samples', []) + samples))
     obj['constructor'] = obj.get('constructor', TextFile)
-    for fobj in files:
-        if (dialect := csv.sniff(fobj)) is None:
-            fobj = csv.DictReader(fobj)
-        pheno_new = obj['constructor'](fobj, dialect=dialect, **obj['args'])
-        try: obj['pheno'] = obj['pheno'].combine_first(pheno_new)
-        except KeyError: obj['pheno'] = pheno_new
+    phenos = ([obj['pheno']] if 'pheno' in obj else []) + read_files(obj['constructor'], files, jobs=obj.get('jobs', 1), **obj['args'])
+    if phenos:
+        obj['pheno'] = phenos[0].combine(phenos[1:])
     return processor
 
 
@@ -98,13 +92,16 @@ class TextFile(Phenotype):
         """Init the TextFile object."""
         super().__init__(*args, **kwargs)
 
-    def to_textfile(self):
-        """No conversion necessary; self is already TextFile."""
+    def to_textfile(self, exclude=[]):
+        """No conversion necessary; self is already TextFile. Only leaves out the columns in self.helpers and exclude."""
+        if self.helpers or exclude:
+            self.df = self.drop(columns=self.helpers + exclude, errors='ignore')
+            self.helpers = []
         return self
 
     def write(self, sep="tsv", dest=sys.stdout, *args, **kwargs):
         """Output with support for textfile formatflags."""
-        super().write(*args, sep=self.FORMATFLAGS[sep], **kwargs)
+        super().write(dest, *args, sep=self.FORMATFLAGS[sep], **kwargs)
 
 
 
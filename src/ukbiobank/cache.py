@@ -0,0 +1,188 @@
+
+
+###########################################################
+#
+# ---%%%  UKBiobank: Columnar cache of UKB main datasets  %%%---
+#
+
+import json
+import logging
+import pathlib
+import re
+import sys
+
+import pandas as pd
+
+assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
+logger = logging.getLogger(__name__)
+
+from phenotool.phenotype import file_identity
+
+
+
+##################################################
+#
+# --%%  CLASS: UKBCache    %%--
+
+class UKBCache:
+    """Column-partitioned on-disk copy of a UKB main dataset (ukbXXXXX.tab/csv).
+
+The store is a directory holding one Parquet file per datafield (all instances and arrays of that field) plus one
+file with the participant identifiers. A small json manifest records the original column names and the identity of the
+source file, so that a store is ignored once the source file has changed. It also records all columns of each datafield
+in the header of the source, so that a store built from some of the columns (eg. one instance) is only used for
+reading those.
+
+Object columns are stored as text. Columns where read_csv left numbers among the text (eg. chunks of a large file
+parsed to different types) also keep the type of each such value, so they are read back as parsed.
+"""
+    __name__ = "UKBCache"
+    MANIFEST = "manifest.json"
+    SUFFIX   = ".cache"
+    ID_FILE  = "eid.parquet"
+    TYPES    = ".types" # Suffix of the column holding the types of the values in a mixed object column
+    MIXED    = {'int': int, 'float': float, 'bool': lambda text: text == 'True'} # Types restored from text by read()
+
+    def __init__(self, path):
+        """path: Directory holding a store previously written by UKBCache.build()."""
+        self.path = pathlib.Path(path)
+        with open(self.path / self.MANIFEST) as fh:
+            self.manifest = json.load(fh)
+
+    @property
+    def columns(self):
+        """Return: All column names in the store grouped by datafield."""
+        return [self.manifest['id']] + [col for cols in self.manifest['fields'].values() for col in cols]
+
+    @property
+    def fields(self):
+        """Return: The datafields held in the store."""
+        return list(self.manifest['fields'].keys())
+
+    @staticmethod
+    def field(column):
+        """Return: The datafield of a UKB column name (eg '20002' for both 'f.20002.0.1' and '20002-0.1')."""
+        match = re.match(r"(?:f\D)?(\d+)\D", column)
+        return match.group(1) if match else None
+
+    @classmethod
+    def sidecar(cls, source):
+        """Return: Default location of the store belonging to source; None if source is not a regular file."""
+        identity = file_identity(source)
+        return None if identity is None else pathlib.Path(identity['name'] + cls.SUFFIX)
+
+    @classmethod
+    def build(cls, iterable, path=None, *args, usecols=None, **kwargs):
+        """Parse iterable once with pd.read_csv and write the columns as one Parquet file per datafield.
+
+        iterable: A UKB main dataset; ideally an open file with a name.
+        path: Directory for the store. Default: Sidecar directory next to iterable (see sidecar()).
+        usecols: Forwarded to pd.read_csv. Columns which are not UKB datafields are ignored.
+        Return: The UKBCache object for the new store.
+
+        Building into an existing store for the same source adds or replaces the parsed datafields.
+        """
+        path = pathlib.Path(path) if path else cls.sidecar(iterable)
+        if path is None:
+            sys.exit(f"{cls.__name__}: Unable to place cache for '{getattr(iterable, 'name', iterable)}'. Please specify a directory for the cache.")
+        identity = file_identity(iterable)
+        header = list()
+        def selector(col):
+            header.append(col)
+            return usecols(col)
+        df = pd.read_csv(iterable, *args, usecols=selector if callable(usecols) else usecols, **kwargs)
+        idcol = df.columns[0]
+        header = header if callable(usecols) else df.columns.to_list()
+        logger.info(f"{cls.__name__}: Writing {df.columns.size - 1} columns to '{path}'.")
+
+        manifest = {'source': identity, 'id': idcol, 'nrows': len(df.index), 'fields': {}, 'header': {}, 'mixed': {}}
+        try:
+            old = cls(path)
+            if old.manifest['source'] == identity and old.manifest['id'] == idcol and old.manifest['nrows'] == manifest['nrows']:
+                manifest['fields'] = old.manifest['fields']
+                manifest['header'] = old.manifest.get('header', {})
+                manifest['mixed'] = old.manifest.get('mixed', {})
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        for col in dict.fromkeys(header):
+            if (field := cls.field(col)) is not None:
+                manifest['header'].setdefault(field, [])
+                if col not in manifest['header'][field]:
+                    manifest['header'][field].append(col)
+
+        path.mkdir(parents=True, exist_ok=True)
+        try:
+            df[[idcol]].to_parquet(path / cls.ID_FILE, index=False)
+            for field, cols in df.columns[1:].to_series().groupby(lambda col: cls.field(col), sort=False):
+                block = df[cols.to_list()].copy()
+                manifest['mixed'][field] = list()
+                for col in block.select_dtypes('object').columns:
+                    types = block[col].map(lambda value: type(value).__name__).where(block[col].notna())
+                    if types.isin(list(cls.MIXED)).any():
+                        block[col + cls.TYPES] = types.where(types.isin(list(cls.MIXED)), None)
+                        manifest['mixed'][field].append(col)
+                    block[col] = block[col].astype(str).where(block[col].notna(), None) # Parquet cannot hold mixed-type columns
+                block.to_parquet(path / f"{field}.parquet", index=False)
+                manifest['fields'][field] = cols.to_list()
+                logger.debug(f"{cls.__name__}: Stored field {field} with columns {cols.to_list()}")
+        except ImportError as ex:
+            logger.critical(f"{cls.__name__}: Writing the cache requires the optional dependency 'pyarrow'.")
+            sys.exit(ex)
+        with open(path / cls.MANIFEST, 'w') as fh:
+            json.dump(manifest, fh)
+        return cls(path)
+
+    @classmethod
+    def find(cls, source, path=None):
+        """Return: The UKBCache for source if one exists and is up to date; otherwise None.
+
+        path: Directory of the store. Default: Sidecar directory next to source.
+        """
+        path = path if path else cls.sidecar(source)
+        try: store = cls(path)
+        except (FileNotFoundError, NotADirectoryError, TypeError, json.JSONDecodeError):
+            return None
+        identity = file_identity(source)
+        if identity is not None and store.manifest['source'] != identity:
+            logger.warning(f"{cls.__name__}: Ignoring cache '{path}' as it was built from a different version of '{identity['name']}'.")
+            return None
+        logger.info(f"{cls.__name__}: Found cache '{path}' with {len(store.fields)} datafields.")
+        return store
+
+    def covers(self, usecols):
+        """Return: True if the store holds every column of the source selected by usecols (see read()).
+
+        Stores written before the header of the source was recorded never cover a selection.
+        """
+        if 'header' not in self.manifest:
+            return False
+        stored = set(self.columns)
+        return all(col in stored for cols in self.manifest['header'].values() for col in cols if usecols(col))
+
+    def read(self, usecols, nrows=None):
+        """Read the columns selected by usecols from the store.
+
+        usecols: A callable returning True for column names to read (like pd.read_csv(usecols=...)).
+        nrows: Return only the first 'nrows' rows.
+        Return: pd.DataFrame with the identifier column first followed by the selected columns grouped by datafield.
+        """
+        frames = [pd.read_parquet(self.path / self.ID_FILE)]
+        for field, cols in self.manifest['fields'].items():
+            cols = [col for col in cols if usecols(col)]
+            if cols:
+                mixed = [col for col in self.manifest.get('mixed', {}).get(field, []) if col in cols]
+                block = pd.read_parquet(self.path / f"{field}.parquet", columns=cols + [col + self.TYPES for col in mixed])
+                for col in mixed:
+                    types = block.pop(col + self.TYPES)
+                    block[col] = block[col].astype(object)
+                    for name, restore in self.MIXED.items():
+                        rows = (types == name).to_numpy()
+                        block.loc[rows, col] = block.loc[rows, col].map(restore)
+                frames.append(block)
+        out = pd.concat(frames, axis='columns')
+        logger.debug(f"{self.__name__}: Read columns {out.columns.to_list()} from '{self.path}'")
+        return out if nrows is None else out.head(nrows)
+
+# --%%  END: CLASS UKBCache    %%--
+#
+##################################################
@@ -2,6 +2,17 @@
 #
 # --%%  Define shared help strings for the UKB sections  %%--
 
+cache = """
+Directory with a columnar cache of the phenotype file as written by the 'cache build' command. Default is to use the
+cache next to the phenotype file ('<file>.cache') if there is one.
+"""
+
+data_dictionary = """
+The UKB data dictionary ('Data_Dictionary_Showcase.tsv' from the showcase). If given, each column is parsed directly
+into the type of its datafield: categorical, integer, float or date. This saves both time and memory when parsing large
+phenotype files.
+"""
+
 datafields = """
 Data Field(s) to output. Several fields can be specified as a comma-separated string with no spaces. Required.
 """
@@ -18,4 +29,9 @@ sex = """
 For the 'sex' column, do you want to use data from the NHS registry (field 31) or from the genetic sex (field 22001)?
 """
 
-
+shm = """
+Directory, ideally on a memory-backed file system like '/dev/shm', for sharing parsed phenotypes between processes. The
+first process publishes the parsed datafields there; later processes extracting the same datafields from the same
+phenotype file map them into memory instead of parsing the file, so concurrent jobs on one node share a single copy.
+Published data is not removed automatically. With '--samples', data types are inferred from all participants.
+"""
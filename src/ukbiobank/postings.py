@@ -0,0 +1,183 @@
+
+
+###########################################################
+#
+# ---%%%  UKBiobank: Inverted index of coded UKB datafields  %%%---
+#
+
+import json
+import logging
+import pathlib
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
+logger = logging.getLogger(__name__)
+
+from phenotool.phenotype import file_identity
+
+
+
+##################################################
+#
+# --%%  CLASS: Postings    %%--
+
+class Postings:
+    """Sidecar inverted index mapping each code of a coded datafield (eg. 20002, 20003 or 41270) to the participants
+carrying it.
+
+For each datafield the index holds the distinct codes and, per code, the sorted participant IDs with the instance and
+array of the cell holding the code. It also holds, per instance, the participants with any non-missing value (ie. not
+NA, -1 or -3). All arrays are stored as .npy files and memory-mapped, so a lookup only reads the postings of the codes
+it asks for. Codes are stored and looked up in one text form (see normalize()).
+"""
+    __name__ = "Postings"
+    MANIFEST = "manifest.json"
+    SUFFIX   = ".postings"
+    VERSION  = 2 # Bump when the stored codes change, so that older indexes are rebuilt
+    MISSING  = ['-1', '-3']
+
+    def __init__(self, path):
+        """path: Directory holding an index previously written by Postings.build()."""
+        self.path = pathlib.Path(path)
+        with open(self.path / self.MANIFEST) as fh:
+            self.manifest = json.load(fh)
+        self._arrays = dict()
+
+    def __getstate__(self):
+        """Pickle without the mapped arrays; they are mapped again on first use."""
+        return {**self.__dict__, '_arrays': dict()}
+
+    @property
+    def fields(self):
+        """Return: The datafields held in the index."""
+        return list(self.manifest['fields'].keys())
+
+    @staticmethod
+    def cell(column):
+        """Return: (field, instance, array) of a UKB column name (eg. 'f.20002.0.1', '20002-0.1' or 'f20002_0_1')."""
+        match = re.match(r"^\D*(\d+)\D(\d+)\D(\d+)$", column)
+        return (match.group(1), int(match.group(2)), int(match.group(3))) if match else None
+
+    @classmethod
+    def sidecar(cls, source):
+        """Return: Location of the index belonging to source; None if source is not a regular file."""
+        identity = file_identity(source)
+        return None if identity is None else pathlib.Path(identity['name'] + cls.SUFFIX)
+
+    @classmethod
+    def build(cls, iterable, fields, *args, **kwargs):
+        """Parse the columns of fields in iterable once and write their inverted index next to it.
+
+        iterable: A UKB main dataset; an open file with a name.
+        fields: The datafields to index.
+        Return: The Postings object for the new index.
+
+        Building again for the same source adds or replaces the given datafields.
+        """
+        path = cls.sidecar(iterable)
+        if path is None:
+            sys.exit(f"{cls.__name__}: Unable to place index for '{getattr(iterable, 'name', iterable)}'; only regular files can be indexed.")
+        identity = file_identity(iterable)
+        fields = [str(field) for field in fields]
+        df = pd.read_csv(iterable, *args, dtype=str, usecols=lambda col: (c := cls.cell(col)) is None or c[0] in fields, **kwargs)
+        df = df.set_index(df.columns[0])
+        manifest = {'source': identity, 'version': cls.VERSION, 'fields': {}}
+        try:
+            old = cls(path)
+            if old.manifest['source'] == identity and old.manifest.get('version') == cls.VERSION:
+                manifest['fields'] = old.manifest['fields']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+        path.mkdir(parents=True, exist_ok=True)
+        ids = pd.to_numeric(df.index, errors='coerce')
+        ids = df.index.to_numpy(dtype=str) if np.isnan(ids).any() else ids.to_numpy(dtype='int64')
+        for field, cols in df.columns.to_series().groupby(lambda col: cls.cell(col)[0] if cls.cell(col) else None, sort=False):
+            cols = cols.to_list()
+            cells = df[cols].to_numpy(dtype=object)
+            rows, colpos = np.nonzero(df[cols].notna().to_numpy())
+            values = cls.normalize(cells[rows, colpos])
+            instance = np.array([cls.cell(col)[1] for col in cols], dtype='int16')[colpos]
+            array = np.array([cls.cell(col)[2] for col in cols], dtype='int16')[colpos]
+            codes, inverse = np.unique(values, return_inverse=True)
+            order = np.lexsort((rows, inverse))
+            arrays = {
+                'codes':    codes,
+                'offsets':  np.searchsorted(inverse[order], np.arange(codes.size + 1)),
+                'eids':     ids[rows[order]],
+                'instance': instance[order],
+                'array':    array[order],
+            }
+            present = ~np.isin(values, cls.MISSING)
+            for inst in np.unique(instance):
+                arrays[f'present_{inst}'] = ids[np.unique(rows[present & (instance == inst)])]
+            for name, arr in arrays.items():
+                np.save(path / f"{field}.{name}.npy", arr)
+            manifest['fields'][field] = {'columns': cols, 'instances': np.unique(instance).tolist()}
+            logger.info(f"{cls.__name__}: Indexed {rows.size} cells with {codes.size} distinct codes in field {field}.")
+        with open(path / cls.MANIFEST, 'w') as fh:
+            json.dump(manifest, fh)
+        return cls(path)
+
+    @classmethod
+    def find(cls, source):
+        """Return: The Postings of source if they exist and are up to date; otherwise None."""
+        if (path := cls.sidecar(source)) is None:
+            return None
+        try: out = cls(path)
+        except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            return None
+        if out.manifest['source'] != file_identity(source):
+            logger.warning(f"{cls.__name__}: Ignoring index '{path}' as it was built from a different version of '{out.manifest['source']['name']}'.")
+            return None
+        if out.manifest.get('version') != cls.VERSION:
+            logger.warning(f"{cls.__name__}: Ignoring index '{path}' as it was built by an older version; please build it again.")
+            return None
+        logger.info(f"{cls.__name__}: Found inverted index '{path}' with fields {out.fields}.")
+        return out
+
+    def _array(self, field, name):
+        """Return: The memory-mapped array 'name' of field."""
+        if (field, name) not in self._arrays:
+            self._arrays[(field, name)] = np.load(self.path / f"{field}.{name}.npy", mmap_mode='r')
+        return self._arrays[(field, name)]
+
+    def cells(self, field):
+        """Return: The set of (instance, array) of the columns of field in the index."""
+        return {self.cell(col)[1:] for col in self.manifest['fields'][field]['columns']}
+
+    @staticmethod
+    def normalize(values):
+        """Return: np.ndarray with values as text in one form, so numbers compare by value as in Phenotype.pkisin(); eg.
+        1065, 1065.0, '1065' and '1065.0' all give '1065' and 2003.5 gives '2003.5'. Other values are kept as text."""
+        text = pd.Series(values, dtype=object).astype(str).str.strip()
+        number = pd.to_numeric(text, errors='coerce').to_numpy(dtype='float64')
+        whole = np.isfinite(number) & (number == np.round(number)) & (np.abs(number) < 2**53)
+        fraction = np.isfinite(number) & ~whole
+        out = text.to_numpy(dtype=object)
+        out[whole] = number[whole].astype('int64').astype(str)
+        out[fraction] = [repr(float(x)) for x in number[fraction]]
+        return out.astype(str)
+
+    def lookup(self, field, values):
+        """Find the cells of field holding any of values. Values are compared as in normalize().
+
+        Return: Tuple of arrays (eids, instance, array) with one entry per matching cell.
+        """
+        codes = self._array(field, 'codes')
+        offsets = self._array(field, 'offsets')
+        idx = np.flatnonzero(np.isin(codes, self.normalize([values] if isinstance(values, str) else list(values))))
+        sel = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in idx]) if idx.size else np.array([], dtype='int64')
+        return self._array(field, 'eids')[sel], self._array(field, 'instance')[sel], self._array(field, 'array')[sel]
+
+    def present(self, field):
+        """Return: dict with the participants having any non-missing value in field for each instance."""
+        return {inst: self._array(field, f'present_{inst}') for inst in self.manifest['fields'][field]['instances']}
+
+# --%%  END: CLASS Postings    %%--
+#
+##################################################
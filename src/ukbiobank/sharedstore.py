@@ -0,0 +1,179 @@
+
+
+###########################################################
+#
+# ---%%%  UKBiobank: Parsed phenotypes shared between processes  %%%---
+#
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newer. Your version appears to be: '{sys.version}'."
+logger = logging.getLogger(__name__)
+
+from phenotool.phenotype import file_identity
+
+
+
+##################################################
+#
+# --%%  CLASS: SharedStore    %%--
+
+class SharedStore:
+    """A parsed phenotype frame published as memory-mapped numpy arrays, typically on a memory-backed file system.
+
+The first process parsing a phenotype file publishes the resulting frame; later processes asking for the same columns
+from the same file map the arrays into memory instead of parsing, so all processes on a node share one copy of the
+data through the page cache. The arrays are mapped read-only and never copied unless a process modifies a column.
+
+Each column is stored as one or more .npy files: numeric and date columns as is, nullable columns as values plus a
+missing mask, period columns as integer ordinals and text, object and categorical columns as integer codes plus their
+distinct values. The manifest keeps the dtype of each column, so the frame is read back with the dtypes and values it
+was written with; distinct values which are not all strings, eg. numbers in an object column, are stored pickled.
+"""
+    __name__ = "SharedStore"
+    MANIFEST = "manifest.json"
+    INDEX    = "index.npy"
+
+    def __init__(self, path):
+        """path: Directory holding a frame previously written by SharedStore.publish()."""
+        self.path = pathlib.Path(path)
+        with open(self.path / self.MANIFEST) as fh:
+            self.manifest = json.load(fh)
+
+    @staticmethod
+    def key(source, **spec):
+        """Return: Name of the store holding the frame parsed from source with the settings in spec."""
+        content = json.dumps({'source': file_identity(source), **spec}, sort_keys=True, default=str)
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    @classmethod
+    def find(cls, source, path, **spec):
+        """Return: The SharedStore in directory path for source and spec if it has been published; otherwise None."""
+        if file_identity(source) is None:
+            return None
+        try: store = cls(pathlib.Path(path) / cls.key(source, **spec))
+        except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            return None
+        logger.info(f"{cls.__name__}: Found published frame '{store.path}'.")
+        return store
+
+    @classmethod
+    def publish(cls, df, source, path, **spec):
+        """Write df to the directory path for later processes asking for source with the same spec.
+
+        The frame is written to a private directory which is then renamed into place, so other processes never see a
+        partial store. If another process published the same frame first, that store is kept.
+        Return: The SharedStore object or None if source is not a regular file.
+        """
+        if file_identity(source) is None:
+            return None
+        return cls.write(df, pathlib.Path(path) / cls.key(source, **spec))
+
+    @classmethod
+    def write(cls, df, final, replace=False):
+        """Write df to the directory final (see publish()).
+
+        replace: Replace a store already in final, eg. a snapshot from an earlier run. Default: Keep it.
+        Return: The SharedStore object.
+        """
+        final = pathlib.Path(final)
+        tmp = final.with_name(f"{final.name}.{os.getpid()}.tmp")
+        tmp.mkdir(parents=True, exist_ok=True)
+        manifest = {'index': df.index.name, 'columns': []}
+        index = df.index.to_numpy()
+        cls._save_values(tmp / cls.INDEX, index)
+        for i, (name, series) in enumerate(df.items()):
+            manifest['columns'].append({'name': name, 'kind': cls._save_column(series, tmp / str(i)), 'dtype': str(series.dtype)})
+        with open(tmp / cls.MANIFEST, 'w') as fh:
+            json.dump(manifest, fh)
+        try:
+            os.rename(tmp, final)
+            logger.info(f"{cls.__name__}: Published {df.columns.size} columns to '{final}'.")
+        except OSError:
+            if replace:
+                old = final.with_name(f"{final.name}.{os.getpid()}.old")
+                os.rename(final, old)
+                os.rename(tmp, final)
+                shutil.rmtree(old, ignore_errors=True)
+                logger.info(f"{cls.__name__}: Replaced '{final}' with {df.columns.size} columns.")
+            else:
+                shutil.rmtree(tmp, ignore_errors=True)
+                logger.info(f"{cls.__name__}: Frame '{final}' was already published by another process.")
+        return cls(final)
+
+    @staticmethod
+    def _save_column(series, stem):
+        """Write series to files starting with stem. Return: The kind of encoding used (see _load_column)."""
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            np.save(f"{stem}.codes.npy", series.cat.codes.to_numpy())
+            SharedStore._save_values(f"{stem}.categories.npy", series.cat.categories.to_numpy())
+            return "categorical"
+        if pd.api.types.is_string_dtype(dtype) or dtype == 'object':
+            codes, uniques = pd.factorize(series)
+            np.save(f"{stem}.codes.npy", codes)
+            SharedStore._save_values(f"{stem}.categories.npy", np.asarray(uniques, dtype=object))
+            return "object"
+        if isinstance(dtype, pd.PeriodDtype):
+            np.save(f"{stem}.values.npy", series.array.asi8)
+            return dtype.name
+        if isinstance(series.array, (pd.arrays.BooleanArray, pd.arrays.IntegerArray, pd.arrays.FloatingArray)):
+            kind = {'b': "boolean", 'i': "integer", 'u': "integer", 'f': "floating"}[dtype.kind]
+            np.save(f"{stem}.values.npy", series.to_numpy(dtype=dtype.numpy_dtype, na_value=False if kind == "boolean" else 0))
+            np.save(f"{stem}.mask.npy", series.isna().to_numpy())
+            return kind
+        np.save(f"{stem}.values.npy", series.to_numpy())
+        return "numpy"
+
+    @staticmethod
+    def _save_values(path, values):
+        """Write the array values to path; an object array of strings as text, other object arrays pickled."""
+        if values.dtype == 'object' and all(isinstance(value, str) for value in values):
+            values = values.astype(str)
+        np.save(path, values, allow_pickle=True)
+
+    @staticmethod
+    def _load_values(path):
+        """Return: The array in path; memory-mapped read-only unless it holds Python objects."""
+        try: return np.load(path, mmap_mode='r')
+        except ValueError:
+            return np.load(path, allow_pickle=True)
+
+    @staticmethod
+    def _load_column(stem, kind, dtype=None):
+        """Return: The column in files starting with stem, memory-mapped read-only where possible.
+        dtype: The dtype the column was written with; restores text and object columns (see _save_column)."""
+        if kind == "categorical":
+            return pd.Categorical.from_codes(np.load(f"{stem}.codes.npy", mmap_mode='r'), SharedStore._load_values(f"{stem}.categories.npy"))
+        if kind == "object":
+            uniques = np.append(SharedStore._load_values(f"{stem}.categories.npy").astype(object), np.nan) # Code -1 is missing
+            values = uniques[np.load(f"{stem}.codes.npy", mmap_mode='r')]
+            return values if dtype in (None, 'object') else pd.array(values, dtype=dtype)
+        values = np.load(f"{stem}.values.npy", mmap_mode='r')
+        if kind == "numpy":
+            return values
+        if kind.startswith("period"):
+            return pd.arrays.PeriodArray(values, dtype=pd.api.types.pandas_dtype(kind))
+        array = {'boolean': pd.arrays.BooleanArray, 'integer': pd.arrays.IntegerArray, 'floating': pd.arrays.FloatingArray}[kind]
+        return array(values, np.load(f"{stem}.mask.npy", mmap_mode='r'))
+
+    def read(self):
+        """Return: pd.DataFrame on top of the memory-mapped arrays."""
+        columns = {col['name']: self._load_column(self.path / str(i), col['kind'], col.get('dtype')) for i, col in enumerate(self.manifest['columns'])}
+        index = pd.Index(self._load_values(self.path / self.INDEX), name=self.manifest['index'])
+        out = pd.DataFrame(columns, index=index, copy=False)
+        logger.debug(f"{self.__name__}: Attached columns {out.columns.to_list()} from '{self.path}'")
+        return out
+
+# --%%  END: CLASS SharedStore    %%--
+#
+##################################################
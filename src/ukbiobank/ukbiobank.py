@@ -2,6 +2,7 @@
 
 import itertools
 import logging
+import numpy as np
 import pandas as pd
 import re
 import sys
@@ -10,6 +11,10 @@ assert sys.version_info >= (3, 8), f"{sys.argv[0]} requires Python 3.8.0 or newe
 logger = logging.getLogger(__name__)
 
 from phenotool import Phenotype
+from phenotool.phenotype import file_identity
+from ukbiobank.cache import UKBCache
+from ukbiobank.postings import Postings
+from ukbiobank.sharedstore import SharedStore
 
 
 
@@ -33,29 +38,154 @@ class UKBioBank(Phenotype):
         "registry": ["f.31.0.0","31-0.0"],
     }
 
-    def __init__(self, iterable, *args, instances=[], phenovars, samples=[], sexcol=None, values=None, **kwargs):
+    # Column dtypes by the 'ValueType' of datafields in the UKB data dictionary (Data_Dictionary_Showcase.tsv).
+    dictionary_dtypes = {
+        "Categorical single":   "category",
+        "Categorical multiple": "category",
+        "Continuous":           "Float32",
+        "Integer":              "Int32",
+        "Text":                 "string",
+    }
+    dictionary_dates = ["Date", "Time"]
+
+    def __init__(self, iterable, *args, cache=None, dictionary=None, instances=[], phenovars, samples=[], selectors=[], sexcol=None, shm=None, values=None, **kwargs):
         """
         iterable: An iterable with data...
+        cache: Directory with a columnar cache of iterable (see UKBCache). Default: Use the cache next to iterable if any.
+        dictionary: The UKB data dictionary (Data_Dictionary_Showcase.tsv). If given, columns are parsed directly into the dtype of their datafield.
         phenovars: The UKBiobank datafield(s) to extract. (Named for compatibility with ancestor classes).
+        selectors: Datafields, instances or arrays needed by later processing but not for output (see plan()). Columns
+          read only for these are listed in self.helpers and left out of the output.
+        shm: Directory for sharing the parsed data with other processes (see SharedStore). Default: Do not share.
         """
 # NOTE: The second digit in datafields is called an 'instance'.
 # NOTE: The third is the 'array index'.
         self.MAGIC_COLS[self.mkey_sex] = self.sex_dict.get(sexcol, [])
-        if instances:
-            phenovars = [f"{p}\D[{''.join(instances)}]" for p in phenovars]
-        col_fun = lambda x: any([re.match(f'(f\D|){p}\D', x) for p in phenovars] + [x in list(itertools.chain.from_iterable(self.MAGIC_COLS.values()))])
-        super().__init__(iterable, *args, usecols=col_fun, phenovars=phenovars, samples=samples, **kwargs)
+        self.source = file_identity(iterable)
+        output = self.plan(phenovars, instances=instances)
+        phenovars = self.plan(phenovars, selectors, instances=instances)
+        self._postings = Postings.find(iterable)
+        spec = {'phenovars': phenovars, 'sexcol': sexcol, 'dictionary': file_identity(dictionary) if dictionary else None}
+        share = shm and not kwargs.get('nrows') # The shared frame holds all samples; they are selected after publishing
+        shared = SharedStore.find(iterable, shm, **spec) if share else None
+        col_fun = self.colselector(phenovars, itertools.chain.from_iterable(self.MAGIC_COLS.values()))
+        store = UKBCache.find(iterable, cache)
+        if shared is not None:
+            logger.info(f"{self.__name__}: Reading datafields {phenovars} from the frame published in '{shared.path}'.")
+            self.df = shared.read()
+            Phenotype._validate(self)
+        elif store is not None and store.covers(col_fun):
+            logger.info(f"{self.__name__}: Reading datafields {phenovars} from cache '{store.path}'.")
+            super().__init__(store.read(col_fun, nrows=kwargs.get('nrows')), phenovars=phenovars, samples=[] if share else samples)
+        else:
+            if dictionary is not None:
+                kwargs.update(self.schema(dictionary, self.peek_columns(iterable, usecols=col_fun, dialect=kwargs.get('dialect'))))
+            self._typed = list(kwargs.get('dtype', {}).keys()) + kwargs.get('parse_dates', [])
+            super().__init__(iterable, *args, usecols=col_fun, phenovars=phenovars, samples=[] if share else samples, **kwargs)
+        if share and shared is None:
+            SharedStore.publish(self.df, iterable, shm, **spec)
+        if share and samples:
+            self.samples = samples
+        self.helpers = [col for col in self.field2cols(phenovars) if col not in self.field2cols(output)]
+        if self.helpers:
+            logger.info(f"{self.__name__}: Read {len(self.helpers)} helper columns for later processing; these are not output.")
 
     def _conform_columns(self, columns=[]):
         """Overloads generic to set standardized names of ukb columns regardless of tab/csv origin.
         """
-        self = super()._conform_columns(columns=columns)
+        self = super()._conform_columns(columns=columns, typed=getattr(self, '_typed', []))
         patone = re.compile("f\.")
         pattwo = re.compile("[-.]")
         self.df = self.df.rename(columns=lambda label: pattwo.sub("_",patone.sub('f',label)))
         logger.debug(f"UKBioBank: Renamed columns {list(self._obj.columns)}")
         return self
 
+    @staticmethod
+    def colselector(phenovars, magic=[]):
+        """Return: Callable selecting the columns of the datafields in phenovars and any column named in magic. For pd.read_csv(usecols=...)."""
+        magic = list(magic)
+        return lambda x: any([re.match(f'(f\D|){p}(?!\d)', x) for p in phenovars] + [x in magic])
+
+    @staticmethod
+    def peek_columns(iterable, usecols=None, dialect=None):
+        """Return: The names of the columns selected by usecols in the header of iterable, which is then rewound. Empty if iterable cannot be rewound."""
+        if dialect is None or not hasattr(iterable, 'seek'):
+            logger.warning(f"UKBioBank: Unable to read the header of '{getattr(iterable, 'name', iterable)}' in advance; ignoring the data dictionary.")
+            return []
+        columns = pd.read_csv(iterable, nrows=0, usecols=usecols, dialect=dialect).columns.to_list()
+        iterable.seek(0)
+        return columns
+
+    @classmethod
+    def schema(cls, dictionary, columns):
+        """Look up the ValueType of the datafields of columns in the UKB data dictionary.
+
+        dictionary: The data dictionary (Data_Dictionary_Showcase.tsv); file name or open file.
+        columns: UKB column names as found in the header of the phenotype file.
+        Return: dict with keyword arguments for pd.read_csv; ie. 'dtype', 'parse_dates' and 'date_format'.
+
+        Continuous fields using data coding 13 (pseudo-dates as decimal years) are kept in Float64 to keep the month.
+        """
+        types = pd.read_csv(dictionary, sep='\t', usecols=['FieldID', 'ValueType', 'Coding'], dtype=str).set_index('FieldID')
+        types = types[~types.index.duplicated()]
+        dtype, dates = dict(), list()
+        for col in columns:
+            field = UKBCache.field(col)
+            if field not in types.index:
+                continue
+            valuetype, coding = types.at[field, 'ValueType'], types.at[field, 'Coding']
+            if valuetype in cls.dictionary_dates:
+                dates.append(col)
+            elif valuetype == "Continuous" and coding == "13":
+                dtype[col] = "Float64"
+            elif valuetype in cls.dictionary_dtypes:
+                dtype[col] = cls.dictionary_dtypes[valuetype]
+        logger.info(f"UKBioBank: Data dictionary gives dtypes for {len(dtype) + len(dates)} of {len(columns)} columns.")
+        logger.debug(f"UKBioBank: dtypes = {dtype}; dates = {dates}")
+        return {'dtype': dtype, 'parse_dates': dates, 'date_format': 'ISO8601'}
+
+    @staticmethod
+    def phenovars_instances(phenovars, instances=[]):
+        """Return: phenovars as regular expressions restricted to the given instances."""
+        if instances:
+            phenovars = [f"{p}\D[{''.join(instances)}]" for p in phenovars]
+        return phenovars
+
+    @staticmethod
+    def selector(spec):
+        """Parse a UKB column selector: 'field', 'field-instance' or 'field-instance.array' (eg. '20002', '2976-0' or
+        '20002-0.1'). Any non-digit separates the parts, so '2976_0' works as well.
+        Return: Tuple (field, instance, array) with None for the parts not given; None if spec is not a selector."""
+        match = re.match(r"^(\d+)(?:\D(\d+)(?:\D(\d+))?)?$", str(spec))
+        return match.groups() if match else None
+
+    @classmethod
+    def plan(cls, phenovars, selectors=[], instances=[]):
+        """Merge the datafields to output and the selectors registered by later processing into the minimal list of
+        patterns to read.
+
+        phenovars: The datafields to output. With instances, datafields are restricted to those instances.
+        selectors: Further selectors (see selector()) needed by later processing, eg. ['53', '2976-0'].
+        Return: List of regular expressions for colselector() and field2cols(). A selector is left out if a broader
+          one covers it (eg. '2976-0' when all of '2976' is read). Entries which are not selectors are kept as is.
+        """
+        out, sels = [], []
+        for spec in phenovars:
+            sel = cls.selector(spec)
+            if sel is None:
+                out.extend(cls.phenovars_instances([spec], instances))
+            elif instances and sel[1] is None:
+                sels.extend([(sel[0], str(instance), None) for instance in instances])
+            else:
+                sels.append(sel)
+        sels.extend([sel for sel in map(cls.selector, selectors) if sel is not None])
+        covers = lambda a, b: a[0] == b[0] and all([x is None or x == y for x, y in zip(a[1:], b[1:])])
+        sels = list(dict.fromkeys(sels))
+        sels = [sel for sel in sels if not any([other != sel and covers(other, sel) for other in sels])]
+        out.extend(["\\D".join([part for part in sel if part is not None]) for sel in sels])
+        logger.debug(f"plan: phenovars={phenovars}; selectors={selectors}; instances={instances}; Reading {out}")
+        return out
+
     @property
     def sex(self):
         """Returns the SEX in a systematic way (male/female) for querying."""
@@ -78,19 +208,41 @@ class UKBioBank(Phenotype):
 
     def dc13toDate(self, fields):
         """Convert pseudo-dates in data coding 13 format to pythonic dates for specified fields.
-        Return: Copy of self where 'fields' are converted."""
-        def asPeriod(value):
-            try:
-                value = pd.NA if int(value) in [-1, -3] else pd.Period(freq='M', year=int(value), month=value %1 * 12)
-            except TypeError:
-                pass
-            return value
-
-        mycols = self.field2cols('20008')
-        self[mycols] = self[mycols]._obj.applymap(asPeriod)
-        logger.debug(f"dc13toDate: Converted subset (firstrow) = {self[mycols]._obj.iloc[0].to_list()}")
+        Return: self where 'fields' are converted in place. Columns converted before are left as is."""
+        mycols = self.field2cols(fields)
+        for col in mycols:
+            self[col] = self.dc13toPeriod(self._obj[col])
+        logger.debug(f"dc13toDate: Converted subset (firstrow) = {self[mycols]._obj.iloc[0].to_list() if mycols else []}")
         return self
 
+    @staticmethod
+    def dc13toPeriod(values):
+        """Convert a column of decimal years (data coding 13, eg. 1998.5) to monthly periods.
+
+        The month is the truncated fraction of the year times 12, where 0 falls in December of the year before (as with
+        pd.Period(year=, month=)). The codes -1 (Unknown) and -3 (Prefer not to answer) and non-numeric values become NaT.
+        Return: pd.Series with dtype period[M]; values which are periods already are returned unchanged.
+        """
+        if isinstance(values.dtype, pd.PeriodDtype):
+            return values
+        years = pd.to_numeric(values, errors='coerce').astype('float64').to_numpy()
+        missing = np.isnan(years) | np.isin(np.trunc(years), [-1, -3])
+        years = np.where(missing, 1970, years)
+        months = (np.trunc(years) - 1970) * 12 + np.trunc(years % 1 * 12) - 1
+        ordinals = np.where(missing, pd.NaT.value, months.astype('int64'))
+        return pd.Series(pd.arrays.PeriodArray(ordinals, dtype='period[M]'), index=values.index, name=values.name)
+
+    def __setitem__(self, key, value):
+        """Like super() but drops the value index (see valueindex())."""
+        self._valueindex = None
+        super().__setitem__(key, value)
+
+    def __getstate__(self):
+        """Like super() but without the value index, which is rebuilt on first use (eg. when sent to another process)."""
+        state = self.__dict__.copy()
+        state.pop('_valueindex', None)
+        return state
+
     def drop(self, labels=None, index=None, columns=None, *args, **kwargs):
         if labels is not None:
             labels = self.field2cols(labels)
@@ -107,31 +259,173 @@ class UKBioBank(Phenotype):
         """Find all column names containing 'field' using regex."""
         if isinstance(fields, str):
             fields = [fields]
-        fields = [f"^\D*{field}\D" for field in fields]
+        fields = [f"^\D*{field}(?!\d)" for field in fields]
         return super().field2cols(fields)
 
     def findinfield(self, fields, values, instances=None, *args, mask=None):
         """Find value in indicated fields.
 
         fields: The field(s) to search through. Forwarded to field2cols.
-        values: The value(s) to search for. Forwarded to pkisin.
-        instances: A pd.Series with same index as self holding the instances to use.
-        mask: An optional mask to apply before search. Forwarded to pd.mask()
+        values: The value(s) to search for. Compared as in pkisin.
+        instances: A boolean pd.DataFrame (participants x instances) with True for the instances to use, eg. from
+          instancematrix(). A pd.Series holding a list of instances per participant is also accepted.
+        mask: An optional mask to apply before search. A DataFrame like self[fields] with True for cells to ignore.
 
-        Return: A pd.Series with True/False for each row describing if row contained the value.
+        Return: A pd.Series with True/False for each row describing if row contained the value. Rows with no data left
+          in fields after masking are NA.
 
         Note: It seems -1 and -3 are consistently used to indicate 'missing' in UKB. This is implemented here.
+        Note: The search runs on the value index of fields (see valueindex()), not on the wide frame.
         """
         # Ok, here's a serious bug. Value 'NA' in UKB doesn't mean 'pd.NA', rather it means False.
-        mymask = self[self.field2cols(fields)].pkisin(['-1','-3'])
+        out = pd.Series(pd.NA, index=self.index, dtype='boolean')
+        cols = self.field2cols(fields)
+        if not cols:
+            return out
+        if mask is None:
+            hits, known = self.findininstances(fields, values)
+            if instances is not None:
+                instances = pd.DataFrame(self.instancematrix(instances, known.columns), index=self.index, columns=known.columns)
+            return self.ininstances(hits, known, instances)
+        vindex = self.valueindex(cols)
+        uniques = pd.Index(vindex['uniques'])
+        found = uniques.isin(self.pkvalues(values))[vindex['codes']]
+        valid = ~uniques.isin(self.pkvalues(['-1', '-3']))[vindex['codes']]
         if instances is not None:
-            df = self[self.field2cols(fields)]
-            mymask = mymask | ~pd.DataFrame([pd.Series(df.columns, index=df.columns).str.contains(f"_{'_|_'.join(i)}_") for i in instances], index=instances.index)
-        if mask is not None:
-            mymask = mymask | mask
-        out = super().findinfield(fields=fields, values=values, *args, mask=mymask)
+            labels = pd.Index(vindex['instances']).unique()
+            allowed = self.instancematrix(instances, labels)
+            valid &= allowed[vindex['rows'], labels.get_indexer(vindex['instances'])[vindex['cols']]]
+        valid &= ~mask.reindex(index=self.index, columns=cols, fill_value=False).fillna(False).to_numpy(dtype=bool)[vindex['rows'], vindex['cols']]
+        hits, known = np.zeros(self.index.size, dtype=bool), np.zeros(self.index.size, dtype=bool)
+        hits[vindex['rows'][found]] = True
+        known[vindex['rows'][valid]] = True
+        out[known] = hits[known]
+        logger.debug(f"findinfield: Scanning {fields} for values={values}; Found {hits.sum()} rows, {(~known).sum()} without data.")
         return out
 
+    def findininstances(self, fields, values):
+        """The search of findinfield() before any instances are selected. Select instances with ininstances(); the
+        search can then be shared by several selections, eg. one per baseline date.
+
+        Return: Tuple (hits, known); np.ndarray with True for rows holding any of values in fields and a boolean
+          pd.DataFrame (rows of self x instances) with True where the row has data (ie. not -1 or -3) in the instance.
+        """
+        cols = self.field2cols(fields)
+        if not cols:
+            return np.zeros(self.index.size, dtype=bool), pd.DataFrame(index=self.index, dtype=bool)
+        if (postings := self.postings(fields)) is not None:
+            return self._findinpostings(postings, fields, values)
+        vindex = self.valueindex(cols)
+        uniques = pd.Index(vindex['uniques'])
+        found = uniques.isin(self.pkvalues(values))[vindex['codes']]
+        valid = ~uniques.isin(self.pkvalues(['-1', '-3']))[vindex['codes']]
+        labels = pd.Index(vindex['instances']).unique()
+        hits, known = np.zeros(self.index.size, dtype=bool), np.zeros((self.index.size, labels.size), dtype=bool)
+        hits[vindex['rows'][found]] = True
+        known[vindex['rows'][valid], labels.get_indexer(vindex['instances'])[vindex['cols'][valid]]] = True
+        logger.debug(f"findinfield: Scanning {fields} for values={values}; Found {hits.sum()} rows, {(~known.any(axis=1)).sum()} without data.")
+        return hits, pd.DataFrame(known, index=self.index, columns=labels)
+
+    @staticmethod
+    def ininstances(hits, known, instances=None):
+        """Select instances in the result of findininstances().
+
+        instances: A boolean pd.DataFrame (participants x instances) with True for the instances to use. Default: All.
+        Return: A pd.Series like findinfield(); True/False for rows with data in the selected instances, otherwise NA.
+        """
+        present = known.to_numpy(dtype=bool)
+        if instances is not None:
+            present = present & instances.rename(columns=str).reindex(index=known.index, columns=known.columns, fill_value=False).fillna(False).to_numpy(dtype=bool)
+        present = present.any(axis=1)
+        out = pd.Series(pd.NA, index=known.index, dtype='boolean')
+        out[present] = hits[present]
+        return out
+
+    def _findinpostings(self, postings, fields, values):
+        """findininstances() using the inverted index of fields; see postings()."""
+        labels = pd.Index(sorted({inst for cells in postings.values() for (inst, arr) in cells}))
+        hits, known = np.zeros(self.index.size, dtype=bool), np.zeros((self.index.size, labels.size), dtype=bool)
+        for field, cells in postings.items():
+            frame_instances = {inst for (inst, arr) in cells}
+            eids, inst, _ = self._postings.lookup(field, values)
+            rows = self._eid2row(eids[np.isin(inst, list(frame_instances))])
+            hits[rows[rows >= 0]] = True
+            for i, eids in self._postings.present(field).items():
+                if i not in frame_instances:
+                    continue
+                rows = self._eid2row(eids)
+                known[rows[rows >= 0], labels.get_loc(i)] = True
+        logger.debug(f"findinfield: Looked up {fields} for values={values} in '{self._postings.path}'; Found {hits.sum()} rows, {(~known.any(axis=1)).sum()} without data.")
+        return hits, pd.DataFrame(known, index=self.index, columns=labels.astype(str))
+
+    def instancematrix(self, instances, labels=None):
+        """Align the instances to use for each participant with self.
+
+        instances: A boolean pd.DataFrame (participants x instances) or a pd.Series with a list of instances per participant.
+        labels: The instances (as str) to return. Default: The instances in 'instances'.
+        Return: np.ndarray of bools (rows of self x labels); False for participants and instances not in 'instances'.
+        """
+        if isinstance(instances, pd.Series):
+            exploded = instances.explode().dropna().astype(str)
+            columns = pd.Index(exploded.unique())
+            matrix = np.zeros((instances.index.size, columns.size), dtype=bool)
+            matrix[instances.index.get_indexer(exploded.index), columns.get_indexer(exploded)] = True
+            instances = pd.DataFrame(matrix, index=instances.index, columns=columns)
+        instances = instances.rename(columns=str)
+        labels = instances.columns if labels is None else labels
+        return instances.reindex(index=self.index, columns=labels, fill_value=False).fillna(False).to_numpy(dtype=bool)
+
+    def _eid2row(self, eids):
+        """Return: Row positions in self of the participant IDs eids; -1 for IDs not in self."""
+        eids = pd.Index(eids)
+        try: eids = eids.astype(self.index.dtype)
+        except (TypeError, ValueError):
+            pass
+        return self.index.get_indexer(eids)
+
+    def postings(self, fields):
+        """Check if the inverted index of the phenotype file (see Postings) can answer queries on fields.
+
+        The index can be used if it holds all fields and self holds either all or none of the columns of each instance
+        of the field in the index (ie. the frame was not restricted to a subset of arrays).
+        Return: dict with the (instance, array) cells in self for each field; None if the index cannot be used.
+        """
+        if getattr(self, '_postings', None) is None:
+            return None
+        out = dict()
+        for field in [fields] if isinstance(fields, str) else fields:
+            if str(field) not in self._postings.fields:
+                return None
+            cells = {Postings.cell(col)[1:] for col in self.field2cols(field)}
+            indexed = self._postings.cells(str(field))
+            if not cells <= indexed or any([{c for c in indexed if c[0] == inst} - cells for (inst, arr) in cells]):
+                return None
+            out[str(field)] = cells
+        return out
+
+    def valueindex(self, cols):
+        """Long-format index of the non-missing cells in cols for fast lookup of values. Built on first use and kept
+        until the frame is replaced or assigned to through self[...].
+
+        Return: dict with the row and column position (in cols) of each cell, its value as a code into 'uniques' and
+          the instance of each column in cols.
+        """
+        if getattr(self, '_valueindex', None) is None or self._valueindex[0] is not self._obj:
+            self._valueindex = (self._obj, dict())
+        key = tuple(cols)
+        if key not in self._valueindex[1]:
+            rows, colpos, values = [], [], []
+            for i, col in enumerate(cols):
+                notna = self._obj[col].notna().to_numpy()
+                rows.append(np.flatnonzero(notna))
+                colpos.append(np.full(rows[-1].size, i))
+                values.append(self._obj[col].to_numpy(dtype=object)[notna])
+            codes, uniques = pd.factorize(np.concatenate(values))
+            instances = [re.sub(r'^\D*\d+\D(\d+)\D.*$', r'\1', col) for col in cols]
+            self._valueindex[1][key] = {'rows': np.concatenate(rows), 'cols': np.concatenate(colpos), 'codes': codes, 'uniques': uniques, 'instances': instances}
+            logger.debug(f"valueindex: Indexed {codes.size} cells with {uniques.size} distinct values in {len(cols)} columns.")
+        return self._valueindex[1][key]
+
     def findinterpolated(self, field, other, values):
         """Perform lookup in UKB interpolated data
 
@@ -140,11 +434,23 @@ class UKBioBank(Phenotype):
         values: The values to find in other.
 
         Return: A pandas obj with values from field corresponding to values were found in other.
+
+        Note: With an inverted index of other (see postings()), cells are paired on instance and array; otherwise on
+          column order.
         """
         cols1 = self.field2cols(field)
-        cols2 = self.field2cols(other)
-        mask = self[cols2].pkisin(values)
-        mask = mask.rename(columns=dict(zip(cols2,cols1)))
+        if self.postings(other) is not None:
+            eids, inst, arr = self._postings.lookup(str(other), values)
+            colpos = pd.Index([Postings.cell(col)[1:] for col in cols1]).get_indexer(list(zip(inst, arr))) if len(eids) else np.array([], dtype=int)
+            rows = self._eid2row(eids)
+            keep = (rows >= 0) & (colpos >= 0)
+            mask = np.zeros((self.index.size, len(cols1)), dtype=bool)
+            mask[rows[keep], colpos[keep]] = True
+            mask = pd.DataFrame(mask, index=self.index, columns=cols1)
+        else:
+            cols2 = self.field2cols(other)
+            mask = self[cols2].pkisin(values)
+            mask = mask.rename(columns=dict(zip(cols2,cols1)))
         out = self._obj[cols1].mask(~mask, other=pd.NA)
         out = out.mask(out.isin([-1,-3,'-1','-3']), other=pd.NA).dropna(axis='columns', how='all')
         logger.debug(f"findinterpolated: field={field}; other={other}; values={values}; return={out.to_dict()}")
@@ -0,0 +1,36 @@
+import pytest
+
+
+@pytest.fixture
+def newline():
+    """Line ending of phenofile; override in a test module to write others."""
+    return "\n"
+
+
+@pytest.fixture
+def phenofile(tmp_path, table, newline):
+    """A tab separated UKB main dataset holding 'table'; a list of rows with the header first, given by each test module
+    as the fixture 'table'."""
+    path = tmp_path / "ukb.tab"
+    path.write_bytes((newline.join("\t".join(row) for row in table) + newline).encode())
+    return path
+
+
+@pytest.fixture
+def parse(phenofile):
+    """Return: A function parsing phenofile with UKBioBank as the command line does; keyword arguments are passed on."""
+    import pklib.pkcsv as csv
+    from ukbiobank.ukbiobank import UKBioBank
+    def parse(phenovars, **kwargs):
+        with open(phenofile) as fh:
+            return UKBioBank(fh, dialect=csv.sniff(fh), phenovars=phenovars, **kwargs)
+    return parse
+
+
+@pytest.fixture
+def build(phenofile):
+    """Return: A function building an index or cache of phenofile with cls.build(), eg. UKBCache, RowIndex or Postings."""
+    def build(cls, *args, **kwargs):
+        with open(phenofile) as fh:
+            return cls.build(fh, *args, **kwargs)
+    return build
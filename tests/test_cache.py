@@ -0,0 +1,69 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+pytest.importorskip("pyarrow")
+
+from ukbiobank.cache import UKBCache
+from ukbiobank.ukbiobank import UKBioBank
+
+
+PHENOVARS = ["31", "20002", "41270"]
+
+
+@pytest.fixture
+def table():
+    return [
+        ["f.eid", "f.31.0.0", "f.20002.0.0", "f.20002.0.1", "f.20002.1.0", "f.41270.0.0"],
+        ["1000001", "1", "1220", "1065", "1223", "E119"],
+        ["1000002", "2", "NA", "NA", "1222", "NA"],
+        ["1000003", "1", "1065", "NA", "NA", "I10"],
+    ]
+
+
+def cache(build, phenofile, phenovars):
+    return build(UKBCache, phenofile.parent / "cache", sep="\t", usecols=UKBioBank.colselector(phenovars, ["f.eid", "f.31.0.0"]))
+
+
+def test_cached_read_equals_parse(phenofile, build, parse, caplog):
+    cache(build, phenofile, PHENOVARS)
+    parsed = parse(PHENOVARS)
+    with caplog.at_level("INFO", logger="ukbiobank.ukbiobank"):
+        cached = parse(PHENOVARS, cache=phenofile.parent / "cache")
+    assert "from cache" in caplog.text
+    pd.testing.assert_frame_equal(cached.df, parsed.df)
+
+
+def test_covers_only_the_columns_stored(phenofile, build):
+    store = cache(build, phenofile, UKBioBank.plan(['20002'], instances=['0']))
+    assert store.manifest['header']['20002'] == ["f.20002.0.0", "f.20002.0.1", "f.20002.1.0"]
+    assert store.covers(UKBioBank.colselector(UKBioBank.plan(['20002'], instances=['0'])))
+    assert not store.covers(UKBioBank.colselector(['20002']))
+
+
+def test_covers_after_adding_columns(phenofile, build):
+    cache(build, phenofile, UKBioBank.plan(['20002'], instances=['0']))
+    store = cache(build, phenofile, ['20002'])
+    assert store.covers(UKBioBank.colselector(['20002']))
+
+
+def test_store_without_header_is_not_used(phenofile, build):
+    store = cache(build, phenofile, ['20002'])
+    del store.manifest['header']
+    assert not store.covers(UKBioBank.colselector(['20002']))
+
+
+# A wide file longer than one chunk of read_csv, so that 41270 is parsed as numbers in the first chunk and text after
+WIDE = [["f.eid", "f.31.0.0", "f.41270.0.0"] + [f"f.{field}.0.0" for field in range(100000, 100300)]]
+WIDE += [[str(1000001 + row), "1", "1" if row < 5000 else "E119"] + ["1"] * 300 for row in range(5010)]
+
+
+@pytest.mark.parametrize("table", [WIDE], ids=["mixed"])
+@pytest.mark.filterwarnings("ignore::pandas.errors.DtypeWarning")
+def test_cached_mixed_column_equals_parse(phenofile, build, parse):
+    parsed = parse(["31", "41270"])
+    assert set(parsed.df["f41270_0_0"].map(type)) == {int, str}
+    store = cache(build, phenofile, ["31", "41270"])
+    assert store.manifest['mixed']['41270'] == ["f.41270.0.0"]
+    cached = parse(["31", "41270"], cache=phenofile.parent / "cache")
+    pd.testing.assert_frame_equal(cached.df, parsed.df)
@@ -0,0 +1,179 @@
+import copy
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+pytestmark = pytest.mark.filterwarnings("error::pandas.errors.SettingWithCopyWarning") # The row subsets of _subset() must not be views
+
+from eastwood.cli import memo_prevalence
+from eastwood.eastwood import Incidence, Prevalence
+from phenotool.phenotype import read_files
+from ukbiobank.sharedstore import SharedStore
+from ukbiobank.ukbiobank import UKBioBank
+
+
+N = 40
+
+
+def coded(rng, cols, field, instances, arrays, choices, p_na=0.5):
+    for i in range(instances):
+        for a in range(arrays):
+            values = rng.choice(choices, N).astype(object)
+            values[rng.random(N) < p_na] = None
+            cols[f"f.{field}.{i}.{a}"] = values
+
+
+def synthetic():
+    """Return: A UKB frame where the first half of the samples have no diagnoses, so a shard of them finds no dates."""
+    rng = np.random.default_rng(1)
+    cols = {"f.eid": np.arange(1000001, 1000001 + N), "f.31.0.0": rng.choice([0, 1], N)}
+    for i in range(2):
+        cols[f"f.53.{i}.0"] = (pd.Timestamp("2006-01-01") + pd.to_timedelta(rng.integers(0, 365 * 12, N), unit="D")).astype(str)
+    coded(rng, cols, 21000, 1, 1, [1001, 3001, 4001, 2001, -1], 0.05)
+    coded(rng, cols, 4041, 2, 1, [0, 1, -1])
+    coded(rng, cols, 2976, 2, 1, [20, 35, 50, -1])
+    coded(rng, cols, 2986, 2, 1, [0, 1, -1])
+    coded(rng, cols, 6153, 2, 2, [1, 2, 3, -1])
+    coded(rng, cols, 6177, 2, 2, [1, 2, 3, -1])
+    coded(rng, cols, 20002, 2, 2, [1220, 1221, 1222, 1223, 1065], 0.4)
+    coded(rng, cols, 20003, 2, 2, [1140883066, 1140884600, 1141171646, 123], 0.6)
+    coded(rng, cols, 20008, 2, 2, [1995.5, 2003.5, 2009.5, 2012.5, -1], 0.2)
+    coded(rng, cols, 20009, 2, 2, [25.5, 40.5, 55.5, -1], 0.2)
+    coded(rng, cols, 41270, 1, 3, ["E100", "E112", "E119", "E149", "I10"], 0.4)
+    for a in range(3):
+        dates = (pd.Timestamp("1998-01-01") + pd.to_timedelta(rng.integers(0, 365 * 20, N), unit="D")).astype(str).to_numpy(dtype=object)
+        dates[pd.isna(cols[f"f.41270.0.{a}"])] = None
+        cols[f"f.41280.0.{a}"] = dates
+    df = pd.DataFrame(cols)
+    df.loc[: N // 2 - 1, [col for col in df.columns if col.startswith(("f.20002.", "f.41270.", "f.41280."))]] = None
+    return df
+
+
+def release(df):
+    """Return: The next release of df; one subject withdrawn, one added and the diagnoses of two others changed."""
+    df = df.copy()
+    df.loc[N // 2 + 1, "f.20002.0.0"] = 1223 if df.loc[N // 2 + 1, "f.20002.0.0"] != 1223 else 1222
+    df.loc[N - 1, "f.41270.0.0"], df.loc[N - 1, "f.41280.0.0"] = "E112", "2001-02-03"
+    added = df.iloc[[N // 2 + 2]].assign(**{"f.eid": 2000001})
+    return pd.concat([df.drop(index=N // 2 + 3), added], ignore_index=True)
+
+
+def ukbfile(path, df):
+    df.to_csv(path, sep="\t", index=False, na_rep="NA")
+    return path
+
+
+@pytest.fixture
+def phenofile(tmp_path):
+    return ukbfile(tmp_path / "ukb.tab", synthetic())
+
+
+def read(phenofile, **kwargs):
+    with open(phenofile) as fh:
+        pheno, = read_files(UKBioBank, [fh], phenovars=[], selectors=Prevalence.UKBioFields, **kwargs)
+    return pheno
+
+
+def prevalence(phenofile, jobs=1, **kwargs):
+    return Prevalence(read(phenofile, **kwargs.pop('read', {})), baseline=Prevalence.UKBbaseline, jobs=jobs, **kwargs)
+
+
+def test_sharded_equals_serial(phenofile):
+    serial, sharded = prevalence(phenofile, 1), prevalence(phenofile, 2)
+    assert isinstance(serial.dm['date_anydm_ni'].dtype, pd.PeriodDtype)
+    assert serial.dm['date_anydm_ni'].notna().any() and serial.dm['date_anydm_ip'].notna().any()
+    pd.testing.assert_frame_equal(sharded.dm, serial.dm)
+    pd.testing.assert_series_equal(sharded._prevalence, serial._prevalence)
+    pd.testing.assert_series_equal(sharded.prevalence, serial.prevalence)
+
+
+def test_snapshot_equals_full(tmp_path, caplog):
+    snapshot = tmp_path / "snapshot"
+    first = prevalence(ukbfile(tmp_path / "ukb1.tab", synthetic()), snapshot=snapshot)
+    second = ukbfile(tmp_path / "ukb2.tab", release(synthetic()))
+    with caplog.at_level("INFO", logger="eastwood.eastwood"):
+        updated = prevalence(second, snapshot=snapshot)
+    assert f"Loaded {N - 3} unchanged subjects" in caplog.text
+    full = prevalence(second)
+    pd.testing.assert_frame_equal(updated.dm, full.dm)
+    pd.testing.assert_series_equal(updated._prevalence, full._prevalence)
+    assert updated._snapshotpath() == first._snapshotpath()
+
+
+def test_cache_hit_refreshes_snapshot(tmp_path):
+    cache, snapshot = tmp_path / "cache", tmp_path / "snapshot"
+    first, second = ukbfile(tmp_path / "ukb1.tab", synthetic()), ukbfile(tmp_path / "ukb2.tab", release(synthetic()))
+    prevalence(first, cache=cache, snapshot=snapshot)
+    prevalence(second, snapshot=snapshot)
+    again = prevalence(first, cache=cache, snapshot=snapshot)
+    assert again._features is False # From the cache
+    stored = SharedStore(again._snapshotpath()).read()
+    assert stored.index.equals(again.dm.index)
+    assert np.array_equal(stored['_input'].to_numpy(), again._rowhashes())
+
+
+def test_snapshot_depends_on_parse_settings(tmp_path, phenofile):
+    dictionary = tmp_path / "dictionary.tsv"
+    dictionary.write_text("FieldID\tValueType\tCoding\n20008\tContinuous\t13\n20002\tCategorical multiple\t6\n53\tDate\t\n")
+    parsed = prevalence(phenofile, snapshot=tmp_path / "snapshot")
+    typed = prevalence(phenofile, snapshot=tmp_path / "snapshot", read={'dictionary': dictionary})
+    assert typed._inputtypes() != parsed._inputtypes()
+    assert typed._snapshotpath() != parsed._snapshotpath()
+
+
+def test_incidence_leaves_prevalence_as_is(phenofile):
+    prev = prevalence(phenofile)
+    dm, found, agediag = prev.dm.copy(), dict(prev._found), dict(prev._agediag)
+    incidence = Incidence(prev=prev)
+    incidence._found['extra'], incidence._agediag['extra'] = found['t1dm_ni'], agediag['ts']
+    incidence.atbaseline(pd.Timestamp("2014-01-01"))
+    assert prev.baseline == Prevalence.UKBbaseline
+    pd.testing.assert_frame_equal(prev.dm, dm)
+    assert prev._found == found and prev._agediag.keys() == agediag.keys()
+
+
+def test_memo_keys_on_the_inputs(phenofile, tmp_path):
+    obj, pheno = dict(), prevalence(phenofile)._pheno
+    first = memo_prevalence(obj, pheno, Prevalence.UKBbaseline)
+    assert memo_prevalence(obj, pheno, Prevalence.UKBbaseline) is first
+    assert memo_prevalence(obj, pheno, Prevalence.UKBbaseline, snapshot=tmp_path / "snapshot") is not first
+    assert memo_prevalence(obj, copy.copy(pheno), Prevalence.UKBbaseline) is first # Same file, columns and samples
+    subset = prevalence(phenofile, read={'samples': ["1000001", "1000030"]})._pheno
+    assert memo_prevalence(obj, subset, Prevalence.UKBbaseline) is not first
+    moved = memo_prevalence(obj, pheno, pd.Timestamp("2014-01-01"))
+    assert moved is first and moved.baseline == pd.Timestamp("2014-01-01")
+    assert len(obj['eastwood']) == 3
+
+
+def test_sweep_restores_the_baseline_state(phenofile):
+    prev = prevalence(phenofile)
+    dm, before = prev.dm.copy(), prev.prevalence.copy()
+    baselines = [Prevalence.UKBbaseline, pd.Timestamp("2014-01-01"), pd.Timestamp("2020-01-01")]
+    out = prev.sweep(baselines)
+    assert prev.baseline == Prevalence.UKBbaseline
+    pd.testing.assert_frame_equal(prev.dm, dm)
+    pd.testing.assert_series_equal(prev.prevalence, before)
+    later = prevalence(phenofile).atbaseline(baselines[-1])
+    pd.testing.assert_series_equal(out[baselines[-1]], later.prevalence, check_names=False)
+    assert not out[baselines[-1]].equals(out[baselines[0]])
+
+
+def test_chain_of_prevalence_sweep_and_incidence(phenofile):
+    # As in 'prevalence -b 2010-08-01 -b 2020-01-01 incidence -b 2010-08-01'
+    obj, baselines = dict(), [Prevalence.UKBbaseline, pd.Timestamp("2020-01-01")]
+    pheno = read(phenofile)
+    memo_prevalence(obj, pheno, baselines[0]).sweep(baselines)
+    chained = Incidence(prev=memo_prevalence(obj, pheno, baselines[0]), enddate=Incidence.UKBenddate)
+    alone = Incidence(prev=memo_prevalence(dict(), read(phenofile), baselines[0]), enddate=Incidence.UKBenddate)
+    assert len(obj['eastwood']) == 1
+    for outcome in Incidence.Outcomes:
+        pd.testing.assert_series_equal(getattr(chained, outcome), getattr(alone, outcome))
+
+
+def test_second_prevalence_on_the_same_phenotype(phenofile):
+    first = prevalence(phenofile)
+    second = Prevalence(first._pheno, baseline=Prevalence.UKBbaseline)
+    assert first.dm['date_anydm_ni'].notna().any()
+    pd.testing.assert_frame_equal(second.dm, first.dm)
+    pd.testing.assert_series_equal(second.prevalence, first.prevalence)
@@ -0,0 +1,75 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from eastwood import kleene
+
+
+# The three truth values and every combination of them, one per row; pandas' nullable booleans follow Kleene logic
+TRUTH = [True, False, pd.NA]
+PAIRS = list(itertools.product(TRUTH, repeat=2))
+TRIPLES = list(itertools.product(TRUTH, repeat=3))
+
+
+def column(values):
+    return pd.Series(list(values), dtype="boolean")
+
+
+def expect(result, oracle):
+    """Assert that the (value, known) pair result has the truth values of the boolean pd.Series oracle."""
+    value, known = result
+    np.testing.assert_array_equal(known, oracle.notna().to_numpy())
+    np.testing.assert_array_equal(value, oracle.fillna(False).to_numpy(dtype=bool))
+
+
+def test_kleene_operands():
+    series = column(TRUTH)
+    value, known = kleene.kleene(series)
+    assert value.tolist() == [True, False, False] and known.tolist() == [True, True, False]
+    assert kleene.kleene((value, known)) == (value, known)
+    value, known = kleene.kleene([True, False])
+    assert value.tolist() == [True, False] and known.all()
+
+
+def test_and_or_not_truth_tables():
+    a, b = column(pair[0] for pair in PAIRS), column(pair[1] for pair in PAIRS)
+    expect(kleene.and_(a, b), a & b)
+    expect(kleene.or_(a, b), a | b)
+    expect(kleene.not_(a), ~a)
+    expect(kleene.and_(kleene.kleene(a), b.to_numpy(dtype=bool, na_value=True)), a & b.fillna(True))
+
+
+def test_all_any_truth_tables():
+    cols = [column(triple[i] for triple in TRIPLES) for i in range(3)]
+    expect(kleene.all(cols), cols[0] & cols[1] & cols[2])
+    expect(kleene.any(cols), cols[0] | cols[1] | cols[2])
+    frame = pd.DataFrame({i: col for i, col in enumerate(cols)})
+    expect(kleene.all(frame), cols[0] & cols[1] & cols[2])
+    expect(kleene.any(frame), cols[0] | cols[1] | cols[2])
+    expect(kleene.all(cols[:1]), cols[0])
+    expect(kleene.any(cols[:1]), cols[0])
+
+
+def test_all_any_leave_operands_as_is():
+    a, b = kleene.kleene(column(TRUTH)), kleene.kleene(column([False, pd.NA, True]))
+    copies = [array.copy() for array in a + b]
+    kleene.all([a, b]), kleene.any([a, b])
+    assert all(np.array_equal(array, before) for array, before in zip(a + b, copies))
+
+
+def test_all_any_require_operands():
+    with pytest.raises(ValueError):
+        kleene.all([])
+    with pytest.raises(ValueError):
+        kleene.any([])
+
+
+def test_mask_and_series():
+    a = column(TRUTH)
+    assert kleene.mask(a).tolist() == [True, False, False]
+    assert kleene.mask(kleene.not_(a)).tolist() == [False, True, False]
+    out = kleene.series(kleene.kleene(a), index=["x", "y", "z"], name="dm")
+    pd.testing.assert_series_equal(out, pd.Series(TRUTH, index=["x", "y", "z"], name="dm", dtype="boolean"))
+    pd.testing.assert_series_equal(kleene.series(kleene.or_(a, [False, False, False])), a)
@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+
+from phenotool.phenotype import Phenotype
+
+
+@pytest.fixture
+def malformed(tmp_path):
+    path = tmp_path / "pheno.tsv"
+    path.write_text("IID\tSEX\tbmi\nid1\t1\t25.5\nid2\t2\t31.0\nid3\t1\t22.0\nid4\t2\t27.5\textra\tfields\n")
+    return path
+
+
+@pytest.mark.parametrize("kwargs", [{}, {'chunksize': 2}], ids=["whole", "chunked"])
+def test_unparsable_file_raises(malformed, kwargs):
+    with open(malformed) as fh, pytest.raises(pd.errors.ParserError):
+        Phenotype(fh, sep="\t", **kwargs)
+    with pytest.raises(pd.errors.ParserError):
+        Phenotype(str(malformed), sep="\t", **kwargs)
+
+
+def test_frame_input():
+    df = pd.DataFrame({'IID': ["id1", "id2"], 'SEX': [1, 2], 'bmi': [25.5, 31.0]})
+    pheno = Phenotype(df, phenovars=["bmi"])
+    assert pheno.index.to_list() == ["id1", "id2"]
+    assert pheno.df['bmi'].to_list() == [25.5, 31.0]
@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+
+from ukbiobank.postings import Postings
+
+
+FIELDS = ["20002", "20008", "41270"]
+QUERIES = [("20002", "1065"), ("20002", [1065]), ("20002", [1065.0]), ("20002", "1065.0"), ("20002", ["1220", "1223"]),
+           ("20002", [1220.0]), ("20002", "-1"), ("20008", [2003.5]), ("20008", "2003.5"), ("41270", "E119"), ("41270", ["E100", "I10"])]
+DICTIONARY = "FieldID\tValueType\tCoding\n20002\tContinuous\t\n20008\tContinuous\t13\n"
+
+
+# Codes written as integers, as floats (eg. by an export of a float-typed field) and as text; -1/-3 are missing
+@pytest.fixture
+def table():
+    return [
+        ["f.eid", "f.20002.0.0", "f.20002.0.1", "f.20002.1.0", "f.20008.0.0", "f.41270.0.0", "f.41270.0.1"],
+        ["1000001", "1220", "1065", "NA", "2003.5", "E119", "I10"],
+        ["1000002", "1065.0", "NA", "1223.0", "2003.50", "NA", "NA"],
+        ["1000003", "-1", "NA", "1065", "-1", "E100", "NA"],
+        ["1000004", "NA", "NA", "-3", "NA", "NA", "NA"],
+        ["1000005", "1223", "1220.0", "NA", "1995.5", "I10", "E119"],
+    ]
+
+
+def test_normalize():
+    assert Postings.normalize(["1065", 1065, 1065.0, "1065.0", " 1065 ", 2003.5, "2003.50", "E119", "-1.0"]).tolist() == \
+        ["1065"] * 5 + ["2003.5"] * 2 + ["E119", "-1"]
+    assert Postings.normalize([]).size == 0
+
+
+@pytest.mark.parametrize("dictionary", [None, DICTIONARY], ids=["text", "float"])
+def test_postings_equal_scan(parse, build, tmp_path, dictionary):
+    read = dict()
+    if dictionary:
+        (tmp_path / "dictionary.tsv").write_text(dictionary)
+        read['dictionary'] = tmp_path / "dictionary.tsv"
+    scanned = parse(FIELDS, **read)
+    assert scanned._postings is None
+    build(Postings, FIELDS, sep="\t")
+    indexed = parse(FIELDS, **read)
+    assert indexed._postings is not None
+    for field, values in QUERIES:
+        expected, found = scanned.findinfield(field, values), indexed.findinfield(field, values)
+        pd.testing.assert_series_equal(found, expected, obj=f"findinfield({field}, {values!r})")
+        assert expected.any()
+        hits, known = indexed.findininstances(field, values)
+        expected_hits, expected_known = scanned.findininstances(field, values)
+        np.testing.assert_array_equal(hits, expected_hits)
+        pd.testing.assert_frame_equal(known, expected_known.rename(columns=str))
+
+
+def test_older_index_is_ignored(parse, build):
+    postings = build(Postings, FIELDS, sep="\t")
+    postings.manifest.pop('version')
+    (postings.path / Postings.MANIFEST).write_text(json.dumps(postings.manifest))
+    assert parse(FIELDS)._postings is None
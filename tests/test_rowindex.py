@@ -0,0 +1,63 @@
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+
+from phenotool.rowindex import RowIndex
+
+
+PHENOVARS = ["31", "20002", "41270"]
+
+
+@pytest.fixture
+def table():
+    return [
+        ["f.eid", "f.31.0.0", "f.20002.0.0", "f.41270.0.0"],
+        ["1000001", "1", "1220", "E119"],
+        ["1000002", "0", "NA", "NA"],
+        ['"1000003"', "0", "1065", "I10"],
+        ["1000004", "1", "1223", "E100"],
+    ]
+
+
+@pytest.fixture(params=["\n", "\r\n"], ids=["LF", "CRLF"])
+def newline(request):
+    return request.param
+
+
+def test_subset_returns_header_and_requested_rows(phenofile, build):
+    built = build(RowIndex)
+    assert built.ids.to_list() == ["1000001", "1000002", "1000003", "1000004"]
+    rowindex = RowIndex.find(str(phenofile))
+    assert rowindex is not None and rowindex.ids.equals(built.ids)
+    header, *rows = phenofile.read_bytes().splitlines(keepends=True)
+    out = rowindex.subset(["1000004", 1000001, "9999999", "1000004", "1000003"])
+    assert out.read() == header + rows[0] + rows[2] + rows[3] # In file order, without duplicates or unknown samples
+    assert rowindex.subset(["9999999"]).read() == header
+
+
+def test_modified_source_is_detected(phenofile, build):
+    build(RowIndex)
+    with open(phenofile, 'r+b') as fh: # Same size, new content
+        fh.write(b"f.eid\tf.31.0.0\tf.20002.0.0\tf.41270.0.1")
+    stat = os.stat(phenofile)
+    os.utime(phenofile, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert RowIndex.find(str(phenofile)) is None
+    build(RowIndex)
+    assert RowIndex.find(str(phenofile)) is not None
+    with open(phenofile, 'ab') as fh:
+        fh.write(b"1000005\t0\tNA\tNA\n")
+    assert RowIndex.find(str(phenofile)) is None
+
+
+def test_parse_with_rowindex_equals_full_parse(build, parse, caplog):
+    samples = ["1000003", "1000001", "9999999"]
+    full = parse(PHENOVARS, samples=samples).df
+    build(RowIndex)
+    with caplog.at_level("INFO", logger="phenotool.rowindex"):
+        indexed = parse(PHENOVARS, samples=samples).df
+    assert "Read 2 of 3 requested samples using the row index" in caplog.text
+    pd.testing.assert_frame_equal(indexed, full)
+    assert indexed.index.astype(str).to_list() == samples and indexed.loc[indexed.index[-1]].isna().all()
@@ -0,0 +1,148 @@
+import re
+import numpy as np
+import pandas as pd
+import pytest
+
+from eastwood import kleene
+from eastwood.rules import Ruleset
+
+
+CATEGORIES = {'no': "None", 'low': "Low", 'high': "High"}
+
+
+def frame(**cols):
+    return pd.DataFrame({name: pd.array(values, dtype="boolean") for name, values in cols.items()})
+
+
+def test_first_matching_step_wins():
+    rules = Ruleset(CATEGORIES, {'X': {'default': 'no', 'steps': [('1', 'p', 'high'), ('2', 'q', 'low')]}})
+    df = frame(p=[True, True, False, pd.NA, False], q=[True, False, True, True, pd.NA])
+    assert rules(df).tolist() == ["High", "High", "Low", "Low", "None"]
+
+
+def test_comparisons_and_parameters():
+    rules = Ruleset(CATEGORIES, {'X': {'default': 'no', 'steps': [
+        ('1', ('<=', 'date', '{baseline}'), 'high'),
+        ('2', ('no', ('<', 'age', 40)), 'low'),
+    ]}})
+    df = pd.DataFrame({'date': pd.to_datetime(["2001-01-01", "2020-01-01", None, None]), 'age': [50, 45, np.nan, 20]})
+    assert rules(df, baseline=pd.Timestamp("2010-01-01")).tolist() == ["High", "Low", "Low", "None"]
+
+
+def test_later_flowcharts_take_their_entry_category():
+    rules = Ruleset(CATEGORIES, {
+        'X': {'default': 'low', 'steps': [('1', 'p', 'no')]},
+        'Y': {'entry': 'low', 'default': 'low', 'steps': [('2', 'q', 'high')]},
+    })
+    df = frame(p=[True, False, False], q=[True, True, False])
+    assert rules(df).tolist() == ["None", "High", "Low"]
+    assert rules(df, charts=['Y'], start=["None", "Low", "High"]).tolist() == ["None", "High", "High"]
+
+
+def test_shared_subconditions_are_compiled_once():
+    shared = ('no', ('any', 'p', 'q'))
+    rules = Ruleset(CATEGORIES, {
+        'X': {'default': 'no', 'steps': [('1', ('all', 'r', shared), 'high'), ('2', shared, 'low')]},
+        'Y': {'entry': 'low', 'default': 'low', 'steps': [('3', ('all', shared, ('>', 'age', 3)), 'high')]},
+    })
+    # r, p, q, any, no, all, age > 3, all
+    assert len(rules.program) == 8
+    assert rules.columns == ['r', 'p', 'q', 'age']
+
+
+def test_unknown_operator():
+    with pytest.raises(ValueError):
+        Ruleset(CATEGORIES, {'X': {'default': 'no', 'steps': [('1', ('xor', 'p', 'q'), 'high')]}})
+
+
+
+# The flowcharts of Eastwood2016 (Fig 2) as they were written by hand before they became a Ruleset
+
+def handwritten(dm, baseline, labels):
+    """Return: The prevalence of the subjects in dm after flowcharts A, B and C."""
+    out = pd.Series(pd.Categorical([pd.NA] * dm.index.size, categories=list(labels.values())), index=dm.index)
+    out[:] = flowchartA(dm, baseline, labels)
+    t1 = (out == labels['T1Moderate']).to_numpy()
+    out[t1] = flowchartB(dm[t1], baseline, labels)
+    t2 = (out == labels['T2Moderate']).to_numpy()
+    out[t2] = flowchartC(dm[t2], baseline, labels)
+    return out
+
+
+def flowchartA(dm, baseline, labels):
+    out = np.full(dm.index.size, None, dtype=object)
+    left = np.ones(dm.index.size, dtype=bool)
+    def assign(x, category):
+        x = kleene.mask(kleene.and_(x, left))
+        out[x] = labels[category]
+        left[x] = False
+    x = kleene.any(dm[['gdmonly_sr', 'alldm_ni', 'gdm_ni', 't1dm_ni', 't2dm_ni', 'drug_ins_ni', 'drug_ins_sr', 'drug_metf_ni', 'drug_nonmetf_oad_ni']])
+    assign(~kleene.mask(kleene.or_(x, dm['date_anydm_ip'] <= baseline)), 'Negative')
+    nodm = ~kleene.mask(kleene.any(dm[['anydmrx_ni_sr', 't1dm_ni', 't2dm_ni']]))
+    assign(kleene.any([kleene.all([dm['gdmonly_sr'], nodm]), kleene.all([dm['gdm_ni'], dm['agediag_gdm_ni'] < 50, nodm])]), 'GDModerate')
+    assign(dm['drug_nonmetf_oad_ni'], 'T2Moderate')
+    assign(kleene.or_(dm['agedm_ts_or_ni'] > 36, kleene.and_(dm['agedm_ts_or_ni'] >= 31, dm['ethnic_sa_afc'])), 'T2Moderate')
+    x = kleene.or_(kleene.any(dm[['drug_ins_sr', 'drug_ins_ni', 'insat1yr', 't1dm_ni']]), dm['date_t1dm_ip'] <= baseline)
+    x = kleene.mask(kleene.and_(x, left))
+    left[x] = False
+    out[left] = labels['T2Moderate']
+    out[x] = labels['T1Moderate']
+    return out
+
+
+def flowchartB(dm, baseline, labels):
+    out = np.full(dm.index.size, labels['T1Moderate'], dtype=object)
+    x = kleene.mask(kleene.or_(dm['t1dm_ni'], dm['date_t1dm_ip'] <= baseline))
+    out[x] = labels['T1High']
+    y = kleene.mask(kleene.and_(kleene.and_(dm['insat1yr'], kleene.any(dm[['drug_ins_sr', 'drug_ins_ni']])), ~x))
+    out[y] = labels['T1High']
+    return out
+
+
+def flowchartC(dm, baseline, labels):
+    out = np.full(dm.index.size, None, dtype=object)
+    left = np.ones(dm.index.size, dtype=bool)
+    x = kleene.mask(kleene.and_(dm['drug_metf_ni'], ~kleene.mask(kleene.any(dm[['drug_ins_sr', 'drug_ins_ni', 'drug_nonmetf_oad_ni']]))))
+    y = kleene.mask(kleene.and_(x, ~kleene.mask(dm['anynsgt1t2_ni'])))
+    y[(dm['date_anydm_ip'] <= baseline).to_numpy()] = False
+    out[y] = labels['Negative']
+    left[y] = False
+    for x, category in [(kleene.or_(dm['drug_nonmetf_oad_ni'], dm['date_t2dm_ip'] <= baseline), 'T2High'),
+                        (~kleene.mask(kleene.any(dm[['drug_ins_sr', 'drug_ins_ni']])), 'T2High')]:
+        x = kleene.mask(kleene.and_(x, left))
+        out[x] = labels[category]
+        left[x] = False
+    x = kleene.mask(kleene.and_(dm['t1dm_ni'], left))
+    left[x] = False
+    out[left] = labels['T2Moderate']
+    out[x] = labels['T1High']
+    return out
+
+
+def synthetic_dm(n=4000, seed=1):
+    """Return: A random dm; flags are rare, so that subjects reach the later steps, and may be missing."""
+    rng = np.random.default_rng(seed)
+    def flag(p):
+        return pd.array(np.where(rng.random(n) < 0.1, None, rng.random(n) < p), dtype="boolean")
+    def dates():
+        return pd.Series(pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 365 * 20, n), unit="D")).where(rng.random(n) < 0.2)
+    dm = pd.DataFrame({name: flag(0.15) for name in ['gdmonly_sr', 'alldm_ni', 'gdm_ni', 't1dm_ni', 't2dm_ni', 'drug_ins_ni', 'drug_ins_sr',
+                                                       'drug_metf_ni', 'drug_nonmetf_oad_ni', 'insat1yr', 'anynsgt1t2_ni', 'ethnic_sa_afc']})
+    dm['date_anydm_ip'], dm['date_t1dm_ip'], dm['date_t2dm_ip'] = dates(), dates(), dates()
+    dm['agediag_gdm_ni'] = pd.Series(rng.integers(20, 60, n), dtype="float64").where(rng.random(n) < 0.5)
+    dm['agedm_ts_or_ni'] = pd.Series(rng.integers(10, 50, n), dtype="float64").where(rng.random(n) < 0.7)
+    dm['anydmrx_ni_sr'] = dm[['drug_ins_ni', 'drug_metf_ni', 'drug_nonmetf_oad_ni', 'drug_ins_sr']].any(axis='columns')
+    return dm
+
+
+def test_prevalence_rules_equal_the_handwritten_flowcharts(caplog):
+    pytest.importorskip("pklib")
+    from eastwood.eastwood import Eastwood, Prevalence
+    dm, baseline = synthetic_dm(), pd.Timestamp("2010-08-01")
+    expected = handwritten(dm, baseline, Eastwood.CategoriesDM)
+    with caplog.at_level("INFO", logger="eastwood.rules"):
+        pd.testing.assert_series_equal(Prevalence.Rules(dm, baseline=baseline), expected)
+    assigned = dict(re.findall(r"Prevalence ([\d.+]+): (\d+) subjects assigned", caplog.text))
+    steps = [label for chart in Prevalence.Flowcharts.values() for label, _, _ in chart['steps']]
+    assert list(assigned) == steps and all(int(n) > 0 for n in assigned.values()) # Every step is reached
+    assert len(set(Prevalence.Rules.program)) == len(Prevalence.Rules.program)
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+
+from ukbiobank.sharedstore import SharedStore
+
+
+PHENOVARS = ["31", "53", "20002", "20008", "41270", "2443"]
+
+
+@pytest.fixture
+def table():
+    return [
+        ["f.eid", "f.31.0.0", "f.53.0.0", "f.20002.0.0", "f.20002.0.1", "f.20008.0.0", "f.41270.0.0", "f.2443.0.0"],
+        ["1000001", "1", "2008-01-02", "1220", "1065", "2003.5", "E119", "1"],
+        ["1000002", "0", "2009-03-04", "NA", "NA", "NA", "NA", "0"],
+        ["1000003", "0", "NA", "1065", "1223", "-1", "I10", "-3"],
+    ]
+
+
+def test_published_frame_equals_parsed(parse, tmp_path, caplog):
+    parsed = parse(PHENOVARS)
+    published = parse(PHENOVARS, shm=tmp_path / "shm")
+    with caplog.at_level("INFO", logger="ukbiobank.sharedstore"):
+        shared = parse(PHENOVARS, shm=tmp_path / "shm")
+    assert "Found published frame" in caplog.text
+    pd.testing.assert_frame_equal(published.df, parsed.df)
+    pd.testing.assert_frame_equal(shared.df, parsed.df)
+    assert shared.helpers == parsed.helpers
+
+
+def test_published_frame_selects_samples(parse, tmp_path):
+    parse(PHENOVARS, shm=tmp_path / "shm")
+    shared = parse(PHENOVARS, shm=tmp_path / "shm", samples=["1000003", "1000001"])
+    pd.testing.assert_frame_equal(shared.df, parse(PHENOVARS, samples=["1000003", "1000001"]).df)
+
+
+def test_write_restores_dtypes_and_values(tmp_path):
+    df = pd.DataFrame({
+        'text':     pd.array(["a", None, "b"], dtype="string"),
+        'mixed':    np.array([1065, "x", None], dtype=object),
+        'dates':    np.array([pd.Timestamp("2001-01-01"), None, pd.Period("2002-01", "M")], dtype=object),
+        'category': pd.Categorical([1, 2, None]),
+        'period':   pd.period_range("2000-01", periods=3, freq="M"),
+        'integer':  pd.array([1, None, 3], dtype="Int32"),
+        'boolean':  pd.array([True, None, False], dtype="boolean"),
+        'datetime': pd.to_datetime(["2001-01-01", None, "2002-02-02"]),
+    }, index=pd.Index([1, "x", 3], name="EID"))
+    out = SharedStore.write(df, tmp_path / "store").read()
+    pd.testing.assert_frame_equal(out, df)
+    assert [type(value) for value in out['mixed']] == [int, str, float]
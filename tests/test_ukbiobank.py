@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("pklib")
+
+
+DICTIONARY = "FieldID\tValueType\tCoding\n6153\tCategorical multiple\t100626\n2986\tCategorical single\t100349\n20003\tInteger\t\n"
+
+
+@pytest.fixture
+def table():
+    return [
+        ["f.eid", "f.20008.0.0", "f.20008.0.1", "f.20008.1.0", "f.6153.0.0", "f.6153.0.1", "f.2986.0.0", "f.20003.0.0"],
+        ["1000001", "1998.5", "2003.0", "NA", "3", "1", "1", "1140883066"],
+        ["1000002", "-1", "NA", "2012.25", "-1", "NA", "-1", "-1"],
+        ["1000003", "NA", "-3", "1995.9166", "1", "-3", "0", "1140884600"],
+        ["1000004", "NA", "NA", "NA", "-1", "3", "NA", "-3"],
+        ["1000005", "NA", "NA", "NA", "NA", "NA", "-3", "NA"],
+    ]
+
+
+def test_dc13todate_converts_once(parse):
+    pheno = parse(["20008"])
+    pheno.dc13toDate('20008')
+    first = pheno.df.copy()
+    assert all(isinstance(dtype, pd.PeriodDtype) for dtype in first.dtypes)
+    assert first.loc[1000001].tolist() == [pd.Period("1998-06", "M"), pd.Period("2002-12", "M"), pd.NaT]
+    assert first.loc[1000002].isna().tolist() == [True, True, False]
+    pheno.dc13toDate('20008')
+    pd.testing.assert_frame_equal(pheno.df, first)
+
+
+@pytest.mark.parametrize("typed", [False, True], ids=["numeric", "dictionary"])
+def test_missing_codes_in_numeric_columns(parse, tmp_path, typed):
+    # -1 (Unknown) and -3 (Prefer not to answer) are missing data, not a 'no', whatever the dtype of the column
+    read = dict()
+    if typed:
+        (tmp_path / "dictionary.tsv").write_text(DICTIONARY)
+        read['dictionary'] = tmp_path / "dictionary.tsv"
+    pheno = parse(["6153", "2986", "20003"], **read)
+    assert pd.api.types.is_integer_dtype(pheno.df['f20003_0_0'])
+    assert pheno.findinfield('6153', '3').tolist() == [True, pd.NA, False, True, pd.NA]
+    assert pheno.findinfield('2986', '1').tolist() == [True, pd.NA, False, pd.NA, pd.NA]
+    assert pheno.findinfield('20003', '1140883066').tolist() == [True, pd.NA, False, pd.NA, pd.NA]
+    assert pheno.pkisin('f20003_0_0', ['-1', '-3']).tolist() == [False, True, False, True, False]